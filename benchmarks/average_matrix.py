@@ -0,0 +1,41 @@
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from model import Model
+
+"""
+Compares TransitionMatrices.averageMatrix against np.average over the full transition tensor, for a full change of
+weights and for a change in a handful of ODIs between equilibrium iterations.
+"""
+
+if __name__ == "__main__":
+    ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+    inputs = sys.argv[1] if len(sys.argv) > 1 else "input-data-production"
+    model = Model(os.path.join(ROOT_DIR, "..", inputs))
+    transitionMatrices = model._Model__transitionMatrices
+    tensor = transitionMatrices.numpy
+    rng = np.random.default_rng(0)
+    weights = rng.random(tensor.shape[0]) * (rng.random(tensor.shape[0]) > 0.5)
+    nReps = 10
+
+    legacyTime = timeit.timeit(lambda: np.average(tensor, axis=0, weights=weights), number=nReps) / nReps
+    print("{0}: tensor {1}, legacy np.average {2:.1f} ms".format(inputs, tensor.shape, legacyTime * 1000))
+
+    def fullUpdate():
+        weights[:] = rng.random(tensor.shape[0]) * (rng.random(tensor.shape[0]) > 0.5)
+        return transitionMatrices.averageMatrix(weights)
+
+    def smallUpdate():
+        weights[rng.integers(tensor.shape[0], size=10)] = rng.random(10)
+        return transitionMatrices.averageMatrix(weights)
+
+    for name, update in [("all weights changed", fullUpdate), ("10 weights changed", smallUpdate)]:
+        newTime = timeit.timeit(update, number=nReps) / nReps
+        maxDiff = np.max(np.abs(update().matrix - np.average(tensor, axis=0, weights=weights)))
+        print("    {0}: {1:.2f} ms, {2:.0f}x speedup, max abs difference {3:.3g}".format(
+            name, newTime * 1000, legacyTime / newTime, maxDiff))
@@ -0,0 +1,52 @@
+import io
+import os
+import sys
+import time
+from contextlib import redirect_stdout
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from model import ScenarioData
+from utils.OD import TripCollection, ODindex, Trip, Allocation
+
+"""
+Compares TripCollection.importTrips before and after it was rewritten as a single pass over MicrotypeAssignment.csv
+"""
+
+
+def legacyImportTrips(trips: TripCollection, df):
+    for fromId in df.FromMicrotypeID.unique():
+        for toId in df.ToMicrotypeID.unique():
+            for dId in df.DistanceBinID.unique():
+                sub = df.loc[
+                      (df.FromMicrotypeID == fromId) & (df.ToMicrotypeID == toId) & (df.DistanceBinID == dId), :]
+                if len(sub) > 0:
+                    for row in sub.itertuples():
+                        if (not row.FromMicrotypeID == "None") & (not row.ToMicrotypeID == "None"):
+                            odi = ODindex(row.FromMicrotypeID, row.ToMicrotypeID, row.DistanceBinID)
+                            if odi in trips:
+                                trips[odi].allocation[row.ThroughMicrotypeID] = row.Portion
+                            else:
+                                trips[odi] = Trip(odi, Allocation({row.ThroughMicrotypeID: row.Portion}))
+                else:
+                    odi = ODindex(fromId, toId, dId)
+                    trips[odi] = trips.addEmpty(odi)
+
+
+if __name__ == "__main__":
+    ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+    for inputs in ["input-data", "input-data-production"]:
+        df = ScenarioData(os.path.join(ROOT_DIR, "..", inputs))["microtypeAssignment"]
+        old = TripCollection()
+        new = TripCollection()
+        with redirect_stdout(io.StringIO()):
+            start = time.time()
+            legacyImportTrips(old, df)
+            legacyTime = time.time() - start
+            start = time.time()
+            new.importTrips(df)
+            newTime = time.time() - start
+        same = [odi for odi, _ in old] == [odi for odi, _ in new] and all(
+            trip.allocation.mapping == new[odi].allocation.mapping for odi, trip in old)
+        print("{0}: {1} rows, {2} trips, legacy {3:.2f}s, new {4:.3f}s ({5:.0f}x), identical: {6}".format(
+            inputs, len(df), len(new), legacyTime, newTime, legacyTime / newTime, same))
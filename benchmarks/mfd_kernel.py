@@ -0,0 +1,47 @@
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from tests.test_mfd import legacyTimeSteps, syntheticRegion
+from utils.mfd import MFDTimeStepper, njit
+
+"""
+Compares the time stepping in MicrotypeCollection.transitionMatrixMFD before and after it moved to MFDTimeStepper,
+on a synthetic region with the same number of microtypes as input-data-production, and the alternative integrators
+against Euler with a ten times smaller time step.
+"""
+
+
+if __name__ == "__main__":
+    nMicrotypes = 51  # input-data-production
+    dt = 30.0
+    nSteps = int(3 * 3600. / dt)
+    for congestion in [0.05, 0.5, 2.0]:
+        args = syntheticRegion(nMicrotypes, congestion)
+        reference = legacyTimeSteps(*args, dt, nSteps)
+        candidates = {"numpy": MFDTimeStepper(useNumba=False)}
+        if njit is not None:
+            candidates["numba"] = MFDTimeStepper(useNumba=True)
+            candidates["numba"].run(*args, dt, nSteps)  # compile
+        nReps = 20
+        legacyTime = timeit.timeit(lambda: legacyTimeSteps(*args, dt, nSteps), number=nReps) / nReps
+        print("Congestion factor {0}: legacy loop {1:.2f} ms per call".format(congestion, legacyTime * 1000))
+        for name, stepper in candidates.items():
+            out = stepper.run(*args, dt, nSteps)
+            maxDiff = max([np.nanmax(np.abs(a - b)) for a, b in zip(out, reference)])
+            stepperTime = timeit.timeit(lambda: stepper.run(*args, dt, nSteps), number=nReps) / nReps
+            print("    {0}: {1:.2f} ms per call, {2:.1f}x speedup, max abs difference {3:.3g}".format(
+                name, stepperTime * 1000, legacyTime / stepperTime, maxDiff))
+        fine = MFDTimeStepper().run(*args, dt / 10., nSteps * 10)
+        fineAverageSpeed = np.sum(fine[0] * fine[1], axis=1) / np.sum(fine[0], axis=1)
+        for integrator in ["euler", "RK45", "LSODA", "semi-implicit"]:
+            stepper = MFDTimeStepper(integrator=integrator)
+            out = stepper.run(*args, dt, nSteps)
+            averageSpeed = np.sum(out[0] * out[1], axis=1) / np.sum(out[0], axis=1)
+            stepperTime = timeit.timeit(lambda: stepper.run(*args, dt, nSteps), number=nReps) / nReps
+            print("    {0}: {1:.2f} ms per call, {2} rhs evaluations, max average speed error {3:.3g} m/s".format(
+                integrator, stepperTime * 1000, stepper.nfev, np.max(np.abs(averageSpeed - fineAverageSpeed))))
@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 # from noisyopt import minimizeCompass
 # from line_profiler_pycharm import profile
@@ -8,18 +9,23 @@ from itertools import product
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from scipy.optimize import minimize, Bounds, shgo
+from scipy.optimize import minimize, Bounds, shgo, differential_evolution
 
 from utils.OD import TripCollection, OriginDestination, TripGeneration, TransitionMatrices, DemandIndex
+from utils.cache import ScenarioCache
 from utils.choiceCharacteristics import CollectedChoiceCharacteristics
 from utils.demand import Demand, CollectedTotalUserCosts, ODindex
+from utils.equilibrium import WarmStartStore, FixedPointSolver, EquilibriumState, TimePeriodSolution, \
+    handOffDifference
 from utils.microtype import MicrotypeCollection, CollectedTotalOperatorCosts
 from utils.misc import TimePeriods, DistanceBins
-from utils.network import CollectedNetworkStateData
+from utils.network import CollectedNetworkStateData, ModeParameters, SubNetworkParameters
 from utils.population import Population
 
-
-# from skopt import gp_minimize
+try:
+    from skopt import Optimizer as BayesianOptimizer
+except ImportError:
+    BayesianOptimizer = None
 
 
 class Optimizer:
@@ -37,21 +43,36 @@ class Optimizer:
         e.g. [('A', 'bus'), ('B','rail')]
     method : str
         Optimization method
+    warmStart : bool
+        Start each evaluation from the equilibrium of the previous one, rather than from the default mode split
+    nWorkers : int
+        Number of worker processes, each with its own Model, used by evaluateBatch
+    cacheDirectory : str | None
+        Where the models keep a snapshot of the parsed inputs (see ScenarioCache), or None for no snapshot
         
     Methods
     ---------
     evaluate(reallocations):
         Evaluate the objective funciton given a set of modifications to the transportation system
+    evaluateBatch(X):
+        Evaluate the objective function for each row of X, spread over nWorkers processes
     minimize():
         Minimize the objective function using the set method
+    close():
+        Shuts down the worker processes
     """
 
-    def __init__(self, path: str, fromToSubNetworkIDs=None, modesAndMicrotypes=None, method="shgo"):
+    def __init__(self, path: str, fromToSubNetworkIDs=None, modesAndMicrotypes=None, method="shgo", warmStart=True,
+                 nWorkers=1, cacheDirectory=None):
         self.__path = path
+        self.__cacheDirectory = cacheDirectory
         self.__fromToSubNetworkIDs = fromToSubNetworkIDs
         self.__modesAndMicrotypes = modesAndMicrotypes
         self.__method = method
-        self.model = Model(path)
+        self.warmStart = warmStart
+        self.nWorkers = nWorkers
+        self.__batch = None
+        self.model = Model(path, cacheDirectory)
         print("Done")
 
     def nSubNetworks(self):
@@ -74,12 +95,16 @@ class Optimizer:
 
     def getDedicationCost(self, reallocations: np.ndarray) -> float:
         if self.nSubNetworks() > 0:
-            microtypes = self.model.scenarioData["subNetworkData"].loc[self.toSubNetworkIDs(), "MicrotypeID"]
-            modes = self.model.scenarioData["modeToSubNetworkData"].loc[
-                self.model.scenarioData["modeToSubNetworkData"]["SubnetworkID"].isin(
-                    self.toSubNetworkIDs()), "ModeTypeID"]
-            perMeterCosts = self.model.scenarioData["laneDedicationCost"].loc[
-                pd.MultiIndex.from_arrays([microtypes, modes]), "CostPerMeter"].values
+            microtypes = self.model.scenarioData["subNetworkDataFull"].loc[self.toSubNetworkIDs(), "MicrotypeID"]
+            modeToSubNetwork = self.model.scenarioData["modeToSubNetworkData"]
+            costPerMeter = self.model.scenarioData["laneDedicationCost"]["CostPerMeter"]
+            perMeterCosts = []
+            for toID, microtypeID in zip(self.toSubNetworkIDs(), microtypes):
+                # A dedicated subnetwork can allow more than one mode, only the one the lane is dedicated to has a cost
+                costs = [costPerMeter[(microtypeID, mode)] for mode in
+                         modeToSubNetwork.loc[modeToSubNetwork["SubnetworkID"] == toID, "ModeTypeID"]
+                         if (microtypeID, mode) in costPerMeter.index]
+                perMeterCosts.append(costs[0] if len(costs) > 0 else np.nan)
             cost = np.sum(reallocations[:self.nSubNetworks()] * perMeterCosts)
             if np.isnan(cost):
                 return np.inf
@@ -88,25 +113,46 @@ class Optimizer:
         else:
             return 0.0
 
-    def evaluate(self, reallocations: np.ndarray) -> float:
-        # self.model.resetNetworks()
+    def getModifications(self, reallocations: np.ndarray):
         if self.__fromToSubNetworkIDs is not None:
             networkModification = NetworkModification(reallocations[:self.nSubNetworks()], self.__fromToSubNetworkIDs)
         else:
             networkModification = None
         if self.__modesAndMicrotypes is not None:
-            transitModification = TransitScheduleModification(reallocations[-self.nSubNetworks():],
+            transitModification = TransitScheduleModification(reallocations[self.nSubNetworks():],
                                                               self.__modesAndMicrotypes)
         else:
             transitModification = None
-        self.model.modifyNetworks(networkModification, transitModification)
-        userCosts, operatorCosts, vectorUserCosts = self.model.collectAllCosts()
+        return networkModification, transitModification
+
+    def evaluate(self, reallocations: np.ndarray) -> float:
+        userCosts, operatorCosts = self.model.scoreScenario(*self.getModifications(reallocations),
+                                                            warmStart=self.warmStart)
         dedicationCosts = self.getDedicationCost(reallocations)
         print(reallocations)
-        print(userCosts.total, operatorCosts.total, dedicationCosts)
-        return np.sum(vectorUserCosts) + operatorCosts.total + dedicationCosts
+        print(userCosts, operatorCosts, dedicationCosts)
+        return userCosts + operatorCosts + dedicationCosts
+
+    def evaluateBatch(self, X: np.ndarray) -> np.ndarray:
+        """
+        Objective function for each row of X (nPoints, nDims). With nWorkers > 1 the points are spread over a
+        ScenarioBatch, whose workers each hold their own Model and stay warm between batches. Either way every point
+        goes through Model.scoreScenario with the same warmStart setting.
+        """
+        X = np.atleast_2d(X)
+        if self.nWorkers == 1:
+            return np.array([self.evaluate(reallocations) for reallocations in X])
+        if self.__batch is None:
+            self.__batch = ScenarioBatch(self.__path, self.nWorkers, self.__cacheDirectory)
+        scores = self.__batch.score([self.getModifications(reallocations) for reallocations in X], self.warmStart)
+        return np.array([userCosts + operatorCosts + self.getDedicationCost(reallocations)
+                         for reallocations, (userCosts, operatorCosts) in zip(X, scores)])
+
+    def close(self):
+        if self.__batch is not None:
+            self.__batch.close()
+            self.__batch = None
 
-    """
     def getBounds(self):
         if self.__fromToSubNetworkIDs is not None:
             upperBoundsROW = list(
@@ -119,7 +165,7 @@ class Optimizer:
         lowerBoundsHeadway = [120.] * self.nModes()
         defaultHeadway = [300.] * self.nModes()
         bounds = list(zip(lowerBoundsROW + lowerBoundsHeadway, upperBoundsROW + upperBoundsHeadway))
-        if self.__method == "shgo":
+        if self.__method in ("shgo", "differential_evolution", "bayesian"):
             return bounds
         elif self.__method == "sklearn":
             return list(zip(lowerBoundsROW + lowerBoundsHeadway, upperBoundsROW + upperBoundsHeadway, defaultHeadway))
@@ -127,18 +173,21 @@ class Optimizer:
             return bounds
         else:
             return Bounds(lowerBoundsROW + lowerBoundsHeadway, upperBoundsROW + upperBoundsHeadway)
-    """
 
     def x0(self) -> np.ndarray:
         network = [10.0] * self.nSubNetworks()
         headways = [300.0] * self.nModes()
         return np.array(network + headways)
 
-    """
-    This method not used
-    def minimize(self):
+    def minimize(self, maxIterations=100):
         if self.__method == "shgo":
             return shgo(self.evaluate, self.getBounds(), sampling_method="simplicial")
+        elif self.__method == "differential_evolution":
+            # Each generation is scored as one batch, so it runs in parallel over the workers
+            return differential_evolution(lambda X: self.evaluateBatch(np.transpose(X)), self.getBounds(),
+                                          maxiter=maxIterations, vectorized=True, updating="deferred", polish=False)
+        elif self.__method == "bayesian":
+            return self.minimizeBayesian(maxIterations)
         # elif self.__method == "sklearn":
         #    b = self.getBounds()
         #    return gp_minimize(self.evaluate, self.getBounds(), n_calls=100)
@@ -151,7 +200,22 @@ class Optimizer:
         # return minimize(self.evaluate, self.x0(), method='trust-constr', bounds=self.getBounds(),
         #                 options={'verbose': 3, 'xtol': 10.0, 'gtol': 1e-4, 'maxiter': 15, 'initial_tr_radius': 10.})
 
-    """
+    def minimizeBayesian(self, nCalls=100, batchSize=None):
+        """
+        Gaussian process optimization that asks for batchSize points at a time (default: nWorkers) and scores them
+        with evaluateBatch. Requires scikit-optimize.
+        """
+        if BayesianOptimizer is None:
+            raise ImportError("Bayesian optimization requires scikit-optimize (pip install scikit-optimize)")
+        if batchSize is None:
+            batchSize = self.nWorkers
+        optimizer = BayesianOptimizer(self.getBounds(), base_estimator="GP", acq_func="EI")
+        nEvaluated = 0
+        while nEvaluated < nCalls:
+            points = optimizer.ask(n_points=min(batchSize, nCalls - nEvaluated))
+            optimizer.tell(points, list(self.evaluateBatch(np.array(points))))
+            nEvaluated += len(points)
+        return optimizer.get_result()
 
 class TransitScheduleModification:
     def __init__(self, headways: np.ndarray, modesAndMicrotypes: list):
@@ -173,6 +237,73 @@ class NetworkModification:
             yield (self.fromToSubNetworkIDs[i]), self.reallocations[i]
 
 
+class ScenarioDelta:
+    """
+    Records in place edits to subnetwork lengths and transit headways in a ScenarioData, so they can be reverted
+    without keeping a second copy of the scenario. The original value of each entry is saved the first time it is
+    changed.
+    """
+
+    def __init__(self, scenarioData):
+        self.__scenarioData = scenarioData
+        self.__originalLengths = dict()
+        self.__originalHeadways = dict()
+
+    def __len__(self):
+        return len(self.__originalLengths) + len(self.__originalHeadways)
+
+    def originalLength(self, subNetworkID) -> float:
+        if subNetworkID in self.__originalLengths:
+            return self.__originalLengths[subNetworkID]
+        return self.__scenarioData["subNetworkData"].at[subNetworkID, "Length"]
+
+    def setLength(self, subNetworkID, length: float):
+        if subNetworkID not in self.__originalLengths:
+            self.__originalLengths[subNetworkID] = self.__scenarioData["subNetworkData"].at[subNetworkID, "Length"]
+        self.__scenarioData.subNetworkParameters.set(subNetworkID, "Length", length)
+
+    def setHeadway(self, modeName: str, microtypeID: str, headway: float):
+        modeParameters = self.__scenarioData.modeParameters[modeName]
+        if (modeName, microtypeID) not in self.__originalHeadways:
+            self.__originalHeadways[modeName, microtypeID] = modeParameters.data.at[microtypeID, "Headway"]
+        modeParameters.set(microtypeID, "Headway", headway)
+
+    def apply(self, networkModification=None, scheduleModification=None):
+        if networkModification is not None:
+            for ((fromNetwork, toNetwork), laneDistance) in networkModification:
+                self.setLength(fromNetwork, self.originalLength(fromNetwork) - laneDistance)
+                self.setLength(toNetwork, self.originalLength(toNetwork) + laneDistance)
+
+        if scheduleModification is not None:
+            for ((microtypeID, modeName), newHeadway) in scheduleModification:
+                self.setHeadway(modeName, microtypeID, newHeadway)
+
+    def revert(self):
+        for subNetworkID, length in self.__originalLengths.items():
+            self.__scenarioData.subNetworkParameters.set(subNetworkID, "Length", length)
+        for (modeName, microtypeID), headway in self.__originalHeadways.items():
+            self.__scenarioData.modeParameters[modeName].set(microtypeID, "Headway", headway)
+        self.__originalLengths = dict()
+        self.__originalHeadways = dict()
+
+    def getChanges(self) -> (dict, dict):
+        """ Current subnetwork lengths and (mode, microtype) headways that differ from the original scenario """
+        lengths = {subNetworkID: self.__scenarioData["subNetworkData"].at[subNetworkID, "Length"] for subNetworkID in
+                   self.__originalLengths}
+        headways = {(modeName, microtypeID): self.__scenarioData.modeParameters[modeName].data.at[
+            microtypeID, "Headway"] for modeName, microtypeID in self.__originalHeadways}
+        return lengths, headways
+
+    def setChanges(self, changes: (dict, dict)):
+        """ Revert, then make the edits returned by getChanges (possibly of another model of the same scenario) """
+        self.revert()
+        lengths, headways = changes
+        for subNetworkID, length in lengths.items():
+            self.setLength(subNetworkID, length)
+        for (modeName, microtypeID), headway in headways.items():
+            self.setHeadway(modeName, microtypeID, headway)
+
+
 class ScenarioData:
     """
     Class to fetch and store data in a dictionary for specified scenario.
@@ -185,6 +316,12 @@ class ScenarioData:
         File path to input data
     data : dict
         Dictionary containing input data from respective inputs
+    cache : ScenarioCache | None
+        Binary snapshot of the parsed inputs, keyed by a hash of the input files
+    modeParameters : dict
+        Array backed ModeParameters by mode, built from data["modeData"] and shared by every mode object
+    subNetworkParameters : SubNetworkParameters
+        Array backed data["subNetworkData"], shared by every network object
 
     Methods
     -------
@@ -192,11 +329,15 @@ class ScenarioData:
         Loads more modes of transportation.
     loadData():
         Read in data corresponding to various inputs.
+    loadCache():
+        Restores data and indices from the cache, returns False if there is no snapshot yet.
+    saveCache():
+        Writes data and indices to the cache.
     copy():
         Return a new ScenarioData copy containing data.
     """
 
-    def __init__(self, path: str, data=None):
+    def __init__(self, path: str, data=None, cacheDirectory=None):
         """
         Constructs and loads all relevant data of the scenario into the instance.
 
@@ -206,6 +347,9 @@ class ScenarioData:
                 File path to input data
             data : dict
                 Dictionary containing input data from respective inputs
+            cacheDirectory : str | None
+                Read the parsed inputs from (and write them to) a snapshot in this directory, which can be shared by
+                several inputs. No snapshot is kept if None.
         """
         self.__path = path
         self.__diToIdx = dict()  # TODO: Just define this once at the beginning of everything
@@ -214,9 +358,14 @@ class ScenarioData:
         self.__dataToIdx = dict()
         self.__microtypeIdToIdx = dict()
         self.__paramToIdx = dict()
+        self.__modeParameters = None
+        self.__subNetworkParameters = None
+        self.cache = None if cacheDirectory is None else ScenarioCache(path, cacheDirectory)
         if data is None:
             self.data = dict()
-            self.loadData()
+            if not self.loadCache():
+                self.loadData()
+                self.saveCache()
         else:
             self.data = data
             self.loadData()
@@ -245,7 +394,23 @@ class ScenarioData:
     def microtypeIdToIdx(self):
         return self.__microtypeIdToIdx
 
+    @property
+    def modeParameters(self) -> dict:
+        if self.__modeParameters is None:
+            self.__modeParameters = {mode: ModeParameters(data) for mode, data in self["modeData"].items()}
+        return self.__modeParameters
+
+    @property
+    def subNetworkParameters(self) -> SubNetworkParameters:
+        if self.__subNetworkParameters is None:
+            self.__subNetworkParameters = SubNetworkParameters(self["subNetworkData"])
+        return self.__subNetworkParameters
+
     def __setitem__(self, key: str, value):
+        if key == "modeData":
+            self.__modeParameters = None
+        elif key == "subNetworkData":
+            self.__subNetworkParameters = None
         self.data[key] = value
 
     def __getitem__(self, item: str):
@@ -302,6 +467,23 @@ class ScenarioData:
 
         self.defineIndices()
 
+    def loadCache(self) -> bool:
+        if self.cache is None:
+            return False
+        cached = self.cache.load("scenarioData")
+        if cached is None:
+            return False
+        self.data, (self.__diToIdx, self.__odiToIdx, self.__modeToIdx, self.__dataToIdx, self.__microtypeIdToIdx,
+                    self.__paramToIdx) = cached
+        print("|  Loaded scenario data from cache ", self.cache.key)
+        return True
+
+    def saveCache(self):
+        if self.cache is not None:
+            self.cache.save("scenarioData", (self.data, (
+                self.__diToIdx, self.__odiToIdx, self.__modeToIdx, self.__dataToIdx, self.__microtypeIdToIdx,
+                self.__paramToIdx)))
+
     def defineIndices(self):
         self.__modeToIdx = {mode: idx for idx, mode in enumerate(self["modeData"].keys())}
 
@@ -351,8 +533,8 @@ class Model:
         File path to input data
     scenarioData : ScenarioData
         Class object to fetch and store mode and parameter data
-    initialScenarioData : ScenarioData
-        Initial state of the scenario
+    scenarioDelta : ScenarioDelta
+        Edits made to scenarioData since initialization, so they can be reverted
     currentTimePeriod : str
         Description of the current time period (e.g. 'AM-Peak')
     microtypes : dict(str, MicrotypeCollection)
@@ -373,6 +555,16 @@ class Model:
         Contains initialized trips with all the sets and classes
     originDestination : OriginDestination
         Stores origin/destination form of trips
+    warmStart : WarmStartStore
+        Converged equilibrium states by time period, and the iterations they saved
+    equilibriumSolver : FixedPointSolver
+        Update rule and stopping criteria for the mode split in findEquilibrium
+    timePeriodPipeline : TimePeriodPipeline
+        If set, collectAllCosts and collectAllCharacteristics solve the time periods in its worker processes
+    residuals : dict(str, list)
+        Stores currentTimePeriod to the mode split change at each iteration of the last findEquilibrium
+    converged : dict(str, bool)
+        Stores currentTimePeriod to whether the last findEquilibrium met the solver tolerance
 
     Methods
     -------
@@ -387,7 +579,13 @@ class Model:
     initializeTimePeriod:
         Initializes the model with time periods
     findEquilibrium():
-        Finds the ideal mode splits for the model
+        Finds the ideal mode splits for the model, returns the number of iterations
+    saveEquilibrium():
+        Stores the current equilibrium of every time period in warmStart
+    restoreEquilibrium():
+        Starts the next findEquilibrium of each time period from the state stored in warmStart
+    resetEquilibrium():
+        Starts the next findEquilibrium of each time period from the default mode split
     getModeSplit(timePeriod=None, userClass=None, microtypeID=None, distanceBin=None):
         Returns the optimal mode splits
     getUserCosts(mode=None):
@@ -400,16 +598,26 @@ class Model:
         Used in the optimizer class to edit network after initialization
     resetNetworks():
         Reset network to original initialization
+    getScenarioChanges() / setScenarioChanges(changes):
+        The current network and schedule edits, in a form that can be made to another model of the same scenario
     setTimePeriod(timePeriod: str):
 
+    solveTimePeriod(timePeriod, initialStates, startState, quantity):
+        Finds the equilibrium of one time period from explicit initial conditions, returns a TimePeriodSolution
     getModeSpeeds(timePeriod=None):
         Returns speeds for each mode in each microtype
+    evaluateScenario(networkModification=None, scheduleModification=None):
+        Applies the modifications to the base scenario, solves from the default mode split and returns
+        (vectorUserCosts, operatorCosts, modeSplit)
+    evaluateMany(modifications, nWorkers=None):
+        Evaluates a list of (networkModification, scheduleModification) pairs in a pool of worker processes
     """
 
-    def __init__(self, path: str):
+    def __init__(self, path: str, cacheDirectory=None):
         self.__path = path
-        self.scenarioData = ScenarioData(path)
-        self.__initialScenarioData = ScenarioData(path)
+        self.__cacheDirectory = cacheDirectory
+        self.scenarioData = ScenarioData(path, cacheDirectory=cacheDirectory)
+        self.__scenarioDelta = ScenarioDelta(self.scenarioData)
         self.__currentTimePeriod = None
         self.__microtypes = dict()  # MicrotypeCollection(self.modeData.data)
         self.__demand = dict()  # Demand()
@@ -422,6 +630,12 @@ class Model:
         self.__originDestination = OriginDestination()
         self.__transitionMatrices = TransitionMatrices(self.scenarioData)
         self.__networkStateData = dict()
+        self.__warmPeriods = set()
+        self.warmStart = WarmStartStore()
+        self.equilibriumSolver = FixedPointSolver()
+        self.timePeriodPipeline = None
+        self.residuals = dict()
+        self.converged = dict()
         self.readFiles()
         self.initializeAllTimePeriods()
 
@@ -515,15 +729,43 @@ class Model:
 
     # @profile
     def findEquilibrium(self):
+        solver = self.equilibriumSolver
+        solver.reset()
+        residuals = []
         diff = 1000.
         i = 0
-        while (diff > 0.00001) & (i < 20):
+        while (diff > solver.tolerance) & (i < solver.maxIterations):
             oldModeSplit = self.getModeSplit(self.__currentTimePeriod)
             self.demand.updateMFD(self.microtypes)
             self.choice.updateChoiceCharacteristics(self.microtypes, self.__trips)
-            diff = self.demand.updateModeSplit(self.choice, self.__originDestination, oldModeSplit)
-
+            diff = self.demand.updateModeSplit(self.choice, self.__originDestination, oldModeSplit, solver)
+            residuals.append(diff)
             i += 1
+        self.residuals[self.__currentTimePeriod] = residuals
+        self.converged[self.__currentTimePeriod] = diff <= solver.tolerance
+        if not self.converged[self.__currentTimePeriod]:
+            print("|  Equilibrium in time period ", self.__currentTimePeriod, " not converged after ", i,
+                  " iterations, mode split change ", diff)
+        self.warmStart.recordIterations(self.__currentTimePeriod, i, self.__currentTimePeriod in self.__warmPeriods)
+        self.__warmPeriods.add(self.__currentTimePeriod)
+        return i
+
+    def saveEquilibrium(self):
+        for timePeriod, demand in self.__demand.items():
+            self.warmStart.save(timePeriod, demand, self.__microtypes[timePeriod])
+
+    def restoreEquilibrium(self):
+        for timePeriod, demand in self.__demand.items():
+            if self.warmStart.restore(timePeriod, demand, self.__microtypes[timePeriod]):
+                self.__warmPeriods.add(timePeriod)
+
+    def resetEquilibrium(self):
+        for timePeriod, demand in self.__demand.items():
+            demand.resetModeSplit()
+            for _, networkStateData in self.__microtypes[timePeriod].collectedNetworkStateData:
+                networkStateData.resetBlockedDistance()
+                networkStateData.resetNonAutoAccumulation()
+        self.__warmPeriods = set()
 
     def getModeSplit(self, timePeriod=None, userClass=None, microtypeID=None, distanceBin=None):
         if timePeriod is None:
@@ -560,20 +802,16 @@ class Model:
 
     def modifyNetworks(self, networkModification=None,
                        scheduleModification=None):
-        originalScenarioData = self.__initialScenarioData.copy()
-        if networkModification is not None:
-            for ((fromNetwork, toNetwork), laneDistance) in networkModification:
-                oldFromLaneDistance = originalScenarioData["subNetworkData"].loc[fromNetwork, "Length"]
-                self.scenarioData["subNetworkData"].loc[fromNetwork, "Length"] = oldFromLaneDistance - laneDistance
-                oldToLaneDistance = originalScenarioData["subNetworkData"].loc[toNetwork, "Length"]
-                self.scenarioData["subNetworkData"].loc[toNetwork, "Length"] = oldToLaneDistance + laneDistance
-
-        if scheduleModification is not None:
-            for ((microtypeID, modeName), newHeadway) in scheduleModification:
-                self.scenarioData["modeData"][modeName].loc[microtypeID, "Headway"] = newHeadway
+        self.__scenarioDelta.apply(networkModification, scheduleModification)
 
     def resetNetworks(self):
-        self.scenarioData = self.__initialScenarioData.copy()
+        self.__scenarioDelta.revert()
+
+    def getScenarioChanges(self) -> (dict, dict):
+        return self.__scenarioDelta.getChanges()
+
+    def setScenarioChanges(self, changes: (dict, dict)):
+        self.__scenarioDelta.setChanges(changes)
 
     def updateTimePeriodDemand(self, timePeriodId, newTripStartRate):
         self.__demand[timePeriodId].updateTripStartRate(newTripStartRate)
@@ -583,16 +821,99 @@ class Model:
         as a dataframe and go by index. But, we're not keeping track of all accumulations so in that sense
         we always need to go in order."""
         networkStateData = self.networkStateData
-        self.__currentTimePeriod = timePeriod
-        self.__originDestination.setTimePeriod(timePeriod)
-        self.__tripGeneration.setTimePeriod(timePeriod)
+        self.__enterTimePeriod(timePeriod)
         if networkStateData:
             if not init:
                 self.microtypes.importPreviousStateData(networkStateData)
             else:
                 self.microtypes.resetStateData()
 
+    def __enterTimePeriod(self, timePeriod):
+        self.__currentTimePeriod = timePeriod
+        self.__originDestination.setTimePeriod(timePeriod)
+        self.__tripGeneration.setTimePeriod(timePeriod)
+
+    def solveTimePeriod(self, timePeriod, initialStates: dict, startState: EquilibriumState,
+                        quantity="costs") -> TimePeriodSolution:
+        """
+        findEquilibrium for one time period, starting from startState, with the networks starting from initialStates
+        (as given by CollectedNetworkStateData.getFinalStates) rather than from whatever period was solved before.
+        The returned matrix is the user cost matrix, or the summed characteristics if quantity is "characteristics".
+        """
+        self.__enterTimePeriod(timePeriod)
+        startState.applyTo(self.demand, self.microtypes)
+        self.microtypes.importInitialStates(initialStates)
+        self.microtypes.updateNetworkData()
+        self.findEquilibrium()
+        durationInHours = self.__timePeriods[timePeriod]
+        if quantity == "characteristics":
+            matrix = self.getMatrixSummedCharacteristics() * durationInHours
+        else:
+            matrix = self.getMatrixUserCosts() * durationInHours
+        return TimePeriodSolution(timePeriod, EquilibriumState.fromModel(self.demand, self.microtypes), matrix,
+                                  self.getOperatorCosts() * durationInHours, self.residuals[timePeriod],
+                                  self.converged[timePeriod])
+
+    def __solveAllInPipeline(self, quantity):
+        """
+        Jacobi sweeps over the time periods. Every period is solved at once, each assuming the final state its
+        predecessor had after the last evaluation (or an empty network if there wasn't one). Periods whose
+        predecessor then ends somewhere else, beyond timePeriodPipeline.tolerance, are solved again from the same
+        start with the new initial state, until none are left. The first period never needs to be, so there are at
+        most as many sweeps as time periods.
+        """
+        pipeline = self.timePeriodPipeline
+        timePeriods = [timePeriod for timePeriod, _ in self.__timePeriods]
+        initialStates = {timePeriods[0]: dict()}
+        for previous, timePeriod in zip(timePeriods[:-1], timePeriods[1:]):
+            if previous in self.__networkStateData:
+                initialStates[timePeriod] = self.__networkStateData[previous].getFinalStates()
+            else:
+                initialStates[timePeriod] = dict()
+        self.setTimePeriod(timePeriods[0], True)
+        startStates = {timePeriod: EquilibriumState.fromModel(self.__demand[timePeriod],
+                                                              self.__microtypes[timePeriod])
+                       for timePeriod in timePeriods}
+        solutions = dict()
+        toSolve = timePeriods
+        while len(toSolve) > 0:
+            tasks = [(timePeriod, initialStates[timePeriod], startStates[timePeriod], quantity) for timePeriod in
+                     toSolve]
+            for solution in pipeline.map(self, tasks):
+                solutions[solution.timePeriod] = solution
+            toSolve = []
+            for previous, timePeriod in zip(timePeriods[:-1], timePeriods[1:]):
+                finalStates = solutions[previous].finalStates
+                if handOffDifference(initialStates[timePeriod], finalStates) > pipeline.tolerance:
+                    initialStates[timePeriod] = finalStates
+                    toSolve.append(timePeriod)
+
+        # Periods solved from an assumed state within tolerance still need the actual time their predecessor ended at
+        out = []
+        finalStates = dict()
+        for timePeriod in timePeriods:
+            solution = solutions[timePeriod]
+            self.__enterTimePeriod(timePeriod)
+            solution.equilibriumState.applyTo(self.demand, self.microtypes)
+            self.microtypes.importInitialStates(initialStates[timePeriod])
+            self.microtypes.collectedNetworkStateData.alignTimes(finalStates)
+            self.residuals[timePeriod] = solution.residuals
+            self.converged[timePeriod] = solution.converged
+            self.__networkStateData[timePeriod] = self.microtypes.getStateData()
+            finalStates = self.__networkStateData[timePeriod].getFinalStates()
+            print(self.getModeSplit(self.__currentTimePeriod))
+            print(self.getModeSpeeds())
+            out.append(solution)
+        return out
+
     def collectAllCosts(self):
+        if self.timePeriodPipeline is not None:
+            operatorCosts = CollectedTotalOperatorCosts()
+            vectorUserCosts = 0.0
+            for solution in self.__solveAllInPipeline("costs"):
+                vectorUserCosts += solution.matrix
+                operatorCosts += solution.operatorCosts
+            return CollectedTotalUserCosts(), operatorCosts, vectorUserCosts
         userCosts = CollectedTotalUserCosts()
         operatorCosts = CollectedTotalOperatorCosts()
         vectorUserCosts = 0.0
@@ -612,6 +933,8 @@ class Model:
         return userCosts, operatorCosts, vectorUserCosts
 
     def collectAllCharacteristics(self):
+        if self.timePeriodPipeline is not None:
+            return sum(solution.matrix for solution in self.__solveAllInPipeline("characteristics"))
         vectorUserCosts = 0.0
         init = True
         for timePeriod, durationInHours in self.__timePeriods:
@@ -631,6 +954,41 @@ class Model:
             timePeriod = self.__currentTimePeriod
         return pd.DataFrame(self.__microtypes[timePeriod].getModeSpeeds())
 
+    def evaluateScenario(self, networkModification=None, scheduleModification=None):
+        self.resetNetworks()
+        self.modifyNetworks(networkModification, scheduleModification)
+        self.resetEquilibrium()
+        userCosts, operatorCosts, vectorUserCosts = self.collectAllCosts()
+        return vectorUserCosts, operatorCosts, self.getModeSplit()
+
+    def scoreScenario(self, networkModification=None, scheduleModification=None, warmStart=False) -> (float, float):
+        """
+        Total user cost (the sum of vectorUserCosts) and total operator cost of a scenario, applied to the base
+        network. With warmStart the equilibrium starts from the one stored by the previous warm started call rather
+        than the default mode split.
+        """
+        self.resetNetworks()
+        self.modifyNetworks(networkModification, scheduleModification)
+        if warmStart:
+            self.restoreEquilibrium()
+        else:
+            self.resetEquilibrium()
+        userCosts, operatorCosts, vectorUserCosts = self.collectAllCosts()
+        if warmStart:
+            self.saveEquilibrium()
+        return np.nansum(vectorUserCosts), operatorCosts.total
+
+    def evaluateMany(self, modifications, nWorkers=None):
+        """
+        Evaluates each (networkModification, scheduleModification) pair and returns a list of
+        (vectorUserCosts, operatorCosts, modeSplit). With nWorkers=1 they run in this model, otherwise in a
+        ScenarioBatch of nWorkers processes (default: one per core).
+        """
+        if nWorkers == 1:
+            return [self.evaluateScenario(*modification) for modification in modifications]
+        with ScenarioBatch(self.__path, nWorkers, self.__cacheDirectory) as batch:
+            return batch.evaluate(modifications)
+
     def plotAllDynamicStats(self, type):
         ts = []
         vs = []
@@ -677,6 +1035,144 @@ class Model:
         print('AA')
 
 
+class ScenarioBatch:
+    """
+    A pool of worker processes that each build the Model for path (and cacheDirectory) once, and then evaluate
+    scenarios sent to them.
+
+    ...
+
+    Methods
+    -------
+    evaluate(modifications):
+        Evaluates a list of (networkModification, scheduleModification) pairs, returning a list of
+        (vectorUserCosts, operatorCosts, modeSplit) in the same order
+    score(modifications, warmStart):
+        Like evaluate, but with Model.scoreScenario, so each worker only sends back the two cost totals
+    close():
+        Shuts down the worker processes
+    """
+
+    def __init__(self, path: str, nWorkers=None, cacheDirectory=None):
+        if nWorkers is None:
+            nWorkers = os.cpu_count()
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        else:
+            context = multiprocessing.get_context()
+        self.nWorkers = nWorkers
+        self.__pool = context.Pool(nWorkers, initializer=_initializeWorker, initargs=(path, cacheDirectory))
+
+    def evaluate(self, modifications) -> list:
+        return self.__pool.map(_evaluateInWorker, modifications, chunksize=1)
+
+    def score(self, modifications, warmStart=False) -> list:
+        return self.__pool.map(_scoreInWorker, [(modification, warmStart) for modification in modifications],
+                               chunksize=1)
+
+    def close(self):
+        self.__pool.close()
+        self.__pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class TimePeriodPipeline:
+    """
+    Lets Model.collectAllCosts and collectAllCharacteristics solve all time periods at the same time, each in a
+    worker process that builds the Model for path once, rather than one after the other. Set it as the
+    timePeriodPipeline of a model of the same path.
+
+    A time period only depends on the one before it through the accumulation its networks start from, so every
+    period is first solved assuming the final state from the model's last evaluation, and periods are then solved
+    again only while the state they were handed differs from the one their predecessor actually ended in by more
+    than tolerance (relative). Wall time goes toward that of the slowest period times the number of sweeps.
+
+    With nWorkers=1 the periods are solved one after the other in the model itself, with the same hand-off.
+
+    ...
+
+    Attributes
+    ----------
+    tolerance : float
+        Largest relative difference in initial accumulation that doesn't require solving a period again
+    sweeps : int
+        Number of rounds of time periods solved so far
+    solves : int
+        Number of time periods solved so far
+
+    Methods
+    -------
+    map(model, tasks):
+        Calls model.solveTimePeriod with each tuple of arguments, returning the TimePeriodSolutions in order
+    close():
+        Shuts down the worker processes
+    """
+
+    def __init__(self, path: str, nWorkers=None, tolerance=1e-3, cacheDirectory=None):
+        if nWorkers is None:
+            nWorkers = os.cpu_count()
+        self.nWorkers = nWorkers
+        self.tolerance = tolerance
+        self.sweeps = 0
+        self.solves = 0
+        if nWorkers == 1:
+            self.__pool = None
+        else:
+            if "fork" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("fork")
+            else:
+                context = multiprocessing.get_context()
+            self.__pool = context.Pool(nWorkers, initializer=_initializeWorker, initargs=(path, cacheDirectory))
+
+    def map(self, model, tasks) -> list:
+        self.sweeps += 1
+        self.solves += len(tasks)
+        if self.__pool is None:
+            return [model.solveTimePeriod(*task) for task in tasks]
+        changes = model.getScenarioChanges()
+        return self.__pool.map(_solveTimePeriodInWorker, [(changes, task) for task in tasks], chunksize=1)
+
+    def close(self):
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+_workerModel = None
+
+
+def _initializeWorker(path: str, cacheDirectory=None):
+    global _workerModel
+    _workerModel = Model(path, cacheDirectory)
+
+
+def _evaluateInWorker(modification):
+    networkModification, scheduleModification = modification
+    return _workerModel.evaluateScenario(networkModification, scheduleModification)
+
+
+def _scoreInWorker(modificationAndWarmStart):
+    (networkModification, scheduleModification), warmStart = modificationAndWarmStart
+    return _workerModel.scoreScenario(networkModification, scheduleModification, warmStart)
+
+
+def _solveTimePeriodInWorker(changesAndTask):
+    changes, task = changesAndTask
+    _workerModel.setScenarioChanges(changes)
+    return _workerModel.solveTimePeriod(*task)
+
+
 if __name__ == "__main__":
     model = Model("input-data-geotype-A")
     userCosts, operatorCosts, vectorUserCosts = model.collectAllCosts()
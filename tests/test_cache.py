@@ -0,0 +1,96 @@
+import os
+import shutil
+
+import pytest
+
+from model import Model, ScenarioData
+import utils.cache
+from utils.cache import ScenarioCache
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture
+def inputs(tmp_path) -> str:
+    path = str(tmp_path / "input-data")
+    shutil.copytree(ROOT_DIR + "/../input-data", path, ignore=shutil.ignore_patterns("__cache__"))
+    return path
+
+
+@pytest.fixture
+def cacheDirectory(tmp_path) -> str:
+    return str(tmp_path / "cache")
+
+
+def editSubNetworkLength(inputs: str, length: str):
+    subNetworks = os.path.join(inputs, "SubNetworks.csv")
+    with open(subNetworks) as f:
+        lines = f.readlines()
+    header = lines[0].strip().split(",")
+    row = lines[1].strip().split(",")
+    row[header.index("Length")] = length
+    lines[1] = ",".join(row) + "\n"
+    with open(subNetworks, "w") as f:
+        f.writelines(lines)
+
+
+def test_cache_is_off_by_default(inputs):
+    assert ScenarioData(inputs).cache is None
+    assert sorted(os.listdir(inputs)) == sorted(f for f in os.listdir(ROOT_DIR + "/../input-data") if f != "__cache__")
+
+
+def test_cache_hit(inputs, cacheDirectory, capsys):
+    parsed = ScenarioData(inputs, cacheDirectory=cacheDirectory)
+    assert "from cache" not in capsys.readouterr().out
+    assert ScenarioCache(inputs, cacheDirectory).load("scenarioData") is not None
+    cached = ScenarioData(inputs, cacheDirectory=cacheDirectory)
+    assert "from cache" in capsys.readouterr().out
+    assert cached.odiToIdx == parsed.odiToIdx
+    assert cached["subNetworkData"].equals(parsed["subNetworkData"])
+
+
+def test_cache_invalidated_by_input_change(inputs, cacheDirectory, capsys):
+    ScenarioData(inputs, cacheDirectory=cacheDirectory)
+    old = ScenarioCache(inputs, cacheDirectory)
+    editSubNetworkLength(inputs, "12345")
+    capsys.readouterr()
+    new = ScenarioCache(inputs, cacheDirectory)
+    assert new.key != old.key
+    edited = ScenarioData(inputs, cacheDirectory=cacheDirectory)
+    assert "from cache" not in capsys.readouterr().out
+    assert edited["subNetworkData"].iat[0, edited["subNetworkData"].columns.get_loc("Length")] == 12345
+    # Only the snapshot of the edited inputs is kept
+    assert os.listdir(new.inputDirectory) == [new.key]
+    assert old.load("scenarioData") is None
+
+
+def test_cache_invalidated_by_code_change(inputs, cacheDirectory, monkeypatch):
+    key = ScenarioCache(inputs, cacheDirectory).key
+    monkeypatch.setattr(utils.cache, "codeHash", lambda: "edited parser")
+    assert ScenarioCache(inputs, cacheDirectory).key != key
+
+
+def test_cache_inside_inputs_does_not_change_key(inputs):
+    cacheDirectory = os.path.join(inputs, "__cache__")
+    key = ScenarioCache(inputs, cacheDirectory).key
+    ScenarioData(inputs, cacheDirectory=cacheDirectory)
+    assert ScenarioCache(inputs, cacheDirectory).key == key
+
+
+def test_inputs_sharing_a_cache_keep_their_own_snapshots(inputs, cacheDirectory, tmp_path):
+    other = str(tmp_path / "other-input-data")
+    shutil.copytree(inputs, other)
+    editSubNetworkLength(other, "12345")
+    ScenarioData(inputs, cacheDirectory=cacheDirectory)
+    ScenarioData(other, cacheDirectory=cacheDirectory)
+    assert ScenarioCache(inputs, cacheDirectory).load("scenarioData") is not None
+    assert ScenarioCache(other, cacheDirectory).load("scenarioData") is not None
+
+
+def test_unwritable_cache_falls_back_to_parsing(inputs, cacheDirectory):
+    # A file where the cache directory should go makes os.makedirs fail, even when running as root
+    with open(cacheDirectory, "w") as f:
+        f.write("")
+    model = Model(inputs, cacheDirectory)
+    assert model.scenarioData.cache.load("scenarioData") is None
+    assert len(model.scenarioData.odiToIdx) > 0
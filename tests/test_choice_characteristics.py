@@ -0,0 +1,100 @@
+import os
+
+import numpy as np
+import pytest
+
+from model import Model
+from utils.choiceCharacteristics import ChoiceCharacteristics, speedToTravelTime
+from utils.demand import pairModeSplitCalc
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(scope="module")
+def model() -> Model:
+    a = Model(ROOT_DIR + "/../input-data")
+    a.initializeTimePeriod(1)
+    a.demand.updateMFD(a.microtypes)
+    a.choice.updateChoiceCharacteristics(a.microtypes, a._Model__trips)
+    return a
+
+
+def commonModes(model: Model, odi) -> set:
+    return set(model.microtypes[odi.o].mode_names) & set(model.microtypes[odi.d].mode_names)
+
+
+def test_mode_availability(model):
+    trips = model._Model__trips
+    modeAvailability = model.choice.modeAvailability
+    missing = [odi for odi in model.odiToIdx if odi not in trips]
+    assert len(missing) > 0
+    assert not np.all(modeAvailability)
+    for odi, idx in model.odiToIdx.items():
+        if odi in trips:
+            expected = [mode in commonModes(model, odi) for mode in model.modeToIdx]
+        else:
+            # ODIs without an entry in the microtype assignment keep every mode
+            expected = [True] * len(model.modeToIdx)
+        np.testing.assert_array_equal(modeAvailability[idx, :], expected, err_msg=str(odi))
+
+
+def test_start_and_end_costs_match_per_trip_loop(model):
+    """ The per-microtype scatter against adding start and end costs trip by trip, as it used to be done """
+    choice, microtypes = model.choice, model.microtypes
+    expected = np.zeros_like(choice.numpy)
+    expected[:, :, choice.paramToIdx['intercept']] = 1
+    for odi, trip in model._Model__trips:
+        if odi.o == 'None' or odi.d == 'None':
+            continue
+        for mode in commonModes(model, odi):
+            characteristics = ChoiceCharacteristics(data=expected[model.odiToIdx[odi], model.modeToIdx[mode], :])
+            microtypes[odi.o].addStartTimeCostWait(mode, characteristics)
+            microtypes[odi.d].addEndTimeCostWait(mode, characteristics)
+    expected[:, :, choice.paramToIdx['travel_time']] = speedToTravelTime(microtypes.numpySpeed,
+                                                                          model.demand.throughDistance)
+    assert np.any(expected[:, :, choice.paramToIdx['wait_time']] > 0)
+    # Unavailable modes pick up start and end costs too, but they never enter the mode split or the cost totals
+    available = choice.modeAvailability
+    np.testing.assert_allclose(choice.numpy[available], expected[available], rtol=1e-12, atol=1e-15)
+
+
+def perTripModeSplit(model: Model, pairs: list) -> np.ndarray:
+    popVars, choiceChars = model._Model__population.numpy, model.choice.numpy
+    modeSplit = np.zeros((len(pairs), len(model.modeToIdx)))
+    for pair, (di, odi) in enumerate(pairs):
+        available = [model.modeToIdx[mode] for mode in model.modeToIdx if model.choice.modeAvailability[
+            model.odiToIdx[odi], model.modeToIdx[mode]]]
+        utilities = [np.sum(popVars[model.diToIdx[di], m, :] * choiceChars[model.odiToIdx[odi], m, :]) for m in
+                     available]
+        expUtilities = np.exp(np.array(utilities) - np.max(utilities))
+        modeSplit[pair, available] = expUtilities / np.sum(expUtilities)
+    return modeSplit
+
+
+def test_pair_mode_split_matches_per_trip_loop(model):
+    # Every (demand index, ODI) pair, including the ODIs missing from the microtype assignment and the pairs that have
+    # no trips
+    pairs = [(di, odi) for di in model.diToIdx for odi in model.odiToIdx]
+    diIdx = np.array([model.diToIdx[di] for di, _ in pairs])
+    odiIdx = np.array([model.odiToIdx[odi] for _, odi in pairs])
+    with np.errstate(divide="raise", invalid="raise"):
+        modeSplit = pairModeSplitCalc(model._Model__population.numpy, model.choice.numpy, diIdx, odiIdx,
+                                      model.choice.modeAvailability)
+    np.testing.assert_allclose(modeSplit, perTripModeSplit(model, pairs), rtol=1e-12, atol=1e-15)
+
+
+@pytest.mark.parametrize("chunkSize", [None, 1])
+def test_update_mode_split_matches_per_trip_loop(model, chunkSize):
+    demand = model.demand
+    demand.chunkSize = chunkSize
+    demand.resetModeSplit()
+    old = demand.modeSplitData.copy()
+    pairs = [(di, odi) for di, odi in demand.keys() if (di, odi) in demand]
+    assert len(pairs) == demand.nActivePairs
+    assert any(not np.all(model.choice.modeAvailability[model.odiToIdx[odi], :]) for _, odi in pairs)
+    demand.updateModeSplit(model.choice, None, model.getModeSplit(1))
+    expected = old.copy()
+    for (di, odi), modeSplit in zip(pairs, perTripModeSplit(model, pairs)):
+        i, j = model.diToIdx[di], model.odiToIdx[odi]
+        expected[i, j, :] = 0.85 * modeSplit + 0.15 * old[i, j, :]
+    np.testing.assert_allclose(demand.modeSplitData, expected, rtol=1e-12, atol=1e-15)
@@ -0,0 +1,90 @@
+import os
+
+import numpy as np
+import pytest
+
+from model import Model
+from utils.demand import pairModeSplitCalc
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_mode_split_is_zero_where_no_mode_is_available():
+    rng = np.random.default_rng(0)
+    popVars = rng.normal(size=(3, 4, 6))
+    choiceChars = rng.normal(size=(4, 4, 6)) * 100.
+    modeAvailability = rng.random((4, 4)) > 0.3
+    modeAvailability[1, :] = False
+    diIdx, odiIdx = (idx.ravel() for idx in np.meshgrid(np.arange(3), np.arange(4), indexing="ij"))
+    logsum = np.zeros(len(diIdx))
+    # The model silences numpy floating point warnings globally, so make them errors here
+    with np.errstate(divide="raise", invalid="raise"):
+        modeSplit = pairModeSplitCalc(popVars, choiceChars, diIdx, odiIdx, modeAvailability, logsum=logsum)
+
+    for pair, (di, odi) in enumerate(zip(diIdx, odiIdx)):
+        available = modeAvailability[odi, :]
+        if not np.any(available):
+            np.testing.assert_array_equal(modeSplit[pair, :], 0.0)
+            assert np.isnan(logsum[pair])
+            continue
+        utilities = np.sum(popVars[di, :, :] * choiceChars[odi, :, :], axis=-1)[available]
+        # Large utilities, so the reference subtracts the largest one too
+        expUtilities = np.exp(utilities - np.max(utilities))
+        np.testing.assert_allclose(modeSplit[pair, available], expUtilities / np.sum(expUtilities), rtol=1e-12,
+                                   atol=1e-300)
+        np.testing.assert_array_equal(modeSplit[pair, ~available], 0.0)
+        assert logsum[pair] == pytest.approx(np.log(np.sum(expUtilities)) + np.max(utilities), rel=1e-12)
+
+
+def denseUpdateMFD(model: Model) -> (np.ndarray, np.ndarray):
+    """ Demand.updateMFD's (microtype, mode, data) demand and transition matrix weights, from dense einsums """
+    demand = model.demand
+    trips, distanceBins = model._Model__trips, model._Model__distanceBins
+    shape = (len(demand.diToIdx), len(demand.odiToIdx), len(demand.microtypeIdToIdx))
+    tripRate = np.zeros(shape[:2])
+    toStarts, toEnds, toThroughDistance, toThroughCounts = (np.zeros(shape) for _ in range(4))
+    for di, odi in demand.keys():
+        if (di, odi) not in demand:
+            continue
+        i, j = demand.diToIdx[di], demand.odiToIdx[odi]
+        tripRate[i, j] = demand[di, odi].demandForTripsPerHour
+        toStarts[i, j, demand.microtypeIdToIdx[odi.o]] = 1.0
+        toEnds[i, j, demand.microtypeIdToIdx[odi.d]] = 1.0
+        for mID, pct in trips[odi].allocation:
+            toThroughDistance[i, j, demand.microtypeIdToIdx[mID]] = pct * distanceBins[odi.distBin]
+            toThroughCounts[i, j, demand.microtypeIdToIdx[mID]] = 1.0
+    startsByMode = np.einsum('...,...i->...i', tripRate, demand.modeSplitData)
+    newData = np.stack([np.einsum('ijk,ijl->lk', startsByMode, assignment) for assignment in
+                        [toStarts, toEnds, toThroughCounts, toThroughDistance]], axis=-1)
+    weights = np.sum(startsByMode[:, :, demand.modeToIdx["auto"]], axis=0)
+    return newData, weights
+
+
+@pytest.mark.parametrize("chunkSize", [None, 1])
+def test_pair_update_mfd_matches_dense_einsum(chunkSize, monkeypatch):
+    model = Model(ROOT_DIR + "/../input-data-simpler")
+    model.initializeTimePeriod(1)
+    demand, microtypes = model.demand, model.microtypes
+    demand.chunkSize = chunkSize
+    modeSplit = np.random.default_rng(0).random(demand.modeSplitData.shape)
+    demand.updateModeSplitData(modeSplit / np.sum(modeSplit, axis=-1, keepdims=True))
+    expectedData, expectedWeights = denseUpdateMFD(model)
+    assert np.any(expectedData[:, :, 3] > 0)
+
+    captured = dict()
+    transitionMatrices = model._Model__transitionMatrices
+    updateNumpyDemand, averageMatrix = microtypes.updateNumpyDemand, transitionMatrices.averageMatrix
+
+    def captureData(data):
+        captured["data"] = data.copy()
+        updateNumpyDemand(data)
+
+    def captureWeights(weights):
+        captured.setdefault("weights", weights.copy())
+        return averageMatrix(weights)
+
+    monkeypatch.setattr(microtypes, "updateNumpyDemand", captureData)
+    monkeypatch.setattr(transitionMatrices, "averageMatrix", captureWeights)
+    demand.updateMFD(microtypes)
+    np.testing.assert_allclose(captured["data"], expectedData, rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(captured["weights"], expectedWeights, rtol=1e-12, atol=1e-12)
@@ -0,0 +1,102 @@
+import os
+
+import numpy as np
+import pytest
+
+from model import Model
+from utils.equilibrium import FixedPointSolver, AndersonSolver, AdaptiveDampingSolver
+
+
+@pytest.fixture(scope="module")
+def model() -> Model:
+    ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+    a = Model(ROOT_DIR + "/../input-data")
+    a.initializeTimePeriod(1)
+    return a
+
+
+def solve(model: Model, solver) -> np.ndarray:
+    model.resetEquilibrium()
+    model.equilibriumSolver = solver
+    model.findEquilibrium()
+    assert model.converged[1]
+    return model.demand.modeSplitData.copy()
+
+
+@pytest.mark.parametrize("solverClass", [AndersonSolver, AdaptiveDampingSolver])
+def test_solver_reaches_fixed_point_equilibrium(model, solverClass):
+    reference = solve(model, FixedPointSolver(tolerance=1e-9, maxIterations=200))
+    modeSplit = solve(model, solverClass(tolerance=1e-9, maxIterations=200))
+    np.testing.assert_allclose(modeSplit, reference, rtol=0, atol=1e-7)
+
+
+def snapshot(model: Model) -> dict:
+    microtypes = model.microtypes
+    state = {"modeSplit": model.demand.modeSplitData.copy(), "speed": microtypes.numpySpeed.copy()}
+    for name in ["VMT", "N_eff", "L_blocked", "speed"]:
+        state["networkModeData." + name] = getattr(microtypes.networkModeData, name).copy()
+    for microtypeID, microtype in microtypes:
+        for modes, network in microtype.networks:
+            state[("base_speed", microtypeID, modes)] = network.base_speed
+            state[("isJammed", microtypeID, modes)] = network.isJammed
+    for key, networkStateData in microtypes.collectedNetworkStateData:
+        for name in ["finalAccumulation", "finalSpeed", "blockedDistance", "nonAutoAccumulation"]:
+            state[(name,) + key] = getattr(networkStateData, name)
+        for name in ["inflow", "outflow", "v", "n", "t"]:
+            state[(name,) + key] = getattr(networkStateData, name).copy()
+    return state
+
+
+def assertSameState(state: dict, other: dict):
+    assert state.keys() == other.keys()
+    for key in state:
+        np.testing.assert_array_equal(state[key], other[key], err_msg=str(key))
+
+
+def test_restore_round_trip(model):
+    solve(model, FixedPointSolver(tolerance=1e-9, maxIterations=200))
+    model.warmStart.reset()
+    model.saveEquilibrium()
+    saved = snapshot(model)
+    # The snapshot must not share arrays with the live state
+    for _, networkStateData in model.microtypes.collectedNetworkStateData:
+        networkStateData.n += 1.0
+    model.microtypes.networkModeData.VMT *= 2.0
+    model.resetEquilibrium()
+    model.equilibriumSolver = FixedPointSolver(maxIterations=1)
+    model.findEquilibrium()
+    assert not np.array_equal(model.demand.modeSplitData, saved["modeSplit"])
+    model.restoreEquilibrium()
+    assertSameState(saved, snapshot(model))
+
+
+def test_warm_start_converges_in_fewer_iterations(model):
+    model.warmStart.reset()
+    model.resetEquilibrium()
+    model.equilibriumSolver = FixedPointSolver()
+    cold = model.findEquilibrium()
+    assert model.converged[1]
+    model.saveEquilibrium()
+    model.resetEquilibrium()
+    model.restoreEquilibrium()
+    warm = model.findEquilibrium()
+    assert model.converged[1]
+    assert warm < cold
+    assert model.warmStart.iterationsSaved == cold - warm
+
+
+@pytest.mark.parametrize("solverClass", [FixedPointSolver, AndersonSolver, AdaptiveDampingSolver])
+def test_update_writes_result_into_out(solverClass):
+    rng = np.random.default_rng(0)
+    x = rng.random((6, 4))
+    x /= np.sum(x, axis=-1, keepdims=True)
+    # Negative entries make the Anderson step go through the projection
+    gx = rng.random((6, 4)) - 0.2
+    gx[0, :] = [1.5, -0.5, 0.0, 0.0]
+    reference, inPlace = solverClass(), solverClass()
+    expected = [reference.update(x, gx), reference.update(gx, x)]
+    for (a, b), result in zip([(x, gx), (gx, x)], expected):
+        out = np.empty_like(a)
+        returned = inPlace.update(a, b, out=out)
+        np.testing.assert_allclose(out, returned, rtol=0, atol=0)
+        np.testing.assert_allclose(out, result, rtol=1e-12, atol=1e-15)
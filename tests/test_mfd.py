@@ -0,0 +1,133 @@
+import logging
+
+import numpy as np
+import pytest
+
+from utils.mfd import MFDTimeStepper, njit, spillback
+
+
+def legacyTimeSteps(n_init, X, characteristicL, V_0, N_0, n_other, tripStartRate, dt, nSteps):
+    """ The time stepping loop MicrotypeCollection.transitionMatrixMFD used before MFDTimeStepper """
+    def v(n, v_0, n_0, n_other, minspeed=0.005) -> np.ndarray:
+        n_eff = n + n_other
+        v = v_0 * (1. - n_eff / n_0)
+        v[v < minspeed] = minspeed
+        v[v > v_0] = v_0[v > v_0]
+        return v
+
+    def tripEndingRate(n, X, L, v_0, n_0, n_other) -> np.ndarray:
+        return (1 - np.sum(X, axis=0)) * v(n, v_0, n_0, n_other, 0.005) * n / L
+
+    def outflow(n, L, v_0, n_0, n_other) -> np.ndarray:
+        return v(n, v_0, n_0, n_other, 0.005) * n / L
+
+    def inflow(n, X, L, v_0, n_0, n_other) -> np.ndarray:
+        os = X @ (v(n, v_0, n_0, n_other, 0.005) * n / L)
+        return os
+
+    def spillback(n, N_0, demand, inflow, outflow, dt, n_other=0.0, criticalDensity=0.9) -> np.ndarray:
+        requestedN = (demand + inflow - outflow) * dt + n
+        criticalN = criticalDensity * (N_0 - n_other)
+        overLimit = requestedN > criticalN
+        counter = 0
+        while np.any(overLimit):
+            if np.all(overLimit):
+                if counter == 0:
+                    vals = np.linspace(criticalDensity, 1.0, 5)
+                if counter <= 1:
+                    criticalDensity = vals[counter]
+                    criticalN = criticalDensity * (N_0 - n_other)
+                    counter += 1
+                else:
+                    return criticalN
+            totalSpillback = np.sum(requestedN[overLimit] - criticalN[overLimit])
+            toBeLimited = inflow[~overLimit]
+            requestedN[~overLimit] += inflow[~overLimit] * totalSpillback / np.sum(toBeLimited)
+            requestedN[overLimit] = criticalN[overLimit]
+            overLimit = (requestedN / N_0) > criticalN
+        return requestedN
+
+    ns = np.zeros((len(n_init), nSteps), dtype=float)
+    vs = np.zeros((len(n_init), nSteps), dtype=float)
+    inflows = np.zeros((len(n_init), nSteps), dtype=float)
+    outflows = np.zeros((len(n_init), nSteps), dtype=float)
+    n_t = n_init.copy()
+    for i in range(nSteps):
+        infl = inflow(n_t, X, characteristicL, V_0, N_0, n_other)
+        outfl = outflow(n_t, characteristicL, V_0, N_0, n_other)
+        n_t = spillback(n_t, N_0, tripStartRate, infl, outfl, dt, n_other, 1.0)
+        ends = tripEndingRate(n_t, X, characteristicL, V_0, N_0, n_other)
+        n_t[n_t < 0] = 0.0
+        ns[:, i] = n_t
+        vs[:, i] = v(n_t, V_0, N_0, n_other)
+        inflows[:, i] = tripStartRate * dt
+        outflows[:, i] = ends * dt
+    return ns, vs, inflows, outflows
+
+
+def syntheticRegion(nMicrotypes, congestion=1.0, seed=0):
+    rng = np.random.default_rng(seed)
+    matrix = rng.random((nMicrotypes, nMicrotypes)) * (rng.random((nMicrotypes, nMicrotypes)) > 0.7)
+    matrix /= matrix.sum(axis=1, keepdims=True) * 1.25
+    X = np.transpose(matrix)
+    L = rng.uniform(500., 3000., nMicrotypes)
+    V_0 = np.full(nMicrotypes, 16.0)
+    N_0 = rng.uniform(1e5, 1e6, nMicrotypes) * 0.145
+    n_other = N_0 * rng.uniform(0.0, 0.05, nMicrotypes)
+    n_init = N_0 * rng.uniform(0.0, 0.3, nMicrotypes)
+    tripStartRate = congestion * N_0 * V_0 / L / 12.0
+    return n_init, X, L, V_0, N_0, n_other, tripStartRate
+
+
+@pytest.mark.parametrize("congestion", [0.05, 0.5, 2.0])
+def test_euler_matches_legacy_loop(congestion):
+    region = syntheticRegion(12, congestion)
+    reference = legacyTimeSteps(*region, 30.0, 120)
+    out = MFDTimeStepper(useNumba=False).run(*region, 30.0, 120)
+    for a, b in zip(out, reference):
+        np.testing.assert_array_equal(a, b)
+
+
+@pytest.mark.skipif(njit is None, reason="numba is not installed")
+@pytest.mark.parametrize("congestion", [0.05, 0.5, 2.0])
+def test_numba_euler_matches_legacy_loop(congestion):
+    region = syntheticRegion(12, congestion)
+    reference = legacyTimeSteps(*region, 30.0, 120)
+    out = MFDTimeStepper(useNumba=True).run(*region, 30.0, 120)
+    for a, b in zip(out, reference):
+        np.testing.assert_allclose(a, b, rtol=1e-9, atol=1e-6)
+
+
+def test_spillback_logs_when_every_microtype_is_jammed(caplog):
+    N_0 = np.full(3, 0.5)
+    with caplog.at_level(logging.ERROR, logger="utils.mfd"):
+        capped = spillback(np.full(3, 2.0), N_0, np.ones(3), 0.0, 1.0)
+    np.testing.assert_array_equal(capped, N_0)
+    assert "jam density" in caplog.text
+
+
+def accumulationError(out, reference, N_0):
+    return np.max(np.abs(out - reference) / N_0[:, None])
+
+
+def test_adaptive_integrators_match_tight_reference():
+    region = syntheticRegion(12, 0.05)
+    N_0 = region[4]
+    reference = MFDTimeStepper(integrator="RK45", rtol=1e-10, atol=1e-6).run(*region, 30.0, 120)[0]
+    for integrator in ["RK45", "LSODA"]:
+        stepper = MFDTimeStepper(integrator=integrator)
+        ns, vs, inflows, outflows = stepper.run(*region, 30.0, 120)
+        assert accumulationError(ns, reference, N_0) < 0.01
+        assert stepper.nfev > 0
+        assert np.all(ns >= 0.0) and np.all(ns <= (N_0 - region[5])[:, None])
+
+
+def test_semi_implicit_is_first_order():
+    region = syntheticRegion(12, 0.05)
+    N_0 = region[4]
+    reference = MFDTimeStepper(integrator="RK45", rtol=1e-10, atol=1e-6).run(*region, 30.0, 120)[0]
+    stepper = MFDTimeStepper(integrator="semi-implicit")
+    coarse = accumulationError(stepper.run(*region, 30.0, 120)[0], reference, N_0)
+    fine = accumulationError(stepper.run(*region, 15.0, 240)[0][:, 1::2], reference, N_0)
+    assert coarse < 0.1
+    assert fine < 0.6 * coarse
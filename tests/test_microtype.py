@@ -0,0 +1,78 @@
+import os
+
+import numpy as np
+import pytest
+
+from model import Model, NetworkModification
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture
+def model() -> Model:
+    a = Model(ROOT_DIR + "/../input-data")
+    a.initializeTimePeriod(1)
+    return a
+
+
+def busNetworks(model: Model) -> list:
+    return [n for _, microtype in model.microtypes if "bus" in microtype.networks.modes
+            for n in microtype.networks.modes["bus"].networks]
+
+
+def test_bus_operating_length_follows_network_modification(model):
+    networks = busNetworks(model)
+    assert len(networks) > 0
+    model.modifyNetworks(NetworkModification(np.array([500.]), [(2, 10)]))
+    model.microtypes.updateNetworkData()
+    network = next(n for n in networks if n.subNetworkID == 10)
+    bus = model.microtypes[network.microtypeID].networks.modes["bus"]
+    assert bus.getOperatingL(network) == 500.
+
+
+def scalarBusSupply(bus, network) -> (float, float, float):
+    """ Operating length, bus speed and blocked distance of one subnetwork, as BusMode computed them one at a time """
+    dedicatedDistance = sum([n.L for n in bus.networks if n.dedicated])
+    totalDistance = sum([n.L for n in bus.networks])
+    if network.dedicated:
+        operatingL = network.L
+        perPassenger = bus.passengerWaitInSecDedicated
+    else:
+        operatingL = max(0, (bus.routeDistanceToNetworkDistance * totalDistance - dedicatedDistance) * (
+                network.L / (totalDistance - dedicatedDistance)))
+        perPassenger = bus.passengerWaitInSec
+    numberOfStopsInRoute = bus.getRouteLength() / bus.stopSpacingInMeters
+    passengersPerStop = bus.tripRatePerHour / numberOfStopsInRoute * bus.headwayInSec / 3600.
+    stoppedTime = (perPassenger * passengersPerStop + bus.minStopTimeInSec) * operatingL / bus.stopSpacingInMeters
+    speed = operatingL / (stoppedTime + operatingL / network.base_speed)
+    if np.isnan(speed):
+        speed = 0.1
+    meanTimePerStop = bus.minStopTimeInSec + bus.headwayInSec * perPassenger * bus.tripRatePerHour / (
+            numberOfStopsInRoute * 3600.0)
+    portionOfTimeStopped = min([meanTimePerStop * meanTimePerStop / bus.headwayInSec, 1.0])
+    blocked = portionOfTimeStopped * network.avgLinkLength * operatingL / bus.routeAveragedSpeed / bus.headwayInSec
+    return operatingL, speed, blocked
+
+
+def test_bus_kernels_match_bus_mode(model):
+    model.modifyNetworks(NetworkModification(np.array([500.]), [(2, 10)]))
+    model.microtypes.updateNetworkData()
+    model.findEquilibrium()
+    blocked = []
+    for _, microtype in model.microtypes:
+        if "bus" not in microtype.networks.modes:
+            continue
+        bus = microtype.networks.modes["bus"]
+        meters, seconds = 0.0, 0.0
+        for n in bus.networks:
+            expected = scalarBusSupply(bus, n)
+            np.testing.assert_allclose([bus.getOperatingL(n), bus.getSubNetworkSpeed(n),
+                                        bus.calculateBlockedDistance(n)], expected, rtol=1e-12)
+            blocked.append(expected[2])
+            if n.L > 0:
+                meters += expected[0]
+                seconds += expected[0] / expected[1]
+        np.testing.assert_allclose(bus.calculateBlockedDistances(), blocked[-len(bus.networks):], rtol=1e-12)
+        if seconds > 0:
+            assert bus.getSpeed() == pytest.approx(meters / seconds, rel=1e-12)
+    assert np.any(np.array(blocked) > 0)
@@ -4,8 +4,10 @@ import os
 from model import Model
 import matplotlib.pyplot as plt
 
-from utils.network import Network, AutoMode, BusMode
+from utils.network import Network, AutoMode, BusMode, NetworkModeData, accumulationEvolution, \
+    mph2mps
 import numpy as np
+from scipy.integrate import solve_ivp
 
 data = pd.DataFrame(
     {"SubnetworkID": 1, "MicrotypeID": "A", "ModesAllowed": "Auto-Bus", "Dedicated": False, "Length": 1000.0,
@@ -86,3 +88,68 @@ def test_mfd(model):
     # zi = interpolator(Xi, Yi)
     # plt.contourf(Xi, Yi, zi)
     # print("AH")
+
+
+def test_accumulation_matches_numerical_integration():
+    # Flows below capacity (N_0 V_0 / 4 = 720 veh m / s here), where the cosh / sinh branch applies
+    L_0, t = 10 * 1609.34, 3 * 3600.
+    N_0, V_0 = 0.16 * 1200., 15.
+    for Q, N_init in [(0.5, 0.), (50., 10.), (500., 20.), (700., 30.), (719., 40.)]:
+        speed, N_final, V_init, V_final, _ = accumulationEvolution(1300., 100., 0.16, 15., N_init, Q)
+        solution = solve_ivp(lambda _, N: (Q - V_0 * (1. - N / N_0) * N) / L_0, (0., t), [N_init], rtol=1e-10,
+                             atol=1e-10)
+        assert N_final == pytest.approx(solution.y[0, -1], rel=1e-6)
+        assert V_init == pytest.approx(V_0 * (1. - N_init / N_0))
+        assert speed == pytest.approx(max(0.1, (V_init + V_final) / 2.))
+
+
+class LinearSpeedNetwork:
+    """Stand-in for a road subnetwork whose speed changes linearly with the flow assigned to it"""
+
+    def __init__(self, row, networkModeData, emptySpeed, slope):
+        self.row = row
+        self.networkModeData = networkModeData
+        self.emptySpeed = emptySpeed
+        self.slope = slope
+        self.base_speed = emptySpeed
+
+    def addMode(self, mode):
+        return self
+
+    def NEF(self, Q=None, modeIgnored=None, overrideMatrix=False):
+        return max(0.1, self.emptySpeed + self.slope * Q)
+
+
+def autoModeOn(speeds) -> AutoMode:
+    networkModeData = NetworkModeData(len(speeds), {"auto": 0})
+    networks = [LinearSpeedNetwork(row, networkModeData, v, slope) for row, (v, slope) in enumerate(speeds)]
+    auto = AutoMode(networks, pd.DataFrame({"VehicleSize": [1.0]}, index=["A"]), "A")
+    auto._VMT_tot = 1000. / mph2mps
+    return auto
+
+
+def test_equal_speed_allocation_with_different_subnetworks():
+    # The last subnetwork is slower when empty than the others are at the common speed, so it gets nothing
+    auto = autoModeOn([(20., -0.01), (15., -0.005), (16., -0.02), (8., -0.01)])
+    allocation = auto.equalSpeedAllocation()
+    assert np.sum(allocation) == pytest.approx(1.0, abs=1e-12)
+    assert allocation[3] == 0.0
+    speeds = np.array([auto.getSpeedWithPortion(n, a) for n, a in zip(auto.networks, allocation)])
+    np.testing.assert_allclose(speeds[:3], speeds[0], rtol=1e-8)
+    assert speeds[0] == pytest.approx(96. / 7., rel=1e-8)
+    # 20 - 10 a_0 = 15 - 5 a_1 = 16 - 20 a_2 with a_0 + a_1 + a_2 = 1
+    np.testing.assert_allclose(allocation, [22. / 35., 9. / 35., 4. / 35., 0.], atol=1e-8)
+
+    auto.assignVmtToNetworks()
+    np.testing.assert_allclose(auto._VMT, allocation * auto._VMT_tot, rtol=1e-12)
+    np.testing.assert_allclose(auto._speed[:3], speeds[:3], rtol=1e-12)
+
+
+def test_equal_speed_allocation_falls_back_to_slsqp():
+    # Speed on the first subnetwork rises with flow, so the bracketing search does not apply
+    auto = autoModeOn([(10., 0.005), (25., -0.02)])
+    assert auto.equalSpeedAllocation() is None
+    auto.assignVmtToNetworks()
+    # 10 + 5 a = 25 - 20 (1 - a) at a = 1 / 3
+    np.testing.assert_allclose(auto._VMT / auto._VMT_tot, [1. / 3., 2. / 3.], atol=1e-4)
+    np.testing.assert_allclose(auto._speed, 35. / 3., atol=1e-3)
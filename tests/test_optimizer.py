@@ -0,0 +1,59 @@
+import os
+
+import numpy as np
+import pytest
+
+from model import Optimizer
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+fromToSubNetworkIDs = [(2, 10)]
+modesAndMicrotypes = [("A", "bus")]
+X = np.array([[100., 300.], [800., 600.], [400., 180.]])
+
+
+@pytest.mark.parametrize("warmStart", [False, True])
+def test_batch_scores_do_not_depend_on_worker_count(warmStart):
+    scores = []
+    for nWorkers in [1, 2]:
+        optimizer = Optimizer(ROOT_DIR + "/../input-data", fromToSubNetworkIDs, modesAndMicrotypes,
+                              method="differential_evolution", warmStart=warmStart, nWorkers=nWorkers)
+        try:
+            scores.append(optimizer.evaluateBatch(X))
+        finally:
+            optimizer.close()
+    assert np.all(np.isfinite(scores[0]))
+    np.testing.assert_allclose(scores[1], scores[0], rtol=1e-6)
+
+
+@pytest.fixture(scope="module")
+def quadratic():
+    """ An optimizer whose batch objective is a quadratic with its minimum at (400, 900), so no model is solved """
+    minimum = np.array([400., 900.])
+
+    def evaluateBatch(X):
+        X = np.atleast_2d(X)
+        assert X.shape[1] == len(minimum)
+        return np.sum(((X - minimum) / 100.) ** 2, axis=1)
+
+    def build(method):
+        optimizer = Optimizer(ROOT_DIR + "/../input-data", fromToSubNetworkIDs, modesAndMicrotypes, method=method)
+        optimizer.evaluateBatch = evaluateBatch
+        return optimizer
+
+    return build, minimum
+
+
+def test_differential_evolution_scores_generations_as_batches(quadratic):
+    build, minimum = quadratic
+    result = build("differential_evolution").minimize(maxIterations=200)
+    np.testing.assert_allclose(result.x, minimum, atol=1.)
+
+
+def test_bayesian_scores_points_in_batches(quadratic):
+    pytest.importorskip("skopt")
+    build, minimum = quadratic
+    optimizer = build("bayesian")
+    optimizer.nWorkers = 4
+    result = optimizer.minimizeBayesian(nCalls=40)
+    assert result.fun < 1.
@@ -0,0 +1,28 @@
+import os
+
+import numpy as np
+import pytest
+
+from model import Model, TimePeriodPipeline
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(scope="module")
+def sequential():
+    model = Model(ROOT_DIR + "/../input-data")
+    userCosts, operatorCosts, vectorUserCosts = model.collectAllCosts()
+    return vectorUserCosts, operatorCosts, model.getModeSplit(), model.getModeSpeeds()
+
+
+@pytest.mark.parametrize("nWorkers", [1, 2])
+def test_pipeline_without_tolerance_matches_sequential_solve(sequential, nWorkers):
+    vectorUserCosts, operatorCosts, modeSplit, modeSpeeds = sequential
+    model = Model(ROOT_DIR + "/../input-data")
+    with TimePeriodPipeline(ROOT_DIR + "/../input-data", nWorkers, tolerance=0.0) as pipeline:
+        model.timePeriodPipeline = pipeline
+        _, pipelineOperatorCosts, pipelineVectorUserCosts = model.collectAllCosts()
+    np.testing.assert_array_equal(pipelineVectorUserCosts, vectorUserCosts)
+    assert pipelineOperatorCosts.total == operatorCosts.total
+    np.testing.assert_array_equal(model.getModeSplit(), modeSplit)
+    assert model.getModeSpeeds().equals(modeSpeeds)
@@ -0,0 +1,29 @@
+import os
+
+import numpy as np
+
+from model import Model, NetworkModification, ScenarioBatch
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+busLane = NetworkModification(np.array([500.]), [(2, 10)])
+
+
+def assertSameScore(a, b):
+    vectorUserCostsA, operatorCostsA, modeSplitA = a
+    vectorUserCostsB, operatorCostsB, modeSplitB = b
+    np.testing.assert_array_equal(vectorUserCostsA, vectorUserCostsB)
+    assert operatorCostsA.total == operatorCostsB.total
+    np.testing.assert_array_equal(modeSplitA, modeSplitB)
+
+
+def test_scenario_score_does_not_depend_on_earlier_scenarios():
+    model = Model(ROOT_DIR + "/../input-data")
+    first, _, second = model.evaluateMany([(None, None), (busLane, None), (None, None)], nWorkers=1)
+    assertSameScore(first, second)
+
+
+def test_worker_scenario_score_does_not_depend_on_earlier_scenarios():
+    with ScenarioBatch(ROOT_DIR + "/../input-data", 1) as batch:
+        first, _, second = batch.evaluate([(None, None), (busLane, None), (None, None)])
+    assertSameScore(first, second)
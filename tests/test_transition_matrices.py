@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+import pytest
+
+from model import Model
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(scope="module")
+def transitionMatrices():
+    return Model(ROOT_DIR + "/../input-data")._Model__transitionMatrices
+
+
+def test_incremental_average_matrix_matches_np_average(transitionMatrices):
+    tensor = transitionMatrices.numpy
+    rng = np.random.default_rng(0)
+    weights = rng.random(tensor.shape[0])
+    incrementalUpdates = 0
+    for i in range(60):
+        if i % 20 == 0:
+            weights = rng.random(tensor.shape[0]) * (rng.random(tensor.shape[0]) > 0.3)
+        else:
+            weights[rng.integers(tensor.shape[0], size=2)] = rng.random(2) * (i % 3 > 0)
+        average = transitionMatrices.averageMatrix(weights, maxIncrementalUpdates=8)
+        incrementalUpdates += transitionMatrices._TransitionMatrices__incrementalUpdates > 0
+        np.testing.assert_allclose(average.matrix, np.average(tensor, axis=0, weights=weights), rtol=1e-12,
+                                   atol=1e-15)
+    assert incrementalUpdates > 0
+
+
+def test_average_matrix_only_reads_defined_matrices():
+    transitionMatrices = Model(ROOT_DIR + "/../input-data")._Model__transitionMatrices
+    tensor = transitionMatrices.numpy
+    # Every ODI in the inputs has a matrix, so leave some undefined and drop the compact copy made while loading
+    tensor[::3, :, :] = 0.0
+    transitionMatrices._TransitionMatrices__compactNumpy = None
+    defined = np.any(tensor.reshape((tensor.shape[0], -1)), axis=1)
+    assert not np.all(defined)
+    weights = np.random.default_rng(1).random(tensor.shape[0])
+    # Undefined ODIs still count towards the total weight, so the average matches np.average over all of them
+    average = transitionMatrices.averageMatrix(weights)
+    np.testing.assert_array_equal(transitionMatrices._TransitionMatrices__definedIdx, np.flatnonzero(defined))
+    np.testing.assert_allclose(average.matrix, np.average(tensor, axis=0, weights=weights), rtol=1e-12, atol=1e-15)
+    weights[~defined] = 0.0
+    weights[np.flatnonzero(defined)[0]] = 0.0
+    average = transitionMatrices.averageMatrix(weights)
+    np.testing.assert_allclose(average.matrix, np.average(tensor, axis=0, weights=weights), rtol=1e-12, atol=1e-15)
+    np.testing.assert_array_equal(average.transposed, average.matrix.T)
+    with pytest.raises(ZeroDivisionError):
+        transitionMatrices.averageMatrix(np.zeros(tensor.shape[0]))
+
+
+def test_incremental_average_matrix_is_recomputed_after_max_updates(transitionMatrices):
+    tensor = transitionMatrices.numpy
+    definedIdx = np.flatnonzero(np.any(tensor.reshape((tensor.shape[0], -1)), axis=1))
+    weights = np.zeros(tensor.shape[0])
+    weights[definedIdx] = 1.0
+    transitionMatrices.averageMatrix(weights)
+    counts = []
+    for i in range(5):
+        weights[definedIdx[i % len(definedIdx)]] += 1.0
+        average = transitionMatrices.averageMatrix(weights, maxIncrementalUpdates=2)
+        counts.append(transitionMatrices._TransitionMatrices__incrementalUpdates)
+        np.testing.assert_allclose(average.matrix, np.average(tensor, axis=0, weights=weights), rtol=1e-12,
+                                   atol=1e-15)
+    assert counts == [1, 2, 0, 1, 2]
+
+
+def test_transition_matrix_rows_are_positional(transitionMatrices):
+    tensor = transitionMatrices.numpy
+    odi = next(odi for odi, idx in transitionMatrices.odiToIdx.items() if np.any(tensor[idx, :, :]))
+    matrix = transitionMatrices[odi]
+    for microtypeID, idx in transitionMatrices.microtypeIdToIdx.items():
+        assert matrix.idx(microtypeID) == idx
+        np.testing.assert_array_equal(matrix[microtypeID], tensor[transitionMatrices.odiToIdx[odi], idx, :])
+
+
+def test_transition_matrices_load_from_cache(tmp_path, capsys):
+    cacheDirectory = str(tmp_path / "cache")
+    parsed = Model(ROOT_DIR + "/../input-data", cacheDirectory)._Model__transitionMatrices
+    assert "transition matrices from cache" not in capsys.readouterr().out
+    cached = Model(ROOT_DIR + "/../input-data", cacheDirectory)._Model__transitionMatrices
+    assert "transition matrices from cache" in capsys.readouterr().out
+    np.testing.assert_array_equal(cached.numpy, parsed.numpy)
+    weights = np.random.default_rng(2).random(parsed.numpy.shape[0])
+    np.testing.assert_array_equal(cached.averageMatrix(weights).matrix, parsed.averageMatrix(weights).matrix)
+
+
+def test_transition_matrices_ignore_cached_array_of_wrong_shape(tmp_path, capsys):
+    cacheDirectory = str(tmp_path / "cache")
+    model = Model(ROOT_DIR + "/../input-data", cacheDirectory)
+    expected = model._Model__transitionMatrices.numpy.copy()
+    model.scenarioData.cache.saveArray("transitionMatrices", np.zeros((1, 1, 1)))
+    capsys.readouterr()
+    reparsed = Model(ROOT_DIR + "/../input-data", cacheDirectory)._Model__transitionMatrices
+    assert "transition matrices from cache" not in capsys.readouterr().out
+    np.testing.assert_array_equal(reparsed.numpy, expected)
@@ -292,6 +292,10 @@ class DemandIndex:
     def __hash__(self):
         return self.__hash
 
+    def __reduce__(self):
+        # String hashes differ between processes, so rebuild rather than unpickle __hash
+        return DemandIndex, (self.homeMicrotype, self.populationGroupType, self.tripPurpose)
+
     def __str__(self):
         return "Home: " + self.homeMicrotype + ", type: " + self.populationGroupType + ", purpose: " + self.tripPurpose
 
@@ -328,6 +332,9 @@ class ODindex:
     def __hash__(self):
         return self.__hash
 
+    def __reduce__(self):
+        return ODindex, (self.o, self.d, self.distBin)
+
     def __str__(self):
         return str(self.distBin) + " trip from " + self.o + " to " + self.d
 
@@ -345,9 +352,11 @@ class TripCollection:
 
     def __init__(self):
         self.__trips = dict()
+        self.__throughAssignment = None
 
     def __setitem__(self, key: ODindex, value: Trip):
         self.__trips[key] = value
+        self.__throughAssignment = None
 
     def addEmpty(self, item: ODindex) -> Trip:
         if item.o == item.d:
@@ -362,29 +371,51 @@ class TripCollection:
             return self.__trips[item]
         else:
             # print("Not in database! for " + str(item))
-            if item.o == item.d:
-                allocation = Allocation({item.o: 1.0})
-            else:
-                allocation = Allocation({item.o: 0.5, item.d: 0.5})
-            self[item] = Trip(item, allocation)
-            return self[item]
+            # Same allocation as addEmpty, so the cached through assignment stays valid
+            self.__trips[item] = self.addEmpty(item)
+            return self.__trips[item]
+
+    def getThroughAssignment(self, odiToIdx: dict, microtypeIdToIdx: dict, distanceBins) -> (np.ndarray, np.ndarray):
+        """
+        Returns (OD index, microtype) matrices of the distance in miles each trip covers in each microtype and of
+        whether it passes through that microtype at all. They don't depend on demand index or time period, so they
+        are only built once.
+        """
+        if self.__throughAssignment is None:
+            throughDistance = np.zeros((len(odiToIdx), len(microtypeIdToIdx)), dtype=float)
+            throughCounts = np.zeros((len(odiToIdx), len(microtypeIdToIdx)), dtype=float)
+            for odi, idx in odiToIdx.items():
+                if odi in self.__trips:
+                    trip = self.__trips[odi]
+                else:
+                    trip = self.addEmpty(odi)
+                for mID, pct in trip.allocation:
+                    throughDistance[idx, microtypeIdToIdx[mID]] = pct * distanceBins[odi.distBin]
+                    throughCounts[idx, microtypeIdToIdx[mID]] = 1.0
+            self.__throughAssignment = (throughDistance, throughCounts)
+        return self.__throughAssignment
 
     def importTrips(self, df: pd.DataFrame):
+        """
+        Builds every trip in one pass over the rows. From/to/distance bin combinations that don't appear at all get
+        the default allocation, and trips are added in the same order as looping over the unique IDs.
+        """
+        fromIds = df.FromMicrotypeID.to_list()
+        toIds = df.ToMicrotypeID.to_list()
+        distanceBinIds = df.DistanceBinID.to_list()
+        present = set(zip(fromIds, toIds, distanceBinIds))
+        allocations = dict()
+        for fromId, toId, dId, throughId, portion in zip(fromIds, toIds, distanceBinIds,
+                                                          df.ThroughMicrotypeID.to_list(), df.Portion.to_list()):
+            if (not fromId == "None") & (not toId == "None"):
+                allocations.setdefault((fromId, toId, dId), dict())[throughId] = portion
         for fromId in df.FromMicrotypeID.unique():
             for toId in df.ToMicrotypeID.unique():
                 for dId in df.DistanceBinID.unique():
-                    sub = df.loc[
-                          (df.FromMicrotypeID == fromId) & (df.ToMicrotypeID == toId) & (df.DistanceBinID == dId), :]
-                    if len(sub) > 0:
-                        for row in sub.itertuples():
-                            if (not row.FromMicrotypeID == "None") & (not row.ToMicrotypeID == "None"):
-                                odi = ODindex(row.FromMicrotypeID, row.ToMicrotypeID, row.DistanceBinID)
-                                if odi in self.__trips:
-                                    self[odi].allocation[row.ThroughMicrotypeID] = row.Portion
-                                else:
-                                    self[odi] = Trip(odi, Allocation({row.ThroughMicrotypeID: row.Portion}))
-                    else:
-                        odi = ODindex(fromId, toId, dId)
+                    odi = ODindex(fromId, toId, dId)
+                    if (fromId, toId, dId) in allocations:
+                        self[odi] = Trip(odi, Allocation(allocations[fromId, toId, dId]))
+                    elif (fromId, toId, dId) not in present:
                         self[odi] = self.addEmpty(odi)
         print("-------------------------------")
         print("|  Loaded ", len(df), " trips")
@@ -395,6 +426,9 @@ class TripCollection:
     def __len__(self):
         return len(self.__trips)
 
+    def __contains__(self, item: ODindex) -> bool:
+        return item in self.__trips
+
 
 class TripGeneration:
     """
@@ -515,23 +549,34 @@ class OriginDestination:
 
 
 class TransitionMatrix:
+    """
+    Microtype to microtype transition probabilities, stored as a contiguous array in microtypeIdToIdx order. The
+    transposed view used by the MFD is cached alongside it.
+    """
+    __slots__ = ("__microtypeIds", "__microtypeIdToIdx", "__averageSpeeds", "__matrix", "__transposed",
+                 "__diameters")
+
     def __init__(self, microtypeIdToIdx, matrix=None, diameters=None):
         self.__microtypeIds = list(microtypeIdToIdx.keys())
         self.__microtypeIdToIdx = microtypeIdToIdx
         self.__averageSpeeds = np.zeros(len(microtypeIdToIdx))
         if isinstance(matrix, pd.DataFrame):
-            self.__matrix = pd.DataFrame(0.0, index=self.__microtypeIds, columns=self.__microtypeIds).add(
-                matrix, fill_value=0.0)
+            self.__setMatrix(pd.DataFrame(0.0, index=self.__microtypeIds, columns=self.__microtypeIds).add(
+                matrix, fill_value=0.0).to_numpy())
         elif matrix is None:
-            self.__matrix = pd.DataFrame(0.0, index=self.__microtypeIds, columns=self.__microtypeIds)
+            self.__setMatrix(np.zeros((len(self.__microtypeIds), len(self.__microtypeIds))))
         elif isinstance(matrix, np.ndarray):
-            self.__matrix = pd.DataFrame(matrix, index=self.__microtypeIds, columns=self.__microtypeIds)
+            self.__setMatrix(matrix)
         else:
             print("ERROR INITIALIZING TRANSITION MATRIX")
         if diameters is None:
             diameters = np.ones(len(self.__microtypeIds))
         self.__diameters = diameters
 
+    def __setMatrix(self, matrix: np.ndarray):
+        self.__matrix = np.array(matrix, dtype=float, order="C")
+        self.__transposed = self.__matrix.T
+
     @property
     def averageSpeeds(self) -> np.ndarray:
         return self.__averageSpeeds
@@ -548,11 +593,20 @@ class TransitionMatrix:
         return self.__microtypeIds
 
     @property
-    def matrix(self) -> pd.DataFrame:
+    def matrix(self) -> np.ndarray:
         return self.__matrix
 
+    @property
+    def transposed(self) -> np.ndarray:
+        return self.__transposed
+
     def __getitem__(self, item):
-        return {mId: self.__matrix.loc[idx, :].values for mId, idx in self.__microtypeIdToIdx}
+        """
+        Transition probabilities out of microtype item, as an array ordered by microtypeIdToIdx. The row is looked up
+        by microtype ID, but unlike the DataFrame this class used to wrap, the columns are positions, not labels: use
+        idx(microtypeID) to find one.
+        """
+        return self.__matrix[self.__microtypeIdToIdx[item], :]
 
     def __add__(self, other):
         if isinstance(other, TransitionMatrix):
@@ -571,12 +625,12 @@ class TransitionMatrix:
             return self
 
     def addAndMultiply(self, other, multiplier):
-        self.__matrix += other.__matrix.to_numpy() * multiplier
+        self.__matrix += other.__matrix * multiplier
         return self
 
     def __mul__(self, other):
         # self.__matrix *= other
-        return TransitionMatrix(self.__microtypeIdToIdx, self.matrix * other)
+        return TransitionMatrix(self.__microtypeIdToIdx, self.__matrix * other)
 
     def idx(self, idx):
         return self.__microtypeIdToIdx[idx]
@@ -587,10 +641,10 @@ class TransitionMatrix:
 
     def updateMatrix(self, other):
         self.__matrix = other.matrix
+        self.__transposed = other.transposed
 
     def getSteadyState(self) -> (float, np.ndarray):
-        X = np.transpose(self.matrix.to_numpy())
-        val, vec = np.real_if_close(eigs(X, k=1, which='LM'))
+        val, vec = np.real_if_close(eigs(self.__transposed, k=1, which='LM'))
         dists = self.diameters / (1 - np.real_if_close(val))
         weights = np.real_if_close(vec / np.sum(vec))
         dist = np.average(dists, weights=weights.reshape(len(dists), ))
@@ -602,12 +656,16 @@ class TransitionMatrices:
         self.__names = []
         self.__scenarioData = scenarioData
         self.__diameters = np.ndarray(0)
-        self.__data = dict()
         self.__transitionMatrices = dict()
         self.__currentTimePeriod = 0
         self.__numpy = np.zeros(
             (len(scenarioData.odiToIdx), len(scenarioData.microtypeIdToIdx), len(scenarioData.microtypeIdToIdx)))
         self.__baseIdx = dict()
+        self.__definedIdx = None
+        self.__compactNumpy = None
+        self.__lastWeights = None
+        self.__weightedSum = None
+        self.__incrementalUpdates = 0
 
     @property
     def microtypeIdToIdx(self):
@@ -632,9 +690,9 @@ class TransitionMatrices:
         if (item.o, item.d, item.distBin) in self.__transitionMatrices:
             return self.__transitionMatrices[(item.o, item.d, item.distBin)]
         else:
-            if (item.o, item.d, item.distBin) in self.__data:
-                out = TransitionMatrix(self.microtypeIdToIdx, self.__data[(item.o, item.d, item.distBin)],
-                                       diameters=self.__diameters)
+            idx = self.odiToIdx.get(item, -1)
+            if (idx >= 0) and np.any(self.__numpy[idx, :, :]):
+                out = TransitionMatrix(self.microtypeIdToIdx, self.__numpy[idx, :, :], diameters=self.__diameters)
                 self.__transitionMatrices[(item.o, item.d, item.distBin)] = out
                 return out
             else:
@@ -660,16 +718,59 @@ class TransitionMatrices:
     def emptyWeights(self) -> np.ndarray:
         return np.zeros(self.numpy.shape[0])
 
-    def averageMatrix(self, weights: np.ndarray):
-        return TransitionMatrix(self.microtypeIdToIdx, np.average(self.numpy, axis=0, weights=weights),
+    def __compact(self):
+        # Only ODIs with a defined (nonzero) matrix can contribute to the weighted sum
+        flat = self.__numpy.reshape((self.__numpy.shape[0], -1))
+        self.__definedIdx = np.flatnonzero(np.any(flat, axis=1))
+        self.__compactNumpy = np.ascontiguousarray(flat[self.__definedIdx, :])
+        self.__lastWeights = np.zeros(len(self.__definedIdx))
+        self.__weightedSum = np.zeros(flat.shape[1])
+        self.__incrementalUpdates = 0
+
+    def averageMatrix(self, weights: np.ndarray, maxIncrementalUpdates=50):
+        """
+        Same as np.average(self.numpy, axis=0, weights=weights), but only reads the matrices of defined ODIs with
+        nonzero weight. If only a few weights changed since the last call, the weighted sum is updated with just
+        those rows. It is recomputed from scratch every maxIncrementalUpdates calls so rounding errors don't build up.
+        """
+        if self.__compactNumpy is None:
+            self.__compact()
+        totalWeight = np.sum(weights)
+        if totalWeight == 0:
+            raise ZeroDivisionError("Weights sum to zero, can't be normalized")
+        definedWeights = weights[self.__definedIdx]
+        changed = np.flatnonzero(definedWeights != self.__lastWeights)
+        if len(changed) > 0:
+            if (2 * len(changed) < np.count_nonzero(definedWeights)) & (
+                    self.__incrementalUpdates < maxIncrementalUpdates):
+                self.__weightedSum += np.tensordot(definedWeights[changed] - self.__lastWeights[changed],
+                                                   self.__compactNumpy[changed, :], axes=1)
+                self.__incrementalUpdates += 1
+            else:
+                nonzero = np.flatnonzero(definedWeights)
+                self.__weightedSum = np.tensordot(definedWeights[nonzero], self.__compactNumpy[nonzero, :], axes=1)
+                self.__incrementalUpdates = 0
+            self.__lastWeights = definedWeights.copy()
+        return TransitionMatrix(self.microtypeIdToIdx,
+                                (self.__weightedSum / totalWeight).reshape(self.__numpy.shape[1:]),
                                 diameters=self.__diameters)
 
     def importTransitionMatrices(self, matrices: pd.DataFrame, microtypeIDs: pd.DataFrame, distanceBins: pd.DataFrame):
+        self.__compactNumpy = None
+        cache = self.__scenarioData.cache
+        if cache is not None:
+            cached = cache.loadArray("transitionMatrices")
+            if (cached is not None) and (cached.shape == self.__numpy.shape):
+                self.__numpy = cached
+                print("|  Loaded ", len(cached), " transition matrices from cache")
+                print("-------------------------------")
+                return
         default = pd.DataFrame(0.0, index=microtypeIDs.MicrotypeID, columns=microtypeIDs.MicrotypeID)
         for key, val in matrices.groupby(level=[0, 1, 2]):
             df = val.set_index(val.index.droplevel([0, 1, 2])).add(default, fill_value=0.0)
             odi = ODindex(*key)
-            self.__data[odi] = df  # TODO: Delete this
             self.__numpy[self.odiToIdx[odi], :, :] = df.to_numpy()
+        if cache is not None:
+            cache.saveArray("transitionMatrices", self.__numpy)
         print("|  Loaded ", len(df), " transition probabilities")
         print("-------------------------------")
@@ -0,0 +1,98 @@
+import glob
+import hashlib
+import os
+import pickle
+import shutil
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@lru_cache(maxsize=None)
+def codeHash() -> str:
+    """ Hash of the model source and the numpy and pandas versions, which decide what a parsed snapshot holds """
+    digest = hashlib.sha1((np.__version__ + pd.__version__).encode())
+    for fullPath in [os.path.join(ROOT_DIR, "model.py")] + sorted(glob.glob(os.path.join(ROOT_DIR, "utils", "*.py"))):
+        digest.update(os.path.relpath(fullPath, ROOT_DIR).encode())
+        with open(fullPath, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def contentHash(path: str, exclude=None) -> str:
+    """
+    Hash of the names and contents of every input file under path, and of the code that parses them. The directory
+    exclude (the cache, if it's kept inside the inputs) is skipped.
+    """
+    digest = hashlib.sha1(codeHash().encode())
+    exclude = None if exclude is None else os.path.realpath(exclude)
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if os.path.realpath(os.path.join(root, d)) != exclude)
+        for file in sorted(files):
+            fullPath = os.path.join(root, file)
+            digest.update(os.path.relpath(fullPath, path).encode())
+            with open(fullPath, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+class ScenarioCache:
+    """
+    Binary snapshot of a parsed input directory, stored under <cacheDirectory>/<hash of the input path>/<content
+    hash>. Editing any input file, or the model code, changes the content hash, so stale snapshots are never read,
+    and the first write of a new snapshot deletes the older ones of the same input. If the snapshot can't be written
+    (e.g. the cache directory is read only) the inputs are just parsed again next time.
+
+    Objects are pickled, so only point cacheDirectory at a directory you trust. Large arrays are saved as .npy and
+    loaded memory mapped and read only, so worker processes share the same pages.
+    """
+
+    def __init__(self, path: str, cacheDirectory: str):
+        self.key = contentHash(path, exclude=cacheDirectory)
+        self.inputDirectory = os.path.join(cacheDirectory,
+                                           hashlib.sha1(os.path.realpath(path).encode()).hexdigest()[:16])
+        self.directory = os.path.join(self.inputDirectory, self.key)
+
+    def __file(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def __removeStaleSnapshots(self):
+        if os.path.isdir(self.inputDirectory):
+            for key in os.listdir(self.inputDirectory):
+                if key != self.key:
+                    shutil.rmtree(os.path.join(self.inputDirectory, key), ignore_errors=True)
+
+    def __write(self, name: str, write):
+        # Write to a temporary file first so other processes never see a partial snapshot
+        tmp = self.__file(name) + "." + str(os.getpid()) + ".tmp"
+        try:
+            if not os.path.isdir(self.directory):
+                self.__removeStaleSnapshots()
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp, "wb") as f:
+                write(f)
+            os.replace(tmp, self.__file(name))
+        except OSError as e:
+            print("|  Could not write ", name, " to the scenario cache: ", e)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def load(self, name: str):
+        if os.path.exists(self.__file(name + ".pkl")):
+            with open(self.__file(name + ".pkl"), "rb") as f:
+                return pickle.load(f)
+        return None
+
+    def save(self, name: str, obj):
+        self.__write(name + ".pkl", lambda f: pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def loadArray(self, name: str):
+        if os.path.exists(self.__file(name + ".npy")):
+            return np.load(self.__file(name + ".npy"), mmap_mode="r")
+        return None
+
+    def saveArray(self, name: str, array: np.ndarray):
+        self.__write(name + ".npy", lambda f: np.save(f, array))
@@ -154,6 +154,10 @@ class CollectedChoiceCharacteristics:
         self.__distanceBins = DistanceBins()
         self.__numpy = np.zeros((len(scenarioData.odiToIdx), len(scenarioData.modeToIdx), len(scenarioData.paramToIdx)),
                                 dtype=float)
+        self.__tripOdiIdx = np.zeros(0, dtype=int)
+        self.__tripOriginIdx = np.zeros(0, dtype=int)
+        self.__tripDestinationIdx = np.zeros(0, dtype=int)
+        self.__modeAvailability = np.ones((len(scenarioData.odiToIdx), len(scenarioData.modeToIdx)), dtype=bool)
 
     @property
     def odiToIdx(self):
@@ -175,6 +179,11 @@ class CollectedChoiceCharacteristics:
     def numpy(self) -> np.ndarray:
         return self.__numpy
 
+    @property
+    def modeAvailability(self) -> np.ndarray:
+        """ (OD index, mode) mask of the modes that can be chosen for each trip """
+        return self.__modeAvailability
+
     def __setitem__(self, key, value: ModalChoiceCharacteristics):
         self.__choiceCharacteristics[key] = value
 
@@ -183,33 +192,33 @@ class CollectedChoiceCharacteristics:
 
     def initializeChoiceCharacteristics(self, trips, microtypes, distanceBins: DistanceBins):
         self.__distanceBins = distanceBins
+        self.__modeAvailability = microtypes.getModeAvailability(trips)
         self.__numpy[:, :, self.paramToIdx['intercept']] = 1
+        tripOdiIdx, tripOriginIdx, tripDestinationIdx = [], [], []
         for odIndex, trip in trips:
             if odIndex.d != 'None' and odIndex.o != 'None':
-                common_modes = [microtypes[odIndex.o].mode_names, microtypes[odIndex.d].mode_names]
-                modes = set.intersection(*common_modes)
-                for mode in self.modes:
-                    if mode not in modes:
-                        #print("Excluding mode ", mode, "in ODI", odIndex)
-                        self.__numpy[self.odiToIdx[odIndex], self.modeToIdx[mode], :] = np.nan
+                tripOdiIdx.append(self.odiToIdx[odIndex])
+                tripOriginIdx.append(microtypes.microtypeIdToIdx[odIndex.o])
+                tripDestinationIdx.append(microtypes.microtypeIdToIdx[odIndex.d])
                 self[odIndex] = ModalChoiceCharacteristics(self.modeToIdx, distanceBins[odIndex.distBin],
                                                            data=self.__numpy[self.odiToIdx[odIndex], :, :])
+        self.__tripOdiIdx = np.array(tripOdiIdx, dtype=int)
+        self.__tripOriginIdx = np.array(tripOriginIdx, dtype=int)
+        self.__tripDestinationIdx = np.array(tripDestinationIdx, dtype=int)
 
     def resetChoiceCharacteristics(self):
-        self.__numpy[~np.isnan(self.__numpy)] *= 0.0
+        self.__numpy.fill(0.0)
         self.__numpy[:, :, self.paramToIdx['intercept']] = 1
 
     def updateChoiceCharacteristics(self, microtypes, trips):
         self.resetChoiceCharacteristics()
-        travelTimeInHours = speedToTravelTime(microtypes.numpySpeed, self.__demand.toThroughDistance)
+        travelTimeInHours = speedToTravelTime(microtypes.numpySpeed, self.__demand.throughDistance)
 
-        for odIndex, trip in trips:
-            if odIndex.d != 'None' and odIndex.o != 'None':
-                common_modes = [microtypes[odIndex.o].mode_names, microtypes[odIndex.d].mode_names]
-                modes = set.intersection(*common_modes)
-                for mode in modes:
-                    microtypes[odIndex.o].addStartTimeCostWait(mode, self[odIndex][mode])
-                    microtypes[odIndex.d].addEndTimeCostWait(mode, self[odIndex][mode])
+        # Start and end costs only depend on the microtype. Modes that aren't available at both ends of a trip pick up
+        # a cost too, but modeAvailability keeps them out of the mode split and the cost totals
+        starts, ends = microtypes.getStartAndEndCosts(len(self.paramToIdx))
+        startsAndEnds = starts[self.__tripOriginIdx, :, :] + ends[self.__tripDestinationIdx, :, :]
+        self.__numpy[self.__tripOdiIdx, :, :] += startsAndEnds
         #         newAllocation = microtypes.filterAllocation(mode, trip.allocation)
         #         for microtypeID, allocation in newAllocation.items():
         #             microtypes[microtypeID].addThroughTimeCostWait(mode,
@@ -220,10 +229,11 @@ class CollectedChoiceCharacteristics:
         self.__numpy[:, :, self.paramToIdx['travel_time']] = travelTimeInHours
 
 
-def speedToTravelTime(modeSpeed: np.ndarray, toThroughDistance: np.ndarray) -> np.ndarray:
+def speedToTravelTime(modeSpeed: np.ndarray, throughDistance: np.ndarray) -> np.ndarray:
+    """ throughDistance is the (OD index, microtype) matrix of distances in miles """
     modeSecondsPerMeter = (1 / modeSpeed)
     modeSecondsPerMeter[np.isinf(modeSecondsPerMeter)] = 0.0
-    assignmentMatrix = np.max(toThroughDistance, axis=0) * 1609.34
+    assignmentMatrix = throughDistance * 1609.34
     throughTravelTimeInSeconds = assignmentMatrix @ modeSecondsPerMeter
     return throughTravelTimeInSeconds / 3600.0
 
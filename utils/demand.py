@@ -4,6 +4,7 @@ import numpy as np
 
 np.set_printoptions(precision=5)
 import pandas as pd
+from scipy.sparse import csr_matrix
 
 from .OD import TripCollection, OriginDestination, TripGeneration, DemandIndex, ODindex, ModeSplit, TransitionMatrices
 from .choiceCharacteristics import CollectedChoiceCharacteristics
@@ -149,11 +150,20 @@ class Demand:
         self.__modes = list(scenarioData.modeToIdx.keys())
         self.__modeSplit = dict()
         self.__modeSplitData = np.ndarray(0)
+        self.__logsum = None
         self.__tripRate = np.ndarray(0)
-        self.__toStarts = np.ndarray(0)
-        self.__toEnds = np.ndarray(0)
-        self.__toThroughDistance = np.ndarray(0)
-        self.__toThroughCounts = np.ndarray(0)
+        self.__assignedRows = np.ndarray(0, dtype=int)
+        self.__assignedStarts = np.ndarray(0, dtype=int)
+        self.__assignedEnds = np.ndarray(0, dtype=int)
+        self.__pairRows = np.ndarray(0, dtype=int)
+        self.__pairDi = np.ndarray(0, dtype=int)
+        self.__pairOdi = np.ndarray(0, dtype=int)
+        self.__pairTripRate = np.ndarray(0)
+        self.__toStarts = csr_matrix((0, 0))
+        self.__toEnds = csr_matrix((0, 0))
+        self.__toODindex = csr_matrix((0, 0))
+        self.__throughDistance = np.ndarray(0)
+        self.__throughCounts = np.ndarray(0)
         self.tripRate = 0.0
         self.demandForPMT = 0.0
         self.pop = 0.0
@@ -162,10 +172,61 @@ class Demand:
         self.__trips = TripCollection()
         self.__distanceBins = DistanceBins()
         self.__transitionMatrices = None
+        self.chunkSize = None
 
     @property
-    def toThroughDistance(self):
-        return self.__toThroughDistance
+    def throughDistance(self):
+        """ (OD index, microtype) matrix of miles traveled through each microtype """
+        return self.__throughDistance
+
+    @property
+    def modeSplitData(self):
+        """ (demand index, OD index, mode) mode split """
+        return self.__modeSplitData
+
+    @property
+    def nActivePairs(self):
+        """ Number of (demand index, OD index) pairs that the mode split is computed for """
+        return len(self.__pairRows)
+
+    def __updateActivePairs(self):
+        """
+        The mode split is only evaluated for the (demand index, OD index) pairs OriginDestination assigned trips to, plus
+        any other pair with a nonzero trip rate. Pairs are stored as flat rows, demand index * len(odiToIdx) + OD index,
+        in increasing order. Assigned pairs keep their start and end microtypes; the others have none.
+        """
+        rows = np.union1d(self.__assignedRows, np.flatnonzero(self.__tripRate))
+        self.__pairRows = rows
+        self.__pairDi, self.__pairOdi = np.divmod(rows, len(self.odiToIdx))
+        self.__pairTripRate = self.__tripRate.ravel()[rows]
+        assigned = np.searchsorted(rows, self.__assignedRows)
+        shape = (len(rows), len(self.microtypeIdToIdx))
+        self.__toStarts = csr_matrix((np.ones(len(assigned)), (assigned, self.__assignedStarts)), shape=shape)
+        self.__toEnds = csr_matrix((np.ones(len(assigned)), (assigned, self.__assignedEnds)), shape=shape)
+        self.__toODindex = csr_matrix((np.ones(len(rows)), (np.arange(len(rows)), self.__pairOdi)),
+                                      shape=(len(rows), len(self.odiToIdx)))
+
+    def __pairBlocks(self):
+        """ Slices of the active pairs covering at most chunkSize demand indices each """
+        nDemandIndices = len(self.diToIdx)
+        chunkSize = nDemandIndices if self.chunkSize is None else max(self.chunkSize, 1)
+        for start in range(0, nDemandIndices, chunkSize):
+            yield slice(*np.searchsorted(self.__pairDi, [start, start + chunkSize]))
+
+    def __pairModeSplit(self, block=slice(None)) -> np.ndarray:
+        """ (pair, mode) copy of the mode split of the active pairs in block """
+        return self.__modeSplitData.reshape((-1, len(self.modeToIdx)))[self.__pairRows[block], :]
+
+    def __pairStartsByMode(self, block=slice(None)) -> np.ndarray:
+        return np.einsum('...,...i->...i', self.__pairTripRate[block], self.__pairModeSplit(block))
+
+    @property
+    def logsum(self):
+        """
+        (demand index, OD index) log of the logit denominator from the last mode split update, in utils. Only pairs
+        the mode split is computed for are filled in. The rest, and pairs with no available mode, are nan.
+        """
+        return self.__logsum
 
     @property
     def odiToIdx(self):
@@ -187,6 +248,16 @@ class Demand:
         tripRate = self.__tripRate
         newTripRate = np.ones(np.shape(tripRate)) * newTripStartRate
         np.copyto(self.__tripRate, newTripRate)
+        self.__updateActivePairs()
+
+    def updateModeSplitData(self, modeSplitData):
+        np.copyto(self.__modeSplitData, modeSplitData)
+
+    def resetModeSplit(self):
+        """ Cold start: every trip split 0.7 auto / 0.3 walk """
+        self.__modeSplitData.fill(0.0)
+        self.__modeSplitData[:, :, self.modeToIdx['auto']] = 0.7
+        self.__modeSplitData[:, :, self.modeToIdx['walk']] = 0.3
 
     def nModes(self):
         return len(self.__modes)
@@ -237,16 +308,18 @@ class Demand:
                 # TODO: Make smoother
                 trip = trips[odi]
         self.__modeSplitData = np.zeros((len(self.diToIdx), len(self.odiToIdx), len(self.modeToIdx)), dtype=float)
-        self.__modeSplitData[:, :, self.modeToIdx['auto']] = 0.7
-        self.__modeSplitData[:, :, self.modeToIdx['walk']] = 0.3
+        self.resetModeSplit()
 
         self.__tripRate = np.zeros((len(self.diToIdx), len(self.odiToIdx)), dtype=float)
-        self.__toStarts = np.zeros((len(self.diToIdx), len(self.odiToIdx), len(self.microtypeIdToIdx)), dtype=float)
-        self.__toEnds = np.zeros((len(self.diToIdx), len(self.odiToIdx), len(self.microtypeIdToIdx)), dtype=float)
-        self.__toThroughDistance = np.zeros((len(self.diToIdx), len(self.odiToIdx), len(self.microtypeIdToIdx)),
-                                            dtype=float)
-        self.__toThroughCounts = np.zeros((len(self.diToIdx), len(self.odiToIdx), len(self.microtypeIdToIdx)),
-                                          dtype=float)
+
+        # The start/end microtype of every (demand index, OD index) pair with trips, by flat
+        # row = currentPopIndex * len(odiToIdx) + currentODindex. Each row only touches one microtype.
+        startCols = []
+        endCols = []
+        pairRows = []
+        self.__throughDistance, self.__throughCounts = trips.getThroughAssignment(self.odiToIdx,
+                                                                                  self.microtypeIdToIdx,
+                                                                                  distanceBins)
 
         for demandIndex, utilityParams in population:
             od = originDestination[demandIndex]
@@ -255,7 +328,6 @@ class Demand:
 
             for odi, portion in od.items():
                 trip = trips[odi]
-                common_modes = [microtypes[trip.odIndex.o].mode_names, microtypes[trip.odIndex.d].mode_names]
                 # # Now we're switching over to only looking at origin and destination modes
                 # common_modes = []
                 # for microtypeID, allocation in trip.allocation:
@@ -283,14 +355,11 @@ class Demand:
                 currentPopIndex = self.diToIdx[demandIndex]
                 weights[currentODindex] += tripRatePerHour  # demandForPMT # CHANGED
                 self.__tripRate[currentPopIndex, currentODindex] = tripRatePerHour
-                self.__toStarts[currentPopIndex, currentODindex, self.microtypeIdToIdx[odi.o]] = 1.0
-                self.__toEnds[currentPopIndex, currentODindex, self.microtypeIdToIdx[odi.d]] = 1.0
+                currentRow = currentPopIndex * len(self.odiToIdx) + currentODindex
+                pairRows.append(currentRow)
+                startCols.append(self.microtypeIdToIdx[odi.o])
+                endCols.append(self.microtypeIdToIdx[odi.d])
                 # TODO: Expand through distance to have a mode dimension, then filter and reallocate
-                for mID, pct in trip.allocation:
-                    # NOTE: THis doesn't actually need to be indexed by currentPopIndex
-                    self.__toThroughDistance[
-                        currentPopIndex, currentODindex, self.microtypeIdToIdx[mID]] = pct * distanceBins[odi.distBin]
-                    self.__toThroughCounts[currentPopIndex, currentODindex, self.microtypeIdToIdx[mID]] = 1.0
                 self[demandIndex, odi] = ModeSplit(demandForTrips=tripRatePerHour, demandForPMT=demandForPMT,
                                                    data=self.__modeSplitData[currentPopIndex, currentODindex, :],
                                                    modeToIdx=self.modeToIdx)
@@ -303,6 +372,11 @@ class Demand:
             # self.diToIdx[demandIndex] = popCounter
             # popCounter += 1
 
+        self.__assignedRows = np.array(pairRows, dtype=int)
+        self.__assignedStarts = np.array(startCols, dtype=int)
+        self.__assignedEnds = np.array(endCols, dtype=int)
+        self.__updateActivePairs()
+
         otherMatrix = transitionMatrices.averageMatrix(weights)
         microtypes.transitionMatrix.updateMatrix(otherMatrix)
 
@@ -311,11 +385,16 @@ class Demand:
         for microtypeID, microtype in microtypes:
             microtype.resetDemand()
         totalDemandForTrips = 0.0
-        startsByMode = np.einsum('...,...i->...i', self.__tripRate, self.__modeSplitData)
-        startsByOrigin = np.einsum('ijk,ijl->lk', startsByMode, self.__toStarts)
-        startsByDestination = np.einsum('ijk,ijl->lk', startsByMode, self.__toEnds)
-        distanceByMicrotype = np.einsum('ijk,ijl->lk', startsByMode, self.__toThroughDistance)
-        throughCountsByMicrotype = np.einsum('ijk,ijl->lk', startsByMode, self.__toThroughCounts)
+        startsByOrigin = np.zeros((len(self.microtypeIdToIdx), len(self.modeToIdx)), dtype=float)
+        startsByDestination = np.zeros((len(self.microtypeIdToIdx), len(self.modeToIdx)), dtype=float)
+        startsByODindexAndMode = np.zeros((len(self.odiToIdx), len(self.modeToIdx)), dtype=float)
+        for block in self.__pairBlocks():
+            startsByMode = self.__pairStartsByMode(block)
+            startsByOrigin += self.__toStarts[block, :].T @ startsByMode
+            startsByDestination += self.__toEnds[block, :].T @ startsByMode
+            startsByODindexAndMode += self.__toODindex[block, :].T @ startsByMode
+        distanceByMicrotype = self.__throughDistance.T @ startsByODindexAndMode
+        throughCountsByMicrotype = self.__throughCounts.T @ startsByODindexAndMode
         newData = np.stack([startsByOrigin, startsByDestination, throughCountsByMicrotype, distanceByMicrotype],
                            axis=-1)
         autoDemandInMeters = newData[:, self.modeToIdx['auto'], 3] * 3600 * self.timePeriodDuration
@@ -323,7 +402,7 @@ class Demand:
         # distanceByOdx = np.einsum('ijk,ijl->jk', startsByMode, self.__toThroughDistance)
         microtypes.updateNumpyDemand(newData)
         # weights = distanceByOdx[:, self.modeToIdx["auto"]]
-        weights = np.sum(startsByMode[:, :, self.modeToIdx["auto"]], axis=0)
+        weights = startsByODindexAndMode[:, self.modeToIdx["auto"]]
 
         # for di, odi in self.keys():
         #     if (di, odi) not in self:
@@ -355,9 +434,25 @@ class Demand:
         # print(autoProductionInMeters)
 
     def updateModeSplit(self, collectedChoiceCharacteristics: CollectedChoiceCharacteristics,
-                        originDestination: OriginDestination, oldModeSplit: ModeSplit):
-        newModeSplit = modeSplitMatrixCalc(self.__population.numpy, collectedChoiceCharacteristics.numpy)
-        np.copyto(self.__modeSplitData, np.average([newModeSplit, self.__modeSplitData], axis=0, weights=[0.85, 0.15]))
+                        originDestination: OriginDestination, oldModeSplit: ModeSplit, solver=None):
+        if self.__logsum is None:
+            self.__logsum = np.full((len(self.diToIdx), len(self.odiToIdx)), np.nan, dtype=float)
+        newModeSplit = np.empty((self.nActivePairs, len(self.modeToIdx)), dtype=float)
+        logsum = np.empty(self.nActivePairs, dtype=float)
+        for block in self.__pairBlocks():
+            pairModeSplitCalc(self.__population.numpy, collectedChoiceCharacteristics.numpy, self.__pairDi[block],
+                              self.__pairOdi[block], collectedChoiceCharacteristics.modeAvailability,
+                              out=newModeSplit[block, :], logsum=logsum[block])
+        self.__logsum.ravel()[self.__pairRows] = logsum
+        modeSplit = self.__pairModeSplit()
+        if solver is None:
+            # np.average([newModeSplit, modeSplit], axis=0, weights=[0.85, 0.15]), in place
+            newModeSplit *= 0.85
+            modeSplit *= 0.15
+            modeSplit += newModeSplit
+        else:
+            modeSplit = solver.update(modeSplit, newModeSplit, out=modeSplit)
+        self.__modeSplitData.reshape((-1, len(self.modeToIdx)))[self.__pairRows, :] = modeSplit
         # np.copyto(self.__modeSplitData, newModeSplit)
         # for demandIndex, utilityParams in self.__population:
         #     od = originDestination[demandIndex]
@@ -395,18 +490,24 @@ class Demand:
         return ModeSplit(trips, demandForTrips, demandForDistance)
 
     def getMatrixModeCounts(self):
-        modeCounts = np.einsum('ij,ijk->k', self.__tripRate, self.__modeSplitData)
+        modeCounts = np.einsum('i,ik->k', self.__pairTripRate, self.__pairModeSplit())
         return modeCounts
 
     def getMatrixUserCosts(self, collectedChoiceCharacteristics: CollectedChoiceCharacteristics) -> np.ndarray:
-        startsByMode = np.einsum('...,...i->...i', self.__tripRate, self.__modeSplitData)
-        costByMode = utils(self.__population.numpyCost, collectedChoiceCharacteristics.numpy)
-        return startsByMode * costByMode
+        userCosts = np.zeros_like(self.__modeSplitData)
+        for block in self.__pairBlocks():
+            pairDi, pairOdi = self.__pairDi[block], self.__pairOdi[block]
+            costByMode = pairUtils(self.__population.numpyCost, collectedChoiceCharacteristics.numpy, pairDi, pairOdi)
+            pairCosts = np.zeros_like(costByMode)
+            np.multiply(self.__pairStartsByMode(block), costByMode, out=pairCosts,
+                        where=collectedChoiceCharacteristics.modeAvailability[pairOdi, :])
+            userCosts.reshape((-1, len(self.modeToIdx)))[self.__pairRows[block], :] = pairCosts
+        return userCosts
 
     def getSummedCharacteristics(self, collectedChoiceCharacteristics: CollectedChoiceCharacteristics) -> np.ndarray:
-        startsByMode = np.einsum('...,...i->...i', self.__tripRate, self.__modeSplitData)
-        totalsByModeAndCharacteristic = np.einsum('ijk,jkl->kl', startsByMode, collectedChoiceCharacteristics.numpy)
-        return totalsByModeAndCharacteristic
+        startsByODindexAndMode = self.__toODindex.T @ self.__pairStartsByMode()
+        startsByODindexAndMode *= collectedChoiceCharacteristics.modeAvailability
+        return np.einsum('jk,jkl->kl', startsByODindexAndMode, collectedChoiceCharacteristics.numpy)
 
     def getUserCosts(self, collectedChoiceCharacteristics: CollectedChoiceCharacteristics,
                      originDestination: OriginDestination, modes=None) -> CollectedTotalUserCosts:
@@ -449,21 +550,48 @@ class Demand:
         return "Trips: " + str(self.tripRate) + ", PMT: " + str(self.demandForPMT)
 
 
-def utils(popVars: np.ndarray, choiceChars: np.ndarray) -> np.ndarray:
-    """ Indices:
-    i: population group (demand index)
-    j: OD index
-    k: mode
-    l: parameter
-    """
-    utils = np.einsum('ikl,jkl->ijk', popVars, choiceChars)
-    # print(choiceChars[0,-1,:])
-    return utils
+def pairUtils(popVars: np.ndarray, choiceChars: np.ndarray, diIdx: np.ndarray, odiIdx: np.ndarray) -> np.ndarray:
+    """ Utility of each mode for (demand index, OD index) pairs, giving (pair, mode) """
+    return np.einsum('ikl,ikl->ik', popVars[diIdx, :, :], choiceChars[odiIdx, :, :])
 
 
-def modeSplitMatrixCalc(popVars: np.ndarray, choiceChars: np.ndarray) -> np.ndarray:
-    expUtils = np.exp(utils(popVars, choiceChars))
-    probabilities = expUtils / np.expand_dims(np.nansum(expUtils, axis=2), 2)
-    probabilities[np.isnan(expUtils)] = 0
-    # print(probabilities[0,0,:])
-    return probabilities
+def logitInPlace(utilities: np.ndarray, unavailable: np.ndarray, logsum=None) -> np.ndarray:
+    """
+    Turn utilities, with mode as the last axis, into logit probabilities in place. Unavailable modes get zero, and so
+    does every mode where none is available. The largest utility is subtracted before taking the exponent. If logsum
+    is given, the log sum of the exponentiated utilities is written into it, or nan where no mode is available.
+    """
+    np.copyto(utilities, -np.inf, where=unavailable)
+    # Reductions over the short mode axis are faster as elementwise operations on each mode
+    maxUtility = utilities[..., 0].copy()
+    for modeIdx in range(1, utilities.shape[-1]):
+        np.maximum(maxUtility, utilities[..., modeIdx], out=maxUtility)
+    maxUtility[~np.isfinite(maxUtility)] = 0.0
+    np.subtract(utilities, maxUtility[..., None], out=utilities)
+    np.exp(utilities, out=utilities)
+    total = utilities[..., 0].copy()
+    for modeIdx in range(1, utilities.shape[-1]):
+        np.add(total, utilities[..., modeIdx], out=total)
+    hasChoice = total > 0
+    np.divide(utilities, total[..., None], out=utilities, where=hasChoice[..., None])
+    utilities[~hasChoice] = 0.0
+    if logsum is not None:
+        np.log(total, out=logsum, where=hasChoice)
+        logsum[~hasChoice] = np.nan
+        np.add(logsum, maxUtility, out=logsum)
+    return utilities
+
+
+def pairModeSplitCalc(popVars: np.ndarray, choiceChars: np.ndarray, diIdx: np.ndarray, odiIdx: np.ndarray,
+                      modeAvailability=None, out=None, logsum=None) -> np.ndarray:
+    """
+    Logit mode split for (demand index, OD index) pairs, giving (pair, mode). Modes that aren't available
+    (modeAvailability is an (OD index, mode) mask) get zero. If logsum is given, each pair's log sum of the
+    exponentiated utilities is written into it.
+    """
+    if out is None:
+        out = np.empty((len(diIdx), choiceChars.shape[1]), dtype=float)
+    np.copyto(out, pairUtils(popVars, choiceChars, diIdx, odiIdx))
+    if modeAvailability is None:
+        return logitInPlace(out, False, logsum)
+    return logitInPlace(out, ~modeAvailability[odiIdx, :], logsum)
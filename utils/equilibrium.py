@@ -0,0 +1,231 @@
+import numpy as np
+
+from .demand import Demand
+from .microtype import MicrotypeCollection
+from .network import CollectedNetworkStateData, NetworkModeData
+
+
+class FixedPointSolver:
+    """
+    Damped fixed point iteration on the mode split, x <- damping * G(x) + (1 - damping) * x, where G(x) is the logit
+    split given the speeds x produces. This is the scheme Model.findEquilibrium has always used.
+
+    Iteration stops once the change in the overall mode split is at most tolerance, or after maxIterations.
+    """
+
+    def __init__(self, damping=0.85, tolerance=1e-5, maxIterations=20):
+        self.damping = damping
+        self.tolerance = tolerance
+        self.maxIterations = maxIterations
+
+    def reset(self):
+        pass
+
+    def update(self, x: np.ndarray, gx: np.ndarray, out=None) -> np.ndarray:
+        """ If out is given (it can be x), the step is written into it in blocks rather than into a new array """
+        if out is None:
+            return np.average([gx, x], axis=0, weights=[self.damping, 1. - self.damping])
+        # Same arithmetic as np.average, (damping * gx + (1 - damping) * x) / (damping + 1 - damping)
+        weights = np.array([self.damping, 1. - self.damping])
+        blockSize = max(1, 2 ** 20 // max(out[0].size, 1)) if out.ndim > 1 else out.size
+        for start in range(0, len(out), blockSize):
+            block = slice(start, start + blockSize)
+            damped = gx[block] * weights[0]
+            np.multiply(x[block], weights[1], out=out[block])
+            np.add(damped, out[block], out=out[block])
+            np.divide(out[block], np.sum(weights), out=out[block])
+        return out
+
+
+class AdaptiveDampingSolver(FixedPointSolver):
+    """
+    Damped fixed point iteration that takes longer steps while the residual ||G(x) - x|| keeps shrinking and
+    shorter ones when it grows.
+    """
+
+    def __init__(self, damping=0.85, tolerance=1e-5, maxIterations=20, minDamping=0.1, maxDamping=1.0,
+                 increase=1.2, decrease=0.5):
+        super().__init__(damping, tolerance, maxIterations)
+        self.minDamping = minDamping
+        self.maxDamping = maxDamping
+        self.increase = increase
+        self.decrease = decrease
+        self.__initialDamping = damping
+        self.__lastResidual = np.inf
+
+    def reset(self):
+        self.damping = self.__initialDamping
+        self.__lastResidual = np.inf
+
+    def update(self, x: np.ndarray, gx: np.ndarray, out=None) -> np.ndarray:
+        residual = np.linalg.norm(gx - x)
+        if residual < self.__lastResidual:
+            self.damping = min(self.damping * self.increase, self.maxDamping)
+        else:
+            self.damping = max(self.damping * self.decrease, self.minDamping)
+        self.__lastResidual = residual
+        return super().update(x, gx, out)
+
+
+class AndersonSolver(FixedPointSolver):
+    """
+    Anderson mixing over the last memory iterates. The step is the damped fixed point step corrected by the least
+    squares combination of previous residuals, x <- x + damping * f - (dX + damping * dF) gamma with f = G(x) - x,
+    then projected back to non-negative mode splits that sum to one.
+    """
+
+    def __init__(self, memory=5, damping=0.85, tolerance=1e-5, maxIterations=20, regularization=1e-10):
+        super().__init__(damping, tolerance, maxIterations)
+        self.memory = memory
+        self.regularization = regularization
+        self.__x = []
+        self.__f = []
+
+    def reset(self):
+        self.__x = []
+        self.__f = []
+
+    def update(self, x: np.ndarray, gx: np.ndarray, out=None) -> np.ndarray:
+        f = (gx - x).ravel()
+        step = self.damping * f
+        if len(self.__f) > 0:
+            dF = np.stack([f - old for old in self.__f], axis=1)
+            dX = np.stack([x.ravel() - old for old in self.__x], axis=1)
+            gramian = dF.T @ dF
+            gramian += self.regularization * np.trace(gramian) * np.eye(len(self.__f))
+            gamma = np.linalg.solve(gramian, dF.T @ f)
+            step -= (dX + self.damping * dF) @ gamma
+        self.__x = [x.ravel().copy()] + self.__x[:self.memory - 1]
+        self.__f = [f] + self.__f[:self.memory - 1]
+        if out is None:
+            return projectModeSplit(x + step.reshape(x.shape))
+        np.add(x, step.reshape(x.shape), out=out)
+        return projectModeSplit(out)
+
+
+def projectModeSplit(modeSplit: np.ndarray) -> np.ndarray:
+    """ Clip to non-negative and renormalize over the last (mode) axis, in place """
+    np.maximum(modeSplit, 0.0, out=modeSplit)
+    total = np.sum(modeSplit, axis=-1, keepdims=True)
+    return np.divide(modeSplit, total, out=modeSplit, where=total > 0)
+
+
+class EquilibriumState:
+    """
+    Snapshot of a solved time period: the mode split, the speeds (including the bus route speeds, which live in
+    numpySpeed), the per mode VMT, accumulation and blocked distance of every subnetwork, the base speed and jam
+    flag of every network, and the network state the MFD converged to. Everything findEquilibrium iterates on.
+    """
+
+    def __init__(self, modeSplitData: np.ndarray, numpySpeed: np.ndarray,
+                 networkStateData: CollectedNetworkStateData, networkModeData: NetworkModeData = None,
+                 networkSpeeds: dict = None):
+        self.modeSplitData = modeSplitData
+        self.numpySpeed = numpySpeed
+        self.networkStateData = networkStateData
+        self.networkModeData = networkModeData
+        if networkSpeeds is None:
+            networkSpeeds = dict()
+        self.networkSpeeds = networkSpeeds
+
+    @staticmethod
+    def __networks(microtypes: MicrotypeCollection):
+        for microtypeID, microtype in microtypes:
+            for modes, network in microtype.networks:
+                yield (microtypeID, modes), network
+
+    @classmethod
+    def fromModel(cls, demand: Demand, microtypes: MicrotypeCollection):
+        networkSpeeds = {key: (network.base_speed, network.isJammed) for key, network in cls.__networks(microtypes)}
+        return cls(demand.modeSplitData.copy(), microtypes.numpySpeed.copy(),
+                   microtypes.collectedNetworkStateData.copy(), microtypes.networkModeData.copy(), networkSpeeds)
+
+    def applyTo(self, demand: Demand, microtypes: MicrotypeCollection):
+        demand.updateModeSplitData(self.modeSplitData)
+        microtypes.updateNumpySpeed(self.numpySpeed)
+        microtypes.collectedNetworkStateData.adoptEquilibriumState(self.networkStateData)
+        if self.networkModeData is not None:
+            microtypes.networkModeData.copyFrom(self.networkModeData)
+        for key, network in self.__networks(microtypes):
+            if key in self.networkSpeeds:
+                network.base_speed, network.isJammed = self.networkSpeeds[key]
+
+
+class TimePeriodSolution:
+    """
+    What Model.solveTimePeriod hands back from a (possibly remote) time period: the equilibrium it converged to, the
+    user cost or summed characteristic matrix and the operator costs, all multiplied by the period duration, and the
+    solver residuals.
+    """
+
+    def __init__(self, timePeriod, equilibriumState: EquilibriumState, matrix: np.ndarray, operatorCosts,
+                 residuals: list, converged: bool):
+        self.timePeriod = timePeriod
+        self.equilibriumState = equilibriumState
+        self.matrix = matrix
+        self.operatorCosts = operatorCosts
+        self.residuals = residuals
+        self.converged = converged
+
+    @property
+    def finalStates(self) -> dict:
+        return self.equilibriumState.networkStateData.getFinalStates()
+
+
+def handOffDifference(assumed: dict, actual: dict) -> float:
+    """
+    Largest relative difference in accumulation between two sets of initial states from
+    CollectedNetworkStateData.getFinalStates, or inf if they don't cover the same networks. The time only labels the
+    results, so it isn't compared.
+    """
+    if assumed.keys() != actual.keys():
+        return np.inf
+    difference = 0.0
+    for key, (accumulation, _, _) in actual.items():
+        difference = max(difference, abs(assumed[key][0] - accumulation) / max(abs(accumulation), 1.0))
+    return difference
+
+
+class WarmStartStore:
+    """
+    Converged equilibrium states by time period, used to start Model.findEquilibrium from a previous solution
+    rather than from the default 0.7 auto / 0.3 walk split.
+
+    Iterations are recorded per time period. A cold start sets the reference count for that period, and every warm
+    start adds the difference to iterationsSaved.
+    """
+
+    def __init__(self):
+        self.__states = dict()
+        self.__coldIterations = dict()
+        self.iterations = dict()
+        self.iterationsSaved = 0
+
+    def __contains__(self, timePeriod):
+        return timePeriod in self.__states
+
+    def __len__(self):
+        return len(self.__states)
+
+    def save(self, timePeriod, demand: Demand, microtypes: MicrotypeCollection):
+        self.__states[timePeriod] = EquilibriumState.fromModel(demand, microtypes)
+
+    def restore(self, timePeriod, demand: Demand, microtypes: MicrotypeCollection) -> bool:
+        if timePeriod in self.__states:
+            self.__states[timePeriod].applyTo(demand, microtypes)
+            return True
+        else:
+            return False
+
+    def reset(self, timePeriod=None):
+        if timePeriod is None:
+            self.__states = dict()
+        else:
+            self.__states.pop(timePeriod, None)
+
+    def recordIterations(self, timePeriod, iterations: int, warm: bool):
+        self.iterations[timePeriod] = iterations
+        if not warm:
+            self.__coldIterations[timePeriod] = iterations
+        elif timePeriod in self.__coldIterations:
+            self.iterationsSaved += max(self.__coldIterations[timePeriod] - iterations, 0)
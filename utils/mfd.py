@@ -0,0 +1,331 @@
+import logging
+
+import numpy as np
+from scipy.integrate import solve_ivp
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+logger = logging.getLogger(__name__)
+
+
+class MFDTimeStepper:
+    """
+    Time stepping of the transition matrix MFD used by MicrotypeCollection.transitionMatrixMFD.
+
+    integrator selects the scheme:
+    "euler": fixed step explicit Euler with spillback (the original scheme). The scratch arrays used inside a time
+        step are allocated once and reused across calls, and if numba is installed and useNumba is True the whole
+        loop runs as a compiled kernel instead.
+    "RK45" / "LSODA": adaptive scipy.integrate.solve_ivp, with the dense output sampled onto the reporting grid.
+        rtol and atol (in vehicles) control the step size, so near steady state far fewer steps are taken.
+    "semi-implicit": linearly implicit Euler on the reporting grid, which stays stable in congested regimes.
+
+    Indices:
+    i: microtype
+    t: time step
+    """
+
+    integrators = ("euler", "RK45", "LSODA", "semi-implicit")
+
+    def __init__(self, useNumba=False, integrator="euler", rtol=1e-3, atol=1.0):
+        self.useNumba = useNumba and (njit is not None)
+        self.integrator = integrator
+        self.rtol = rtol
+        self.atol = atol
+        self.nfev = 0
+        self.__nMicrotypes = -1
+        self.__buffers = dict()
+
+    @property
+    def integrator(self):
+        return self.__integrator
+
+    @integrator.setter
+    def integrator(self, integrator: str):
+        if integrator not in self.integrators:
+            raise ValueError("Unknown MFD integrator {0}, expected one of {1}".format(integrator, self.integrators))
+        self.__integrator = integrator
+
+    def allocate(self, nMicrotypes: int):
+        if nMicrotypes != self.__nMicrotypes:
+            self.__nMicrotypes = nMicrotypes
+            self.__buffers = {key: np.zeros(nMicrotypes, dtype=float) for key in
+                              ['n', 'nEff', 'v', 'flow', 'inflow', 'requestedN', 'ends', 'criticalN', 'endPortion']}
+            self.__buffers['mask'] = np.zeros(nMicrotypes, dtype=bool)
+
+    def run(self, n_init: np.ndarray, X: np.ndarray, L: np.ndarray, V_0: np.ndarray, N_0: np.ndarray,
+            n_other: np.ndarray, tripStartRate: np.ndarray, dt: float, nSteps: int) -> (
+            np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+        """
+        Returns (ns, vs, inflows, outflows), each indexed by (microtype, time step). Column t holds the state at the
+        end of step t, i.e. at time (t + 1) * dt. The number of right hand side evaluations is left in self.nfev
+        """
+        ns = np.zeros((len(n_init), nSteps), dtype=float)
+        vs = np.zeros((len(n_init), nSteps), dtype=float)
+        outflows = np.zeros((len(n_init), nSteps), dtype=float)
+        inflows = np.zeros((len(n_init), nSteps), dtype=float)
+        inflows[:, :] = np.expand_dims(tripStartRate * dt, 1)
+        if self.integrator in ("RK45", "LSODA"):
+            self.__runAdaptive(n_init, X, L, V_0, N_0, n_other, tripStartRate, dt, ns, vs, outflows)
+        elif self.integrator == "semi-implicit":
+            self.__runSemiImplicit(n_init, X, L, V_0, N_0, n_other, tripStartRate, dt, ns, vs, outflows)
+        elif self.useNumba:
+            self.nfev = nSteps
+            saturatedSteps = _eulerKernel(np.asarray(n_init, dtype=float), np.ascontiguousarray(X, dtype=float), L,
+                                          V_0, N_0, n_other, np.asarray(tripStartRate, dtype=float), dt, ns, vs,
+                                          outflows)
+            if saturatedSteps > 0:
+                logger.error("Every microtype reached jam density in %d of %d MFD time steps", saturatedSteps,
+                             nSteps)
+        else:
+            self.nfev = nSteps
+            self.__runNumpy(n_init, X, L, V_0, N_0, n_other, tripStartRate, dt, ns, vs, outflows)
+        return ns, vs, inflows, outflows
+
+    def __runAdaptive(self, n_init, X, L, V_0, N_0, n_other, tripStartRate, dt, ns, vs, outflows):
+        nSteps = ns.shape[1]
+        criticalN = N_0 - n_other
+        options = dict()
+        if self.integrator == "LSODA":
+            options["jac"] = accumulationJacobian
+        sol = solve_ivp(accumulationRate, (0.0, nSteps * dt), np.asarray(n_init, dtype=float),
+                        method=self.integrator, dense_output=True, rtol=self.rtol, atol=self.atol,
+                        args=(X, L, V_0, N_0, n_other, tripStartRate, criticalN), **options)
+        self.nfev = sol.nfev
+        ns[:, :] = sol.sol(np.arange(1, nSteps + 1) * dt)
+        np.clip(ns, 0.0, criticalN[:, None], out=ns)
+        self.__fillOutputs(X, L, V_0, N_0, n_other, dt, ns, vs, outflows)
+
+    def __runSemiImplicit(self, n_init, X, L, V_0, N_0, n_other, tripStartRate, dt, ns, vs, outflows):
+        criticalN = N_0 - n_other
+        identity = np.eye(len(n_init))
+        n_t = np.array(n_init, dtype=float)
+        for i in range(ns.shape[1]):
+            flow = speed(n_t, V_0, N_0, n_other) * n_t / L
+            inflow = X @ flow
+            jacobian = accumulationJacobian(0.0, n_t, X, L, V_0, N_0, n_other)
+            dn = np.linalg.solve(identity - dt * jacobian, tripStartRate + inflow - flow)
+            requestedN = n_t + dn * dt
+            if np.any(requestedN > criticalN):
+                requestedN = spillback(requestedN, N_0, inflow, n_other, 1.0)
+            n_t = requestedN
+            n_t[n_t < 0] = 0.0
+            ns[:, i] = n_t
+        self.nfev = ns.shape[1]
+        self.__fillOutputs(X, L, V_0, N_0, n_other, dt, ns, vs, outflows)
+
+    @staticmethod
+    def __fillOutputs(X, L, V_0, N_0, n_other, dt, ns, vs, outflows):
+        endPortion = 1 - np.sum(X, axis=0)
+        vs[:, :] = speed(ns, V_0[:, None], N_0[:, None], n_other[:, None])
+        outflows[:, :] = (endPortion * np.transpose(vs) * np.transpose(ns) / L).T * dt
+
+    def __speed(self, n, V_0, N_0, n_other, out, minspeed=0.005):
+        nEff = self.__buffers['nEff']
+        mask = self.__buffers['mask']
+        np.add(n, n_other, out=nEff)
+        np.divide(nEff, N_0, out=out)
+        np.subtract(1., out, out=out)
+        np.multiply(V_0, out, out=out)
+        np.less(out, minspeed, out=mask)
+        np.copyto(out, minspeed, where=mask)
+        np.greater(out, V_0, out=mask)
+        np.copyto(out, V_0, where=mask)
+        return out
+
+    def __runNumpy(self, n_init, X, L, V_0, N_0, n_other, tripStartRate, dt, ns, vs, outflows):
+        self.allocate(len(n_init))
+        n_t = self.__buffers['n']
+        v = self.__buffers['v']
+        flow = self.__buffers['flow']
+        inflow = self.__buffers['inflow']
+        requestedN = self.__buffers['requestedN']
+        ends = self.__buffers['ends']
+        criticalN = self.__buffers['criticalN']
+        endPortion = self.__buffers['endPortion']
+        mask = self.__buffers['mask']
+
+        np.copyto(n_t, n_init)
+        np.subtract(N_0, n_other, out=criticalN)
+        np.subtract(1, np.sum(X, axis=0), out=endPortion)
+
+        for i in range(ns.shape[1]):
+            self.__speed(n_t, V_0, N_0, n_other, v)
+            np.multiply(v, n_t, out=flow)
+            np.divide(flow, L, out=flow)
+            np.dot(X, flow, out=inflow)
+
+            np.add(tripStartRate, inflow, out=requestedN)
+            np.subtract(requestedN, flow, out=requestedN)
+            np.multiply(requestedN, dt, out=requestedN)
+            np.add(requestedN, n_t, out=requestedN)
+            np.greater(requestedN, criticalN, out=mask)
+            if mask.any():
+                requestedN = spillback(requestedN, N_0, inflow, n_other, 1.0)
+            np.copyto(n_t, requestedN)
+            requestedN = self.__buffers['requestedN']
+
+            self.__speed(n_t, V_0, N_0, n_other, v)
+            np.multiply(endPortion, v, out=ends)
+            np.multiply(ends, n_t, out=ends)
+            np.divide(ends, L, out=ends)
+            np.less(n_t, 0, out=mask)
+            np.copyto(n_t, 0.0, where=mask)
+
+            ns[:, i] = n_t
+            vs[:, i] = self.__speed(n_t, V_0, N_0, n_other, v)
+            outflows[:, i] = np.multiply(ends, dt, out=ends)
+
+
+def speed(n, V_0, N_0, n_other, minspeed=0.005) -> np.ndarray:
+    v = V_0 * (1. - (n + n_other) / N_0)
+    return np.clip(v, minspeed, V_0)
+
+
+def accumulationRate(t, n, X, L, V_0, N_0, n_other, tripStartRate, criticalN, spillbackRamp=0.01) -> np.ndarray:
+    """
+    Right hand side dn/dt for the adaptive integrators. Microtypes approaching their critical accumulation pass
+    the excess on to the others in proportion to their inflow, the continuous version of spillback. The cut in
+    growth is ramped in over the last spillbackRamp of capacity so the right hand side stays continuous.
+    """
+    n = np.maximum(n, 0.0)
+    flow = speed(n, V_0, N_0, n_other) * n / L
+    inflow = X @ flow
+    dn = tripStartRate + inflow - flow
+    blocked = np.clip((n - (1. - spillbackRamp) * criticalN) / (spillbackRamp * criticalN), 0.0, 1.0)
+    blocked[dn <= 0] = 0.0
+    if np.any(blocked > 0):
+        spilled = blocked * dn
+        toBeLimited = (1. - blocked) * inflow
+        dn -= spilled
+        if np.sum(toBeLimited) > 0:
+            dn += toBeLimited * np.sum(spilled) / np.sum(toBeLimited)
+    return dn
+
+
+def accumulationJacobian(t, n, X, L, V_0, N_0, n_other, *args) -> np.ndarray:
+    """
+    d(dn/dt)/dn ignoring spillback, takes the same arguments as accumulationRate. The derivative of the outflow is
+    taken as v / L where the speed sits at one of its bounds.
+    """
+    n = np.maximum(n, 0.0)
+    v = speed(n, V_0, N_0, n_other)
+    dFlow = np.where((v > 0.005) & (v < V_0), v - V_0 * n / N_0, v) / L
+    return (X - np.eye(len(n))) * dFlow
+
+
+def spillback(requestedN: np.ndarray, N_0: np.ndarray, inflow: np.ndarray, n_other=0.0,
+              criticalDensity=0.9) -> np.ndarray:
+    """
+    Caps accumulations that would exceed the critical accumulation and spreads the excess over the microtypes that
+    are still below it, in proportion to their inflow. Only called on the (rare) time steps where a cap is hit.
+    """
+    requestedN = requestedN.copy()
+    criticalN = criticalDensity * (N_0 - n_other)
+    overLimit = requestedN > criticalN
+    counter = 0
+    vals = None
+    while np.any(overLimit):
+        if np.all(overLimit):
+            if counter == 0:
+                vals = np.linspace(criticalDensity, 1.0, 5)
+            if counter <= 1:
+                criticalDensity = vals[counter]
+                criticalN = criticalDensity * (N_0 - n_other)
+                counter += 1
+            else:
+                logger.error("Every microtype reached jam density, capping all accumulations")
+                return criticalN
+        totalSpillback = np.sum(requestedN[overLimit] - criticalN[overLimit])
+        toBeLimited = inflow[~overLimit]
+        requestedN[~overLimit] += inflow[~overLimit] * totalSpillback / np.sum(
+            toBeLimited)  # TODO: Matrix math here?
+        requestedN[overLimit] = criticalN[overLimit]
+        overLimit = (requestedN / N_0) > criticalN
+    return requestedN
+
+
+def _eulerLoop(n_init, X, L, V_0, N_0, n_other, tripStartRate, dt, ns, vs, outflows):
+    nMicrotypes = n_init.shape[0]
+    n_t = n_init.copy()
+    v = np.zeros(nMicrotypes)
+    flow = np.zeros(nMicrotypes)
+    requestedN = np.zeros(nMicrotypes)
+    ends = np.zeros(nMicrotypes)
+    endPortion = np.ones(nMicrotypes)
+    overLimit = np.zeros(nMicrotypes, dtype=np.bool_)
+    saturatedSteps = 0
+    for j in range(nMicrotypes):
+        for k in range(nMicrotypes):
+            endPortion[k] -= X[j, k]
+
+    for i in range(ns.shape[1]):
+        for j in range(nMicrotypes):
+            v[j] = _speed(n_t[j], V_0[j], N_0[j], n_other[j])
+            flow[j] = v[j] * n_t[j] / L[j]
+        anyOver = False
+        for j in range(nMicrotypes):
+            inflow = 0.0
+            for k in range(nMicrotypes):
+                inflow += X[j, k] * flow[k]
+            requestedN[j] = (tripStartRate[j] + inflow - flow[j]) * dt + n_t[j]
+            overLimit[j] = requestedN[j] > N_0[j] - n_other[j]
+            anyOver = anyOver or overLimit[j]
+        if anyOver:
+            # Same rules as spillback() with criticalDensity = 1
+            criticalDensity = 1.0
+            counter = 0
+            inflows = X @ flow
+            while overLimit.any():
+                if overLimit.all():
+                    if counter <= 1:
+                        counter += 1
+                    else:
+                        # Reported by MFDTimeStepper.run, there's no logging inside a numba kernel
+                        saturatedSteps += 1
+                        for j in range(nMicrotypes):
+                            requestedN[j] = criticalDensity * (N_0[j] - n_other[j])
+                        break
+                totalSpillback = 0.0
+                toBeLimited = 0.0
+                for j in range(nMicrotypes):
+                    if overLimit[j]:
+                        totalSpillback += requestedN[j] - criticalDensity * (N_0[j] - n_other[j])
+                    else:
+                        toBeLimited += inflows[j]
+                for j in range(nMicrotypes):
+                    if overLimit[j]:
+                        requestedN[j] = criticalDensity * (N_0[j] - n_other[j])
+                    else:
+                        requestedN[j] += inflows[j] * totalSpillback / toBeLimited
+                for j in range(nMicrotypes):
+                    overLimit[j] = (requestedN[j] / N_0[j]) > criticalDensity * (N_0[j] - n_other[j])
+        for j in range(nMicrotypes):
+            n_t[j] = requestedN[j]
+            ends[j] = endPortion[j] * _speed(n_t[j], V_0[j], N_0[j], n_other[j]) * n_t[j] / L[j]
+            if n_t[j] < 0:
+                n_t[j] = 0.0
+            ns[j, i] = n_t[j]
+            vs[j, i] = _speed(n_t[j], V_0[j], N_0[j], n_other[j])
+            outflows[j, i] = ends[j] * dt
+    return saturatedSteps
+
+
+def _speedScalar(n, v_0, n_0, n_other, minspeed=0.005):
+    v = v_0 * (1. - (n + n_other) / n_0)
+    if v < minspeed:
+        v = minspeed
+    if v > v_0:
+        v = v_0
+    return v
+
+
+if njit is not None:
+    _speed = njit(cache=True)(_speedScalar)
+    _eulerKernel = njit(cache=True)(_eulerLoop)
+else:
+    _speed = _speedScalar
+    _eulerKernel = _eulerLoop
@@ -7,7 +7,9 @@ import pandas as pd
 
 from .OD import TransitionMatrix, Allocation
 from .choiceCharacteristics import ChoiceCharacteristics
-from .network import Network, NetworkCollection, Costs, TotalOperatorCosts, CollectedNetworkStateData
+from .mfd import MFDTimeStepper
+from .network import Network, NetworkCollection, Costs, TotalOperatorCosts, CollectedNetworkStateData, \
+    NetworkModeData
 
 
 class CollectedTotalOperatorCosts:
@@ -204,22 +206,51 @@ class Microtype:
 
 
 class MicrotypeCollection:
-    def __init__(self, scenarioData):
+    def __init__(self, scenarioData, useNumba=False, integrator="euler", rtol=1e-3, atol=1.0):
         self.__timeStepInSeconds = 30.0
+        self.__timeStepper = MFDTimeStepper(useNumba, integrator, rtol, atol)
         self.__microtypes = dict()
         self.__scenarioData = scenarioData
-        self.modeData = scenarioData["modeData"]
+        self.modeData = scenarioData.modeParameters
         self.transitionMatrix = None
         self.collectedNetworkStateData = CollectedNetworkStateData()
         self.__modeToMicrotype = dict()
         self.__numpyDemand = np.ndarray([0])
         self.__numpySpeed = np.ndarray([0])
         self.__diameters = np.ndarray([0])
+        self.__networkModeData = NetworkModeData(0, scenarioData.modeToIdx)
+        self.__subNetworkVersion = 0
+        self.__modeDataVersions = dict()
+        self.__modeAvailability = None
 
     @property
     def diToIdx(self):
         return self.__scenarioData.diToIdx
 
+    @property
+    def integrator(self):
+        return self.__timeStepper.integrator
+
+    @integrator.setter
+    def integrator(self, integrator: str):
+        self.__timeStepper.integrator = integrator
+
+    @property
+    def rtol(self):
+        return self.__timeStepper.rtol
+
+    @rtol.setter
+    def rtol(self, rtol: float):
+        self.__timeStepper.rtol = rtol
+
+    @property
+    def atol(self):
+        return self.__timeStepper.atol
+
+    @atol.setter
+    def atol(self, atol: float):
+        self.__timeStepper.atol = atol
+
     @property
     def odiToIdx(self):
         return self.__scenarioData.odiToIdx
@@ -244,17 +275,34 @@ class MicrotypeCollection:
     def numpySpeed(self):
         return self.__numpySpeed
 
+    @property
+    def networkModeData(self):
+        return self.__networkModeData
+
     def updateNumpyDemand(self, data):
         np.copyto(self.__numpyDemand, data)
 
+    def updateNumpySpeed(self, data):
+        np.copyto(self.__numpySpeed, data)
+
     def updateNetworkData(self):
+        """
+        Networks and modes read the scenario inputs through views of the shared SubNetworkParameters and
+        ModeParameters arrays, so only the modes depending on a subnetwork or parameter edited since the last call
+        redo what they derive from them (bus operating lengths).
+        """
+        subNetworkParameters = self.__scenarioData.subNetworkParameters
+        subNetworkParameters.update()
+        changedSubNetworks = subNetworkParameters.changedSince(self.__subNetworkVersion)
+        self.__subNetworkVersion = subNetworkParameters.version
+        changedParameters = dict()
+        for modeName, modeParameters in self.modeData.items():
+            modeParameters.update()
+            changedParameters[modeName] = modeParameters.changedSince(self.__modeDataVersions.get(modeName, 0))
+            self.__modeDataVersions[modeName] = modeParameters.version
         for m in self.__microtypes.values():
             # assert isinstance(m, Microtype)
-            m.networks.updateModeData()
-            m.networks.updateNetworkData()
-            for _, n in m.networks:
-                # assert isinstance(n, Network)
-                n.updateScenarioInputs()
+            m.networks.updateModeData(changedSubNetworks, changedParameters)
 
     def __setitem__(self, key: str, value: Microtype):
         self.__microtypes[key] = value
@@ -282,7 +330,7 @@ class MicrotypeCollection:
     def importMicrotypes(self):
         # uniqueMicrotypes = subNetworkData["MicrotypeID"].unique()
 
-        subNetworkData = self.__scenarioData["subNetworkData"]
+        subNetworkData = self.__scenarioData.subNetworkParameters
         subNetworkCharacteristics = self.__scenarioData["subNetworkDataFull"]
         modeToSubNetworkData = self.__scenarioData["modeToSubNetworkData"]
         microtypeData = self.__scenarioData["microtypeIDs"]
@@ -300,6 +348,7 @@ class MicrotypeCollection:
             self.__numpyDemand = np.zeros(
                 (len(self.microtypeIdToIdx), len(self.modeToIdx), len(self.dataToIdx)), dtype=float)
             self.__numpySpeed = np.zeros((len(self.microtypeIdToIdx), len(self.modeToIdx)), dtype=float)
+            self.__networkModeData = NetworkModeData(len(subNetworkData.values), self.modeToIdx)
             self.__modeToMicrotype = dict()
 
         for microtypeID, diameter in microtypeData.itertuples(index=False):
@@ -314,7 +363,7 @@ class MicrotypeCollection:
                         modeToSubNetworkData['SubnetworkID'] == idx]
                     subNetwork = Network(subNetworkData, subNetworkCharacteristics, idx, diameter, microtypeID,
                                          self.__numpySpeed[self.microtypeIdToIdx[microtypeID], :],
-                                         self.modeToIdx)
+                                         self.modeToIdx, self.__networkModeData)
                     for n in joined.itertuples():
                         subNetworkToModes.setdefault(subNetwork, []).append(n.ModeTypeID.lower())
                         allModes.add(n.ModeTypeID.lower())
@@ -342,53 +391,6 @@ class MicrotypeCollection:
         if tripStartRate is None:
             tripStartRate = self.getModeStartRatePerSecond("auto")
 
-        def v(n, v_0, n_0, n_other, minspeed=0.005) -> np.ndarray:
-            n_eff = n + n_other
-            v = v_0 * (1. - n_eff / n_0)
-            v[v < minspeed] = minspeed
-            v[v > v_0] = v_0[v > v_0]
-            return v
-
-        def tripEndingRate(n, X, L, v_0, n_0, n_other) -> np.ndarray:
-            return (1 - np.sum(X, axis=0)) * v(n, v_0, n_0, n_other, 0.005) * n / L
-
-        def outflow(n, L, v_0, n_0, n_other) -> np.ndarray:
-            return v(n, v_0, n_0, n_other, 0.005) * n / L
-
-        def inflow(n, X, L, v_0, n_0, n_other) -> np.ndarray:
-            os = X @ (v(n, v_0, n_0, n_other, 0.005) * n / L)
-            return os
-
-        def spillback(n: np.ndarray, N_0: np.ndarray, demand: np.ndarray, inflow: np.ndarray, outflow: np.ndarray,
-                      dt: float, n_other=0.0, criticalDensity=0.9) -> np.ndarray:
-            requestedN = (demand + inflow - outflow) * dt + n
-            criticalN = criticalDensity * (N_0 - n_other)
-            overLimit = requestedN > criticalN
-            counter = 0
-            while np.any(overLimit):
-                if np.all(overLimit):
-                    if counter == 0:
-                        vals = np.linspace(criticalDensity, 1.0, 5)
-                    if counter <= 1:
-                        criticalDensity = vals[counter]
-                        criticalN = criticalDensity * (N_0 - n_other)
-                        counter += 1
-                    else:
-                        print('Youre Effed')
-                        return criticalN
-                before = np.sum(requestedN)
-                totalSpillback = np.sum(requestedN[overLimit] - criticalN[overLimit])
-                toBeLimited = inflow[~overLimit]
-                requestedN[~overLimit] += inflow[~overLimit] * totalSpillback / np.sum(
-                    toBeLimited)  # TODO: Matrix math here?
-                requestedN[overLimit] = criticalN[overLimit]
-                overLimit = (requestedN / N_0) > criticalN
-                after = np.sum(requestedN)
-            return requestedN
-
-        def dn(n, demand, L, X, v_0, n_0, n_other, dt) -> np.ndarray:
-            return (demand + inflow(n, X, L, v_0, n_0, n_other) - outflow(n, L, v_0, n_0, n_other)) * dt
-
         # print(tripStartRate)
         characteristicL = np.zeros((len(self)), dtype=float)
         V_0 = np.zeros((len(self)), dtype=float)
@@ -411,32 +413,12 @@ class MicrotypeCollection:
                     n_init[idx] = networkStateData.initialAccumulation
         #            tripStartRate[idx] = microtype.getModeStartRate("auto") / 3600.
 
-        X = np.transpose(self.transitionMatrix.matrix.values)
+        X = self.transitionMatrix.transposed
 
         dt = self.__timeStepInSeconds
         ts = np.arange(0, durationInHours * 3600., dt)
-        ns = np.zeros((len(self), np.size(ts)), dtype=float)
-        vs = np.zeros((len(self), np.size(ts)), dtype=float)
-        inflows = np.zeros((len(self), np.size(ts)), dtype=float)
-        outflows = np.zeros((len(self), np.size(ts)), dtype=float)
-        n_t = n_init.copy()
-
-        for i, ti in enumerate(ts):
-            # deltaN = dn(n_t, tripStartRate, characteristicL, X, V_0, N_0, n_other, dt)
-            # otherval = deltaN + n_t
-            # n_t += deltaN
-            infl = inflow(n_t, X, characteristicL, V_0, N_0, n_other)
-            outfl = outflow(n_t, characteristicL, V_0, N_0, n_other)
-            n_t = spillback(n_t, N_0, tripStartRate, infl, outfl, dt, n_other, 1.0)
-            ends = tripEndingRate(n_t, X, characteristicL, V_0, N_0, n_other)
-            # print(otherval, n_t)
-            # n_t[n_t > (N_0 - n_other)] = N_0[n_t > (N_0 - n_other)]
-            n_t[n_t < 0] = 0.0
-            # pct = n_t / N_0
-            ns[:, i] = np.squeeze(n_t)
-            vs[:, i] = np.squeeze(v(n_t, V_0, N_0, n_other))
-            inflows[:, i] = np.squeeze(tripStartRate * dt)
-            outflows[:, i] = np.squeeze(ends * dt)
+        ns, vs, inflows, outflows = self.__timeStepper.run(n_init, X, characteristicL, V_0, N_0, n_other,
+                                                           tripStartRate, dt, np.size(ts))
 
         # self.transitionMatrix.setAverageSpeeds(np.mean(vs, axis=1))
         averageSpeeds = np.sum(ns * vs, axis=1) / np.sum(ns, axis=1)
@@ -465,6 +447,34 @@ class MicrotypeCollection:
     def __iter__(self) -> (str, Microtype):
         return iter(self.__microtypes.items())
 
+    def getModeAvailability(self, trips) -> np.ndarray:
+        """
+        (OD index, mode) mask of the modes available in both the origin and the destination microtype of each trip.
+        ODIs without a trip, or without an origin or destination, keep every mode.
+        """
+        if self.__modeAvailability is None:
+            microtypeModes = np.zeros((len(self.microtypeIdToIdx), len(self.modeToIdx)), dtype=bool)
+            for microtypeID, microtype in self:
+                for mode in microtype.mode_names:
+                    microtypeModes[self.microtypeIdToIdx[microtypeID], self.modeToIdx[mode]] = True
+            self.__modeAvailability = np.ones((len(self.odiToIdx), len(self.modeToIdx)), dtype=bool)
+            for odi, _ in trips:
+                if odi.o != 'None' and odi.d != 'None':
+                    self.__modeAvailability[self.odiToIdx[odi], :] = microtypeModes[self.microtypeIdToIdx[odi.o], :] & \
+                                                                     microtypeModes[self.microtypeIdToIdx[odi.d], :]
+        return self.__modeAvailability
+
+    def getStartAndEndCosts(self, nParams: int) -> (np.ndarray, np.ndarray):
+        """ Choice characteristics added at the start and end of a trip, by (microtype, mode, parameter) """
+        starts = np.zeros((len(self.microtypeIdToIdx), len(self.modeToIdx), nParams), dtype=float)
+        ends = np.zeros_like(starts)
+        for microtypeID, microtype in self:
+            idx = self.microtypeIdToIdx[microtypeID]
+            for mode in microtype.mode_names:
+                microtype.addStartTimeCostWait(mode, ChoiceCharacteristics(data=starts[idx, self.modeToIdx[mode], :]))
+                microtype.addEndTimeCostWait(mode, ChoiceCharacteristics(data=ends[idx, self.modeToIdx[mode], :]))
+        return starts, ends
+
     def getModeSpeeds(self) -> dict:
         return {mode: {microtypeId: self.__numpySpeed[microtypeIdx, modeIdx] for microtypeId, microtypeIdx in
                        self.microtypeIdToIdx.items()} for mode, modeIdx in self.modeToIdx.items()}
@@ -487,6 +497,15 @@ class MicrotypeCollection:
         for mID, microtype in self:
             networkStateData.adoptPreviousMicrotypeState(microtype)
 
+    def importInitialStates(self, states: dict):
+        """ Start from (accumulation, speed, time) by (microtypeID, modes), as given by getFinalStates, or empty """
+        for mID, microtype in self:
+            for modes, network in microtype.networks:
+                if (mID, modes) in states:
+                    network.setInitialState(*states[(mID, modes)])
+                else:
+                    network.setInitialState()
+
     def resetStateData(self):
         for _, nsd in self.collectedNetworkStateData:
             nsd.reset()
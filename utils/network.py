@@ -3,7 +3,7 @@ from typing import List, Dict
 
 import numpy as np
 import pandas as pd
-from scipy.optimize import minimize
+from scipy.optimize import minimize, brentq
 
 from utils.supply import TravelDemand, TravelDemands
 
@@ -12,6 +12,78 @@ np.seterr(all='ignore')
 mph2mps = 1609.34 / 3600
 
 
+def accumulationEvolution(L, L_blocked, jamDensity, freeFlowSpeed, N_init, Q, L_0=10 * 1609.34, t=3 * 3600.):
+    """
+    Closed form solution of dN/dt = Q - V(N) N / L_0 with the linear MFD V(N) = V_0 (1 - N / N_0), for a subnetwork
+    with nonzero flow. Below capacity N approaches the stable steady state (cosh / sinh branch), above it there is
+    none (cos / sin branch). Returns the speed, which is the mean of the initial and final MFD speeds, along with the
+    final accumulation and the initial, final and steady state speeds. Network.NEF calls this once per subnetwork
+    inside the equilibrium loop, so it uses the math module rather than NumPy.
+    """
+    N_0 = jamDensity * (L - L_blocked)
+    V_0 = freeFlowSpeed
+    discriminant = N_0 ** 2. / 4. - N_0 * Q / V_0
+    A = sqrt(abs(discriminant))
+    var = A * V_0 * t / (N_0 * L_0)
+    if discriminant >= 0:
+        c, s = cosh(var), sinh(var)
+        V_steadyState = V_0 * (1. - (N_0 / 2 - A) / N_0)
+    else:
+        c, s = cos(var), sin(var)
+        V_steadyState = 0.0
+    N_final = N_0 / 2 - A * ((N_0 / 2 - N_init) * c + A * s) / ((N_0 / 2 - N_init) * s + A * c)
+    V_init = V_0 * (1. - N_init / N_0)
+    V_final = V_0 * (1. - N_final / N_0)
+    speed = (V_init + V_final) / 2.0
+    return max(0.1, speed), N_final, V_init, V_final, V_steadyState
+
+
+def busOperatingLengths(L, dedicated, coverage):
+    """
+    Length of each subnetwork of a bus route that buses operate on. Dedicated subnetworks are covered in full and the
+    rest of the route (coverage times the total subnetwork length, less the dedicated length) is spread over the
+    others in proportion to their length. Returns the operating lengths and the route length.
+    """
+    L = np.asarray(L, dtype=float)
+    dedicated = np.asarray(dedicated, dtype=bool)
+    totalDistance = np.sum(L)
+    dedicatedDistance = np.sum(L[dedicated])
+    shared = (coverage * totalDistance - dedicatedDistance) * (L / (totalDistance - dedicatedDistance))
+    operatingL = np.where(dedicated, L, np.where(shared > 0, shared, 0.0))
+    return operatingL, totalDistance * coverage
+
+
+def busSubNetworkSpeeds(operatingL, dedicated, baseSpeed, routeLength, headway, stopSpacing, minStopTime,
+                        passengerWait, passengerWaitDedicated, tripRate):
+    """
+    Bus speed on each subnetwork of a route given the traffic speed there, counting the time stopped at stops and
+    boarding. routeLength, the BusMode parameters and tripRate (the trip start plus end rate per hour) are the
+    route's.
+    """
+    perPassenger = np.where(dedicated, passengerWaitDedicated, passengerWait)
+    numberOfStopsInSubnetwork = operatingL / stopSpacing
+    numberOfStopsInRoute = routeLength / stopSpacing
+    passengersPerStop = tripRate / numberOfStopsInRoute * headway / 3600.
+    stoppingTime = numberOfStopsInSubnetwork * minStopTime
+    stoppedTime = perPassenger * passengersPerStop * numberOfStopsInSubnetwork + stoppingTime
+    drivingTime = operatingL / baseSpeed
+    speed = operatingL / (stoppedTime + drivingTime)
+    return np.where(np.isnan(speed), 0.1, speed)
+
+
+def busBlockedDistances(operatingL, dedicated, baseSpeed, avgLinkLength, routeLength, routeAveragedSpeed, headway,
+                        stopSpacing, minStopTime, passengerWait, passengerWaitDedicated, tripRate):
+    """ Distance on each subnetwork of a route blocked by buses at stops """
+    perPassenger = np.where(dedicated, passengerWaitDedicated, passengerWait)
+    numberOfStops = routeLength / stopSpacing
+    meanTimePerStop = minStopTime + headway * perPassenger * tripRate / (numberOfStops * 3600.0)
+    portionOfTimeStopped = meanTimePerStop * meanTimePerStop / headway
+    portionOfTimeStopped = np.where(1.0 < portionOfTimeStopped, 1.0, portionOfTimeStopped)
+    # TODO: Think through this more fully. Is this the right way to scale up this time to distance?
+    blocked = portionOfTimeStopped * avgLinkLength * (operatingL / routeAveragedSpeed / headway)
+    return np.where(baseSpeed > 0, blocked, 0.0)
+
+
 class TotalOperatorCosts:
     def __init__(self):
         self.__costs = dict()
@@ -69,6 +141,107 @@ class Costs:
         self.vottMultiplier = vott_multiplier
 
 
+class ParameterTable:
+    """
+    A table of scenario inputs as a float array, with one row per entry of the DataFrame's index and one column per
+    parameter. Objects that read from the table hold row views of the same array, so nothing has to be copied when
+    the scenario is edited.
+
+    Edits made through set() go to both the DataFrame and the array and bump version. update() copies over edits
+    made directly to the DataFrame. changedSince(version) lists the rows (by index label) edited after a given
+    version.
+    """
+
+    def __init__(self, data: pd.DataFrame):
+        self.data = data
+        self.idToIdx = {rowID: idx for idx, rowID in enumerate(data.index)}
+        self.columnToIdx = {column: idx for idx, column in enumerate(data.columns)}
+        self.__values = data.to_numpy(dtype=float)
+        self.__changedAt = dict()
+        self.version = 0
+
+    @property
+    def values(self) -> np.ndarray:
+        return self.__values
+
+    def row(self, rowID) -> np.ndarray:
+        return self.__values[self.idToIdx[rowID], :]
+
+    def __getitem__(self, item):
+        rowID, column = item
+        return self.__values[self.idToIdx[rowID], self.columnToIdx[column]]
+
+    def set(self, rowID, column, value):
+        self.data.at[rowID, column] = value
+        self.__values[self.idToIdx[rowID], self.columnToIdx[column]] = value
+        self.version += 1
+        self.__changedAt[rowID] = self.version
+
+    def update(self):
+        newValues = self.data.to_numpy(dtype=float)
+        changed = np.any(newValues != self.__values, axis=1)
+        if np.any(changed):
+            np.copyto(self.__values, newValues)
+            self.version += 1
+            for idx in np.flatnonzero(changed):
+                self.__changedAt[self.data.index[idx]] = self.version
+
+    def changedSince(self, version: int) -> set:
+        return {rowID for rowID, changedAt in self.__changedAt.items() if changedAt > version}
+
+
+class ModeParameters(ParameterTable):
+    """ One mode's parameter table, with one row per microtype. Every mode object for this mode reads a row of it """
+
+    @property
+    def microtypeIdToIdx(self) -> dict:
+        return self.idToIdx
+
+
+class SubNetworkParameters(ParameterTable):
+    """ The subnetwork table (Length, vMax, densityMax, avgLinkLength), with one row per subnetwork """
+
+    @property
+    def subNetworkIdToIdx(self) -> dict:
+        return self.idToIdx
+
+
+class NetworkModeData:
+    """
+    VMT, effective accumulation, blocked distance and speed of each mode on each subnetwork, as (nSubNetwork x nMode)
+    arrays. MicrotypeCollection owns one for all of its subnetworks. Each Network works on views of its row and each
+    Mode on views of its column, so totals over modes are sums along axis 1.
+    """
+
+    def __init__(self, nSubNetworks: int, modeToIdx: dict):
+        self.modeToIdx = modeToIdx
+        self.VMT = np.zeros((nSubNetworks, len(modeToIdx)), dtype=float)
+        self.N_eff = np.zeros((nSubNetworks, len(modeToIdx)), dtype=float)
+        self.L_blocked = np.zeros((nSubNetworks, len(modeToIdx)), dtype=float)
+        self.speed = np.zeros((nSubNetworks, len(modeToIdx)), dtype=float)
+
+    def copy(self):
+        out = NetworkModeData(len(self.VMT), self.modeToIdx)
+        out.copyFrom(self)
+        return out
+
+    def copyFrom(self, other):
+        """ Overwrite in place, so that the views held by networks and modes see the new values """
+        np.copyto(self.VMT, other.VMT)
+        np.copyto(self.N_eff, other.N_eff)
+        np.copyto(self.L_blocked, other.L_blocked)
+        np.copyto(self.speed, other.speed)
+
+    def getTotalVMT(self) -> np.ndarray:
+        return np.sum(self.VMT, axis=1)
+
+    def getTotalAccumulation(self) -> np.ndarray:
+        return np.sum(self.N_eff, axis=1)
+
+    def getTotalBlockedDistance(self) -> np.ndarray:
+        return np.sum(self.L_blocked, axis=1)
+
+
 class Mode:
     def __init__(self, networks=None, params=None, idx=None, name=None, travelDemandData=None, speedData=None):
         self.name = name
@@ -77,22 +250,42 @@ class Mode:
         # self._inds = self.initInds(idx)
         self.networks = networks
         # self._N_tot = 0.0
-        self._N_eff = dict()
-        self._L_blocked = dict()
+        self._N_eff = np.zeros(0)
+        self._L_blocked = np.zeros(0)
         self._averagePassengerDistanceInSystem = 0.0
         self._VMT_tot = 0.0
-        self._VMT = dict()
-        self._speed = dict()
+        self._VMT = np.zeros(0)
+        self._speed = np.zeros(0)
         self.__bad = False
         if networks is not None:
-            for n in networks:
-                n.addMode(self)
-                self._N_eff[n] = 0.0
-                self._L_blocked[n] = 0.0
-                self._VMT[n] = 0.0
-                self._speed[n] = n.base_speed
+            self.setNetworks(networks)
         self.travelDemand = TravelDemand(travelDemandData)
         self.__speedData = speedData
+        if params is not None:
+            self.setParams(params, idx)
+
+    def setNetworks(self, networks):
+        """ Attach to networks, with _VMT, _N_eff, _L_blocked and _speed as views of this mode's NetworkModeData
+        column, indexed by Network.row """
+        self.networks = networks
+        if len(networks) > 0:
+            networkModeData = networks[0].networkModeData
+            column = networkModeData.modeToIdx[self.name]
+            self._VMT = networkModeData.VMT[:, column]
+            self._N_eff = networkModeData.N_eff[:, column]
+            self._L_blocked = networkModeData.L_blocked[:, column]
+            self._speed = networkModeData.speed[:, column]
+        for n in networks:
+            n.addMode(self)
+            self._speed[n.row] = n.base_speed
+
+    def setParams(self, params, idx):
+        if isinstance(params, pd.DataFrame):
+            params = ModeParameters(params)
+        self.params = params
+        self._idx = idx
+        self._values = params.row(idx)
+        self._columnToIdx = params.columnToIdx
 
     # def initInds(self, idx):
     #     inds = dict()
@@ -103,26 +296,30 @@ class Mode:
     @property
     def relativeLength(self):
         # return self.params.to_numpy()[self._inds["VehicleSize"]]
-        return self.params.at[self._idx, "VehicleSize"]
+        return self._values[self._columnToIdx["VehicleSize"]]
 
     @property
     def perStart(self):
         # return self.params.to_numpy()[self._inds["PerStartCost"]]
-        return self.params.at[self._idx, "PerStartCost"]
+        return self._values[self._columnToIdx["PerStartCost"]]
 
     @property
     def perEnd(self):
         # return self.params.to_numpy()[self._inds["PerEndCost"]]
-        return self.params.at[self._idx, "PerEndCost"]
+        return self._values[self._columnToIdx["PerEndCost"]]
 
     @property
     def perMile(self):
         # return self.params.to_numpy()[self._inds["PerMileCost"]]
-        return self.params.at[self._idx, "PerMileCost"]
+        return self._values[self._columnToIdx["PerMileCost"]]
 
-    def updateScenarioInputs(self):
+    def updateScenarioInputs(self, inputsChanged=True):
         pass
 
+    def dependsOn(self, changedSubNetworks: set, changedMicrotypes: set) -> bool:
+        """ Whether edits to these subnetworks or to this mode's parameters in these microtypes affect this mode """
+        return self._idx in changedMicrotypes or any(n.subNetworkID in changedSubNetworks for n in self.networks)
+
     def updateDemand(self, travelDemand=None):
         if travelDemand is None:
             travelDemand = self.travelDemand
@@ -137,8 +334,8 @@ class Mode:
         return 0.0
 
     def updateModeBlockedDistance(self):
-        for n in self.networks:
-            self._L_blocked[n] = n.L_blocked[self.name]
+        # Networks write their blocked distance into the same NetworkModeData cells this mode reads
+        pass
 
     # def addVehicles(self, n):
     #     self._N_tot += n
@@ -152,11 +349,9 @@ class Mode:
         Ltot = sum([n.L for n in self.networks])
         for n in self.networks:
             VMT = self._VMT_tot * n.L / Ltot
-            self._VMT[n] = VMT
-            n.setVMT(self.name, self._VMT[n])
+            self._VMT[n.row] = VMT
             # self._speed[n] = n.NEF()  # n.NEF(VMT * mph2mps, self.name)
-            self._N_eff[n] = VMT / self._speed[n] * self.relativeLength
-            n.setN(self.name, self._N_eff[n])
+            self._N_eff[n.row] = VMT / self._speed[n.row] * self.relativeLength
 
     # def allocateVehicles(self):
     #     """even"""
@@ -166,19 +361,20 @@ class Mode:
     #         self._N[n] = self._N_tot / n_networks
 
     def __str__(self):
-        return str([self.name + ': VMT=' + str(self._VMT_tot) + ', L_blocked=' + str(self._L_blocked)])
+        return str([self.name + ': VMT=' + str(self._VMT_tot) + ', L_blocked=' + str(
+            {str(n): self._L_blocked[n.row] for n in self.networks})])
 
     def getSpeed(self):
         return self.networks[0].getBaseSpeed()
 
     def getN(self, network):
-        return self._VMT[network] / self._speed[network] / self.relativeLength
+        return self._VMT[network.row] / self._speed[network.row] / self.relativeLength
 
     def getNs(self):
         return [self.getN(n) for n in self.networks]
 
     def getBlockedDistance(self, network):
-        return self._L_blocked[network]
+        return self._L_blocked[network.row]
 
     # def updateN(self, demand: TravelDemand):
     #     n_new = self.getLittlesLawN(demand.rateOfPmtPerHour, demand.averageDistanceInSystemInMiles)
@@ -214,22 +410,14 @@ class WalkMode(Mode):
     def __init__(self, networks, modeParams: pd.DataFrame, idx: str, travelDemandData=None, speedData=None) -> None:
         super(WalkMode, self).__init__(travelDemandData=travelDemandData)
         self.name = "walk"
-        self.params = modeParams
-        self._idx = idx
+        self.setParams(modeParams, idx)
         # self._inds = self.initInds(idx)
-        self.networks = networks
-        for n in networks:
-            n.addMode(self)
-            # self._N[n] = 0.0
-            self._L_blocked[n] = 0.0
-            self._VMT[n] = 0.0
-            self._N_eff[n] = 0.0
-            self._speed[n] = n.base_speed
+        self.setNetworks(networks)
 
     @property
     def speedInMetersPerSecond(self):
         # return self.params.to_numpy()[self._inds["PerEndCost"]]
-        return self.params.at[self._idx, "SpeedInMetersPerSecond"]
+        return self._values[self._columnToIdx["SpeedInMetersPerSecond"]]
 
     def getSpeed(self):
         return self.speedInMetersPerSecond
@@ -239,23 +427,15 @@ class BikeMode(Mode):
     def __init__(self, networks, modeParams: pd.DataFrame, idx: str, travelDemandData=None, speedData=None) -> None:
         super(BikeMode, self).__init__(travelDemandData=travelDemandData)
         self.name = "bike"
-        self.params = modeParams
-        self._idx = idx
+        self.setParams(modeParams, idx)
         # self._inds = self.initInds(idx)
-        self.networks = networks
-        for n in networks:
-            n.addMode(self)
-            # self._N[n] = 0.0
-            self._L_blocked[n] = 0.0
-            self._VMT[n] = 0.0
-            self._N_eff[n] = 0.0
-            self._speed[n] = n.base_speed
+        self.setNetworks(networks)
         self.bikeLanePreference = 2.0
 
     @property
     def speedInMetersPerSecond(self):
         # return self.params.to_numpy()[self._inds["PerEndCost"]]
-        return self.params.at[self._idx, "SpeedInMetersPerSecond"]
+        return self._values[self._columnToIdx["SpeedInMetersPerSecond"]]
 
     def getSpeed(self):
         return self.speedInMetersPerSecond
@@ -272,10 +452,10 @@ class BikeMode(Mode):
         if self._VMT_tot > 0:
             tot = 0.0
             tot_dedicated = 0.0
-            for key, val in self._VMT.items():
-                tot += val
-                if key.dedicated:
-                    tot_dedicated += val
+            for n in self.networks:
+                tot += self._VMT[n.row]
+                if n.dedicated:
+                    tot_dedicated += self._VMT[n.row]
             return tot_dedicated / tot
         else:
             return 0.0
@@ -285,46 +465,38 @@ class RailMode(Mode):
     def __init__(self, networks, modeParams: pd.DataFrame, idx: str, travelDemandData=None, speedData=None) -> None:
         super(RailMode, self).__init__(travelDemandData=travelDemandData)
         self.name = "rail"
-        self.params = modeParams
-        self._idx = idx
-        self.networks = networks
+        self.setParams(modeParams, idx)
         # self.initInds(idx)
-        for n in networks:
-            n.addMode(self)
-            # self._N[n] = 0.0
-            self._L_blocked[n] = 0.0
-            self._VMT[n] = 0.0
-            self._N_eff[n] = 0.0
-            self._speed[n] = n.base_speed
+        self.setNetworks(networks)
 
     @property
     def routeAveragedSpeed(self):
-        return self.params.at[self._idx, "SpeedInMetersPerSecond"]
+        return self._values[self._columnToIdx["SpeedInMetersPerSecond"]]
 
     @property
     def vehicleOperatingCostPerHour(self):
         # return self.params.to_numpy()[self._inds["VehicleOperatingCostsPerHour"]]
-        return self.params.at[self._idx, "VehicleOperatingCostsPerHour"]
+        return self._values[self._columnToIdx["VehicleOperatingCostsPerHour"]]
 
     @property
     def fare(self):
         # return self.params.to_numpy()[self._inds["PerStartCost"]]
-        return self.params.at[self._idx, "PerStartCost"]
+        return self._values[self._columnToIdx["PerStartCost"]]
 
     @property
     def headwayInSec(self):
         # return self.params.to_numpy()[self._inds["Headway"]]
-        return self.params.at[self._idx, "Headway"]
+        return self._values[self._columnToIdx["Headway"]]
 
     @property
     def stopSpacingInMeters(self):
         # return self.params.to_numpy()[self._inds["StopSpacing"]]
-        return self.params.at[self._idx, "StopSpacing"]
+        return self._values[self._columnToIdx["StopSpacing"]]
 
     @property
     def portionAreaCovered(self):
         # return self.params.to_numpy()[self._inds["CoveragePortion"]]
-        return self.params.at[self._idx, "CoveragePortion"]
+        return self._values[self._columnToIdx["CoveragePortion"]]
 
     def updateDemand(self, travelDemand=None):
         if travelDemand is not None:
@@ -353,34 +525,25 @@ class RailMode(Mode):
         Ltot = sum([n.L for n in self.networks])
         for n in self.networks:
             VMT = self._VMT_tot * n.L / Ltot
-            self._VMT[n] = VMT
-            n.setVMT(self.name, self._VMT[n])
-            self._speed[n] = self.routeAveragedSpeed
-            self._N_eff[n] = VMT / self._speed[n] * self.relativeLength
-            n.setN(self.name, self._N_eff[n])
+            self._VMT[n.row] = VMT
+            self._speed[n.row] = self.routeAveragedSpeed
+            self._N_eff[n.row] = VMT / self._speed[n.row] * self.relativeLength
 
 
 class AutoMode(Mode):
     def __init__(self, networks, modeParams: pd.DataFrame, idx: str, travelDemandData=None, speedData=None) -> None:
         super(AutoMode, self).__init__(travelDemandData=travelDemandData)
         self.name = "auto"
-        self.params = modeParams
-        self._idx = idx
-        self.networks = networks
+        self.setParams(modeParams, idx)
         self.MFDmode = "single"
+        self.allocationMethod = "equalSpeed"
         self.override = False
         self.__speedData = speedData
-        for n in networks:
-            n.addMode(self)
-            # self._N[n] = 0.0
-            self._L_blocked[n] = 0.0
-            self._VMT[n] = 0.0
-            self._N_eff[n] = 0.0
-            self._speed[n] = n.base_speed
+        self.setNetworks(networks)
 
     @property
     def relativeLength(self):
-        return self.params.at[self._idx, "VehicleSize"]
+        return self._values[self._columnToIdx["VehicleSize"]]
 
     def getSpeed(self):
         return self.__speedData[0]
@@ -394,6 +557,43 @@ class AutoMode(Mode):
     def bounds(self):
         return [(0.0, 1.0)] * len(self.networks)
 
+    def getSpeedWithPortion(self, network, allocation: float) -> float:
+        return network.NEF(allocation * self._VMT_tot * mph2mps, self.name)
+
+    def equalSpeedAllocation(self, xtol=1e-10):
+        """
+        Portion of VMT on each subnetwork such that every used subnetwork runs at the same speed and unused ones
+        would be slower even when empty. Brent's method finds the common speed, inverting each subnetwork's speed
+        function (also with Brent's method) for the portion that gives it. Returns None if a speed increases with
+        VMT, in which case there is no such allocation to find.
+
+        Brent's method only needs speeds, not derivatives. Network.NEF may return the MFD speed of the microtype, is
+        clamped at 0.1 m/s and switches branch at capacity, so it has no analytic derivative to hand to Newton.
+        """
+        emptySpeeds = np.array([self.getSpeedWithPortion(n, 0.0) for n in self.networks])
+        fullSpeeds = np.array([self.getSpeedWithPortion(n, 1.0) for n in self.networks])
+        if np.any(~(emptySpeeds >= fullSpeeds)):
+            return None
+        if np.all(emptySpeeds == fullSpeeds):
+            # Speeds don't depend on the allocation, so it stays wherever it starts
+            return self.x0()
+
+        def portionAtSpeed(network, emptySpeed, fullSpeed, speed):
+            if emptySpeed <= speed:
+                return 0.0
+            elif fullSpeed >= speed:
+                return 1.0
+            return brentq(lambda a: self.getSpeedWithPortion(network, a) - speed, 0.0, 1.0, xtol=xtol)
+
+        def allocation(speed):
+            return np.array([portionAtSpeed(n, v0, v1, speed) for n, v0, v1 in
+                             zip(self.networks, emptySpeeds, fullSpeeds)])
+
+        commonSpeed = brentq(lambda v: np.sum(allocation(v)) - 1.0, np.min(fullSpeeds), np.max(emptySpeeds),
+                             xtol=xtol * np.max(emptySpeeds))
+        out = allocation(commonSpeed)
+        return out / np.sum(out)
+
     def updateDemand(self, travelDemand=None):  # TODO: Why did I add this?
         if travelDemand is None:
             travelDemand = self.travelDemand
@@ -405,26 +605,25 @@ class AutoMode(Mode):
         if len(self.networks) == 1:
             if self.MFDmode == "single":
                 n = self.networks[0]
-                self._VMT[n] = self._VMT_tot
+                self._VMT[n.row] = self._VMT_tot
                 # self._speed[n] = n.NEF(self._VMT_tot * mph2mps, self.name, self.override)
-                n.setVMT(self.name, self._VMT[n])
-                self._N_eff[n] = self._VMT_tot / self._speed[n] * self.relativeLength
-                n.setN(self.name, self._N_eff[n])
+                self._N_eff[n.row] = self._VMT_tot / self._speed[n.row] * self.relativeLength
             else:
                 n = self.networks[0]
                 # self._speed[n] = n.getTransitionMatrixMeanSpeed()  # TODO: Check Units
-                self._VMT[n] = self._VMT_tot
-                n.setVMT(self.name, self._VMT[n])
-                self._N_eff[n] = n.getNetworkStateData().finalAccumulation * self.relativeLength  # TODO: take avg
-                n.setN(self.name, self._N_eff[n])
+                self._VMT[n.row] = self._VMT_tot
+                self._N_eff[n.row] = n.getNetworkStateData().finalAccumulation * self.relativeLength  # TODO: take avg
         elif len(self.networks) > 1:
-            res = minimize(self.getSpeedDifference, self.x0(), constraints=self.constraints(), bounds=self.bounds())
-            for n, a in zip(self.networks, res.x):
-                self._VMT[n] = a * self._VMT_tot
-                self._speed[n] = n.NEF(a * self._VMT_tot * mph2mps, self.name)
-                n.setVMT(self.name, self._VMT[n])
-                self._N_eff[n] = self._VMT[n] / self._speed[n]
-                n.setN(self.name, self._N_eff[n])
+            allocation = None
+            if self.allocationMethod == "equalSpeed":
+                allocation = self.equalSpeedAllocation()
+            if allocation is None:
+                allocation = minimize(self.getSpeedDifference, self.x0(), constraints=self.constraints(),
+                                      bounds=self.bounds()).x
+            for n, a in zip(self.networks, allocation):
+                self._VMT[n.row] = a * self._VMT_tot
+                self._speed[n.row] = n.NEF(a * self._VMT_tot * mph2mps, self.name)
+                self._N_eff[n.row] = self._VMT[n.row] / self._speed[n.row]
         else:
             print("OH NO!")
 
@@ -468,20 +667,10 @@ class BusMode(Mode):
     def __init__(self, networks, modeParams: pd.DataFrame, idx: str, travelDemandData=None, speedData=None) -> None:
         super(BusMode, self).__init__(travelDemandData=travelDemandData)
         self.name = "bus"
-        self.params = modeParams
-        self._idx = modeParams.index.get_loc(idx)
-        self.__params = modeParams.to_numpy()
-        self.modeParamsColumnToIdx = {i: modeParams.columns.get_loc(i) for i in modeParams.columns}
-        self.networks = networks
-        self.__operatingL = dict()
+        self.setParams(modeParams, idx)
         self.__speedData = speedData
-        for n in networks:
-            n.addMode(self)
-            self._L_blocked[n] = 0.0
-            self._VMT[n] = 0.0
-            self._N_eff[n] = 0.0
-            self._speed[n] = n.base_speed
-            self.__operatingL[n] = self.updateOperatingL(n)
+        self.setNetworks(networks)
+        self.__operatingL = self.updateOperatingLengths()
 
         self.__routeLength = self.updateRouteLength()
         self.travelDemand = TravelDemand(travelDemandData)
@@ -499,43 +688,43 @@ class BusMode(Mode):
 
     @property
     def headwayInSec(self):
-        return self.__params[self._idx, self.modeParamsColumnToIdx["Headway"]]
+        return self._values[self._columnToIdx["Headway"]]
 
     @property
     def passengerWaitInSec(self):
-        return self.__params[self._idx, self.modeParamsColumnToIdx["PassengerWait"]]
+        return self._values[self._columnToIdx["PassengerWait"]]
 
     @property
     def passengerWaitInSecDedicated(self):
-        return self.__params[self._idx, self.modeParamsColumnToIdx["PassengerWaitDedicated"]]
+        return self._values[self._columnToIdx["PassengerWaitDedicated"]]
 
     @property
     def stopSpacingInMeters(self):
-        return self.__params[self._idx, self.modeParamsColumnToIdx["StopSpacing"]]
+        return self._values[self._columnToIdx["StopSpacing"]]
 
     @property
     def minStopTimeInSec(self):
-        return self.__params[self._idx, self.modeParamsColumnToIdx["MinStopTime"]]
+        return self._values[self._columnToIdx["MinStopTime"]]
 
     @property
     def fare(self):
-        return self.__params[self._idx, self.modeParamsColumnToIdx["PerStartCost"]]
+        return self._values[self._columnToIdx["PerStartCost"]]
 
     @property
     def perStart(self):
-        return self.__params[self._idx, self.modeParamsColumnToIdx["PerStartCost"]]
+        return self._values[self._columnToIdx["PerStartCost"]]
 
     @property
     def perEnd(self):
-        return self.__params[self._idx, self.modeParamsColumnToIdx["PerEndCost"]]
+        return self._values[self._columnToIdx["PerEndCost"]]
 
     @property
     def perMile(self):
-        return self.__params[self._idx, self.modeParamsColumnToIdx["PerMileCost"]]
+        return self._values[self._columnToIdx["PerMileCost"]]
 
     @property
     def vehicleOperatingCostPerHour(self):
-        return self.__params[self._idx, self.modeParamsColumnToIdx["VehicleOperatingCostPerHour"]]
+        return self._values[self._columnToIdx["VehicleOperatingCostPerHour"]]
 
     @property
     def routeDistanceToNetworkDistance(self) -> float:
@@ -543,21 +732,19 @@ class BusMode(Mode):
         Changed January 2021: Removed need for car-only subnnetworks.
         Now buses only run on a fixed portion of the bus/car subnetwork
         """
-        return self.__params[self._idx, self.modeParamsColumnToIdx["CoveragePortion"]]
+        return self._values[self._columnToIdx["CoveragePortion"]]
 
     @property
     def relativeLength(self):
         # return self.params.to_numpy()[self._inds["VehicleSize"]]
-        return self.__params[self._idx, self.modeParamsColumnToIdx["VehicleSize"]]
+        return self._values[self._columnToIdx["VehicleSize"]]
 
-    def updateScenarioInputs(self):
-        self.__params = self.params.to_numpy()
+    def updateScenarioInputs(self, inputsChanged=True):
+        # VMT, accumulation and blocked distance are shared with the networks, which carry them over to the next solve
         for n in self.networks:
-            self._L_blocked[n] = 0.0
-            self._VMT[n] = 0.0
-            self._N_eff[n] = 0.0
-            self._speed[n] = n.base_speed
-            self.__operatingL[n] = self.updateOperatingL(n)
+            self._speed[n.row] = n.base_speed
+        if inputsChanged:
+            self.__operatingL = self.updateOperatingLengths()
 
     def updateDemand(self, travelDemand=None):
         if travelDemand is not None:
@@ -571,20 +758,22 @@ class BusMode(Mode):
     def getDemandForVmtPerHour(self):
         return self.getRouteLength() / self.headwayInSec * 3600. / 1609.34
 
+    @property
+    def tripRatePerHour(self) -> float:
+        return self.travelDemand.tripStartRatePerHour + self.travelDemand.tripEndRatePerHour
+
     def getOperatingL(self, network) -> float:
         return self.__operatingL[network]
 
     def updateOperatingL(self, network) -> float:
         """Changed January 2021: Buses only operate on a portion of subnetwork"""
-        if network.dedicated:
-            return network.L
-        else:
-            dedicatedDistance = sum([n.L for n in self.networks if n.dedicated])
-            totalDistance = sum([n.L for n in self.networks])
-            undedicatedDistance = totalDistance - dedicatedDistance
-            return max(0, (self.routeDistanceToNetworkDistance * totalDistance - dedicatedDistance) * (
-                        network.L / undedicatedDistance))
-            # return self.routeDistanceToNetworkDistance * totalDistance * network.L / (totalDistance - dedicatedDistance)
+        return self.updateOperatingLengths()[network]
+
+    def updateOperatingLengths(self) -> dict:
+        """ Operating length of each subnetwork, from busOperatingLengths with this route's subnetworks """
+        operatingL, _ = busOperatingLengths([n.L for n in self.networks], [n.dedicated for n in self.networks],
+                                            self.routeDistanceToNetworkDistance)
+        return {n: L for n, L in zip(self.networks, operatingL)}
 
     def getN(self, network=None):
         """Changed January 2021: Buses only operate on a portion of subnetwork"""
@@ -600,50 +789,27 @@ class BusMode(Mode):
         return sum([n.L for n in self.networks]) * self.routeDistanceToNetworkDistance
 
     def getSubNetworkSpeed(self, network):
-        # averageStopDuration = self.min_stop_time + self.passenger_wait * (
-        #         self.travelDemand.tripStartRate + self.travelDemand.tripEndRate) / (
-        #                               self.routeAveragedSpeed / self.stop_spacing * self.N_tot)
-        # return base_speed / (1 + averageStopDuration * base_speed / self.stop_spacing)
-        if network.dedicated:
-            perPassenger = self.passengerWaitInSecDedicated
-        else:
-            perPassenger = self.passengerWaitInSec
-        numberOfStopsInSubnetwork = self.getOperatingL(network) / self.stopSpacingInMeters
-        numberOfStopsInRoute = self.getRouteLength() / self.stopSpacingInMeters
-        pass_per_stop = (self.travelDemand.tripStartRatePerHour + self.travelDemand.tripEndRatePerHour
-                         ) / numberOfStopsInRoute * self.headwayInSec / 3600.
-        stopping_time = numberOfStopsInSubnetwork * self.minStopTimeInSec
-        stopped_time = perPassenger * pass_per_stop * numberOfStopsInSubnetwork + stopping_time
-        driving_time = self.getOperatingL(network) / network.base_speed
-        spd = self.getOperatingL(network) / (stopped_time + driving_time)
-        if np.isnan(spd):
-            spd = 0.1
-            self.__bad = True
-        else:
-            self.__bad = False
-        return spd
+        return float(busSubNetworkSpeeds(self.getOperatingL(network), network.dedicated, network.base_speed,
+                                         *self.__stopParameters()))
+
+    def getSubNetworkSpeeds(self) -> np.ndarray:
+        return busSubNetworkSpeeds(np.array([self.getOperatingL(n) for n in self.networks], dtype=float),
+                                   np.array([n.dedicated for n in self.networks], dtype=bool),
+                                   np.array([n.base_speed for n in self.networks], dtype=float),
+                                   *self.__stopParameters())
+
+    def __stopParameters(self) -> tuple:
+        """ Route inputs to busSubNetworkSpeeds and busBlockedDistances, in the order they take them """
+        return (self.getRouteLength(), self.headwayInSec, self.stopSpacingInMeters, self.minStopTimeInSec,
+                self.passengerWaitInSec, self.passengerWaitInSecDedicated, self.tripRatePerHour)
 
     def getSpeeds(self):
-        speeds = []
-        for n in self.networks:
-            if n.L == 0:
-                speeds.append(np.inf)
-            else:
-                bus_speed = self.getSubNetworkSpeed(n)
-                speeds.append(bus_speed)
-        return speeds
+        return [np.inf if n.L == 0 else spd for n, spd in zip(self.networks, self.getSubNetworkSpeeds())]
 
     def getSpeed(self):
-        meters = np.zeros(len(self.networks), dtype=float)
-        seconds = np.zeros(len(self.networks), dtype=float)
-        speeds = np.zeros(len(self.networks), dtype=float)
-        for idx, n in enumerate(self.networks):
-            if n.L > 0:
-                # n_bus = self.getN(n)
-                bus_speed = self.getSubNetworkSpeed(n)
-                meters[idx] = self.getOperatingL(n)
-                seconds[idx] = self.getOperatingL(n) / bus_speed
-                speeds[idx] = meters[idx] / seconds[idx]
+        hasLength = np.array([n.L > 0 for n in self.networks], dtype=bool)
+        meters = np.where(hasLength, [self.getOperatingL(n) for n in self.networks], 0.0)
+        seconds = np.where(hasLength, meters / self.getSubNetworkSpeeds(), 0.0)
         if np.sum(seconds) > 0:
             spd = np.sum(meters) / np.sum(seconds)
             return spd
@@ -651,30 +817,21 @@ class BusMode(Mode):
             return next(iter(self.networks)).getBaseSpeed()
 
     def calculateBlockedDistance(self, network) -> float:
-        if network.dedicated:
-            perPassenger = self.passengerWaitInSecDedicated
-        else:
-            perPassenger = self.passengerWaitInSec
-        # bs = network.base_speed
-        if network.base_speed > 0:
-            numberOfStops = self.getRouteLength() / self.stopSpacingInMeters
-            # numberOfBuses = self.getN(network)
-            meanTimePerStop = (self.minStopTimeInSec + self.headwayInSec * perPassenger * (
-                    self.travelDemand.tripStartRatePerHour + self.travelDemand.tripEndRatePerHour) / (
-                                       numberOfStops * 3600.0))
-            portionOfTimeStopped = min([meanTimePerStop * meanTimePerStop / self.headwayInSec, 1.0])
-            # TODO: Think through this more fully. Is this the right way to scale up this time to distance?
-            out = portionOfTimeStopped * network.avgLinkLength * self.getN(network)
-            # portionOfRouteBlocked = out / self.routeLength
-        else:
-            out = 0
-        return out
+        return float(self.calculateBlockedDistances([network])[0])
+
+    def calculateBlockedDistances(self, networks=None) -> np.ndarray:
+        if networks is None:
+            networks = self.networks
+        routeLength, *stopParameters = self.__stopParameters()
+        return busBlockedDistances(np.array([self.getOperatingL(n) for n in networks], dtype=float),
+                                   np.array([n.dedicated for n in networks], dtype=bool),
+                                   np.array([n.base_speed for n in networks], dtype=float),
+                                   np.array([n.avgLinkLength for n in networks], dtype=float), routeLength,
+                                   self.routeAveragedSpeed, *stopParameters)
 
     def updateModeBlockedDistance(self):
-        for n in self.networks:
-            L_blocked = self.calculateBlockedDistance(n)
-            self._L_blocked[n] = L_blocked
-            n.L_blocked[self.name] = L_blocked  # * self.getRouteLength() / n.L
+        for n, L_blocked in zip(self.networks, self.calculateBlockedDistances()):
+            self._L_blocked[n.row] = L_blocked  # * self.getRouteLength() / n.L
             n.getNetworkStateData().blockedDistance += L_blocked
 
     def assignVmtToNetworks(self):
@@ -692,20 +849,18 @@ class BusMode(Mode):
             assert isinstance(n, Network)
             if speeds[ind] >= 0:
                 VMT = self._VMT_tot * lengths[ind] / self.getRouteLength()
-                self._VMT[n] = VMT
-                n.setVMT(self.name, self._VMT[n])
+                self._VMT[n.row] = VMT
                 n.updateBaseSpeed()
-                self._speed[n] = self.getSubNetworkSpeed(n)
-                self._N_eff[n] = VMT / self._speed[n] * self.relativeLength
-                n.setN(self.name, self._N_eff[n])
-                n.getNetworkStateData().nonAutoAccumulation += self._N_eff[n]
+                self._speed[n.row] = self.getSubNetworkSpeed(n)
+                self._N_eff[n.row] = VMT / self._speed[n.row] * self.relativeLength
+                n.getNetworkStateData().nonAutoAccumulation += self._N_eff[n.row]
             else:
                 print("BAD WHY IS THIS SPEED NEGATIVE")
         self.updateCommercialSpeed()
 
     def updateCommercialSpeed(self):
         self.routeAveragedSpeed = self.getRouteLength() / sum(
-            [self.getOperatingL(n) / spd for n, spd in self._speed.items()])
+            [self.getOperatingL(n) / self._speed[n.row] for n in self.networks])
 
     def getOccupancy(self) -> float:
         return self.travelDemand.averageDistanceInSystemInMiles / (
@@ -728,21 +883,27 @@ class BusMode(Mode):
 
 class Network:
     def __init__(self, data, characteristics, idx, diameter=None, microtypeID=None, modeToMicrotypeSpeed=None,
-                 modeToIdx=None):
-        self.data = data
-        self.__data = data.to_numpy()
+                 modeToIdx=None, networkModeData=None):
+        if isinstance(data, pd.DataFrame):
+            data = SubNetworkParameters(data)
+        self.params = data
+        self.__values = data.row(idx)
         self.characteristics = characteristics
         self.charColumnToIdx = {i: characteristics.columns.get_loc(i) for i in characteristics.columns}
-        self.dataColumnToIdx = {i: data.columns.get_loc(i) for i in data.columns}
+        self.dataColumnToIdx = data.columnToIdx
         self.microtypeID = microtypeID
-        self._idx = data.index.get_loc(idx)
+        self.subNetworkID = idx
+        self._idx = data.subNetworkIdToIdx[idx]
         self.type = self.characteristics.iat[self._idx, self.charColumnToIdx["Type"]]
-        self.L_blocked = dict()
+        if networkModeData is None:
+            networkModeData = NetworkModeData(len(data.values), modeToIdx)
+        self.__networkModeData = networkModeData
+        self.L_blocked = networkModeData.L_blocked[self._idx, :]
         self._modes = dict()
         self.dedicated = characteristics.loc[idx, "Dedicated"]
         self.isJammed = False
-        self._VMT = dict()
-        self._N_eff = dict()
+        self._VMT = networkModeData.VMT[self._idx, :]
+        self._N_eff = networkModeData.N_eff[self._idx, :]
         self._networkStateData = NetworkStateData().initFromNetwork(self)
         self._N_init = 0.0
         self._N_final = 0.0
@@ -761,13 +922,18 @@ class Network:
         else:
             self.__diameter = diameter
 
-    def updateNetworkData(self):
-        self.__data = self.data.to_numpy()
-
     # @property
     # def type(self):
     #     return self.characteristics.iat[self._idx, self.charColumnToIdx["Type"]]
 
+    @property
+    def row(self):
+        return self._idx
+
+    @property
+    def networkModeData(self):
+        return self.__networkModeData
+
     @property
     def autoSpeed(self):
         return self.__modeToMicrotypeSpeed[self.__modeToIdx['auto']]
@@ -778,57 +944,53 @@ class Network:
 
     @property
     def avgLinkLength(self):
-        return self.__data[self._idx, self.dataColumnToIdx["avgLinkLength"]]
+        return self.__values[self.dataColumnToIdx["avgLinkLength"]]
 
     @property
     def freeFlowSpeed(self):
-        return self.__data[self._idx, self.dataColumnToIdx["vMax"]]
+        return self.__values[self.dataColumnToIdx["vMax"]]
 
     @property
     def jamDensity(self):
-        return self.__data[self._idx, self.dataColumnToIdx["densityMax"]]
+        return self.__values[self.dataColumnToIdx["densityMax"]]
 
     @property
     def L(self):
-        return self.__data[self._idx, self.dataColumnToIdx["Length"]]
+        return self.__values[self.dataColumnToIdx["Length"]]
 
     @property
     def diameter(self):
         return self.__diameter
 
     def __str__(self):
-        return str(tuple(self._VMT.keys()))
+        return str(tuple(self._modes.keys()))
 
     def __contains__(self, mode):
         return mode in self._modes
 
-    def updateScenarioInputs(self):
-        np.copyto(self.__data, self.data.to_numpy())
-
     def getAccumulationExcluding(self, mode: str):
-        return np.sum(acc for m, acc in self._N_eff.items() if m != mode)
+        return np.sum(self._N_eff) - self._N_eff[self.__modeToIdx[mode]]
 
     def resetAll(self):
-        self.L_blocked = dict()
+        self.L_blocked.fill(0.0)
         self._modes = dict()
         self.base_speed = self.freeFlowSpeed
         self.isJammed = False
 
     def resetModes(self):
-        for mode in self._modes.values():
-            # self.N_eq[mode.name] = mode.getN(self) * mode.params.relativeLength
-            self._VMT[mode] = mode._VMT[self]
-            self._N_eff[mode] = mode._N_eff[self]
-            self.L_blocked[mode.name] = mode.getBlockedDistance(self)
+        # VMT, accumulation and blocked distance are shared with the modes through NetworkModeData
         self.isJammed = False
         self.base_speed = self.freeFlowSpeed
         # mode.reset()
 
     def setVMT(self, mode: str, VMT: float):
-        self._VMT[mode] = VMT
+        self._VMT[self.__modeToIdx[mode]] = VMT
 
     def setN(self, mode: str, N: float):
-        self._N_eff[mode] = N
+        self._N_eff[self.__modeToIdx[mode]] = N
+
+    def setBlockedDistance(self, mode: str, L_blocked: float):
+        self.L_blocked[self.__modeToIdx[mode]] = L_blocked
 
     def updateBaseSpeed(self, override=False):
         # out = self.NEF(overrideMatrix=override)
@@ -852,49 +1014,38 @@ class Network:
                 return self.__modeToMicrotypeSpeed[self.__modeToIdx['auto']]
                 # return self._networkStateData.averageSpeed
             else:
-                if Q is None:
-                    Qtot = sum([VMT for VMT in self._VMT.values()]) * mph2mps
-                else:
-                    Qtot = Q
-                    for mode, Qmode in self._VMT.items():
-                        if mode != modeIgnored:
-                            Qtot += Qmode * mph2mps
+                Qtot = self.getTotalFlow(Q, modeIgnored)
                 if Qtot == 0:
                     return self.freeFlowSpeed
                 self._Q_curr = Qtot
-                L_tot = self.L - self.getBlockedDistance()
-                L_0 = 10 * 1609.34  # TODO: Get average distance, don't hardcode
-                t = 3 * 3600.  # TODO: Add timestep duration in seconds
-                N_0 = self.jamDensity * L_tot
-                V_0 = self.freeFlowSpeed
-                N_init = self._N_init
-                if N_0 ** 2. / 4. >= N_0 * Qtot / V_0:
-                    # Stable state
-                    A = sqrt(N_0 ** 2. / 4. - N_0 * Qtot / V_0)
-                    var = A * V_0 * t / (N_0 * L_0)
-                    N_final = N_0 / 2 - A * ((N_0 / 2 - N_init) * cosh(var) + A * sinh(var)) / (
-                            (N_0 / 2 - N_init) * sinh(var) + A * cosh(var))
-                    V_init = self.getSpeedFromMFD(N_init)
-                    V_final = self.getSpeedFromMFD(N_final)
-                    V_steadyState = self.getSpeedFromMFD(N_0 / 2 - A)
-                else:
-                    Aprime = sqrt(N_0 * Qtot / V_0 - N_0 ** 2. / 4.)
-                    var = Aprime * V_0 * t / (N_0 * L_0)
-                    N_final = N_0 / 2 - Aprime * ((N_0 / 2 - N_init) * cos(var) + Aprime * sin(var)) / (
-                            (N_0 / 2 - N_init) * sin(var) + Aprime * cos(var))
-                    V_init = self.getSpeedFromMFD(N_init)
-                    V_final = self.getSpeedFromMFD(N_final)
-                    V_steadyState = 0
-                self._networkStateData.N_final = N_final
-                self._networkStateData.V_init = V_init
-                self._networkStateData.V_final = V_final
-                self._networkStateData.V_steadyState = V_steadyState
+                speed, N_final, V_init, V_final, V_steadyState = accumulationEvolution(
+                    float(self.L), float(self.getBlockedDistance()), float(self.jamDensity),
+                    float(self.freeFlowSpeed), float(self._N_init), float(Qtot))
+                self.setEvolutionResults(N_final, V_init, V_final, V_steadyState)
                 if overrideMatrix:
-                    self.base_speed = max([0.1, (V_init + V_final) / 2.0])
-                return max([0.1, (V_init + V_final) / 2.0])  # TODO: Actually take the integral
+                    self.base_speed = speed
+                return speed
         else:
             return self.freeFlowSpeed
 
+    @property
+    def hasAnalyticNEF(self) -> bool:
+        return (self.type == 'Road') and ('auto' not in self._modes)
+
+    def getTotalFlow(self, Q=None, modeIgnored=None) -> float:
+        if Q is None:
+            return np.sum(self._VMT) * mph2mps
+        Qtot = Q + np.sum(self._VMT) * mph2mps
+        if modeIgnored is not None:
+            Qtot -= self._VMT[self.__modeToIdx[modeIgnored]] * mph2mps
+        return Qtot
+
+    def setEvolutionResults(self, N_final, V_init, V_final, V_steadyState):
+        self._networkStateData.N_final = N_final
+        self._networkStateData.V_init = V_init
+        self._networkStateData.V_final = V_final
+        self._networkStateData.V_steadyState = V_steadyState
+
     def getBaseSpeed(self):
         if self.base_speed > 0.01:
             return self.base_speed
@@ -909,16 +1060,13 @@ class Network:
         return mode in self._modes.keys()
 
     def getBlockedDistance(self) -> float:
-        if self.L_blocked:
-            return sum(list(self.L_blocked.values()))
-        else:
-            return 0.0
+        return np.sum(self.L_blocked)
 
     def addMode(self, mode: Mode):
         self._modes[mode.name] = mode
-        self.L_blocked[mode.name] = 0.0
-        self._VMT[mode.name] = 0.0
-        self._N_eff[mode.name] = 0.0
+        self.L_blocked[self.__modeToIdx[mode.name]] = 0.0
+        self._VMT[self.__modeToIdx[mode.name]] = 0.0
+        self._N_eff[self.__modeToIdx[mode.name]] = 0.0
         return self
 
     def getModeNames(self) -> list:
@@ -946,6 +1094,11 @@ class Network:
         # self._networkStateData.nonAutoAccumulation = oldNetworkStateData.nonAutoAccumulation
         # self._networkStateData.blockedDistance = oldNetworkStateData.blockedDistance
 
+    def setInitialState(self, accumulation=0.0, speed=np.inf, time=0.0):
+        self._networkStateData.initialAccumulation = accumulation
+        self._networkStateData.initialSpeed = speed
+        self._networkStateData.initialTime = time
+
 
 class NetworkCollection:
     def __init__(self, networksAndModes=None, modeToModeData=None, microtypeID=None, demandData=None, speedData=None,
@@ -972,10 +1125,6 @@ class NetworkCollection:
         self.verbose = verbose
         # self.resetModes()
 
-    def updateNetworkData(self):
-        for n in self._networks.values():
-            n.updateNetworkData()
-
     def populateNetworksAndModes(self, networksAndModes, modeToModeData, microtypeID):
         # modeToNetwork = dict()
         if isinstance(networksAndModes, Dict):
@@ -1007,17 +1156,17 @@ class NetworkCollection:
                                              travelDemandData=self.__demandData[self.__modeToIdx[modeName], :],
                                              speedData=self.__speedData[self.__modeToIdx[modeName], None]))
             elif modeName == "walk":
-                self.__speedData[self.__modeToIdx[modeName]] = params.loc[microtypeID, 'SpeedInMetersPerSecond']
+                self.__speedData[self.__modeToIdx[modeName]] = params[microtypeID, 'SpeedInMetersPerSecond']
                 self.__modes.append(WalkMode(networks, params, microtypeID,
                                              travelDemandData=self.__demandData[self.__modeToIdx[modeName], :],
                                              speedData=self.__speedData[self.__modeToIdx[modeName], None]))
             elif modeName == "bike":
-                self.__speedData[self.__modeToIdx[modeName]] = params.loc[microtypeID, 'SpeedInMetersPerSecond']
+                self.__speedData[self.__modeToIdx[modeName]] = params[microtypeID, 'SpeedInMetersPerSecond']
                 self.__modes.append(BikeMode(networks, params, microtypeID,
                                              travelDemandData=self.__demandData[self.__modeToIdx[modeName], :],
                                              speedData=self.__speedData[self.__modeToIdx[modeName], None]))
             elif modeName == "rail":
-                self.__speedData[self.__modeToIdx[modeName]] = params.loc[microtypeID, 'SpeedInMetersPerSecond']
+                self.__speedData[self.__modeToIdx[modeName]] = params[microtypeID, 'SpeedInMetersPerSecond']
                 self.__modes.append(RailMode(networks, params, microtypeID,
                                              travelDemandData=self.__demandData[self.__modeToIdx[modeName], :],
                                              speedData=self.__speedData[self.__modeToIdx[modeName], None]))
@@ -1025,9 +1174,16 @@ class NetworkCollection:
                 print("BAD!")
                 Mode(networks, params, microtypeID, "bad")
 
-    def updateModeData(self):
+    def updateModeData(self, changedSubNetworks=None, changedParameters=None):
+        """
+        Refresh every mode, or if given the IDs of edited subnetworks and a dict from mode name to the microtypes
+        whose parameters were edited, only redo the inputs of modes that depend on them
+        """
         for m in self.__modes:
-            m.updateScenarioInputs()
+            if changedSubNetworks is None:
+                m.updateScenarioInputs()
+            else:
+                m.updateScenarioInputs(m.dependsOn(changedSubNetworks, changedParameters.get(m.name, set())))
 
     def isJammed(self):
         return np.any([n.isJammed for n in self._networks])
@@ -1147,6 +1303,33 @@ class NetworkStateData:
         # self.averageSpeed = network.freeFlowSpeed
         return self
 
+    def copy(self):
+        out = NetworkStateData(self)
+        out.copyArrays()
+        return out
+
+    def copyArrays(self):
+        self.inflow = self.inflow.copy()
+        self.outflow = self.outflow.copy()
+        self.v = self.v.copy()
+        self.n = self.n.copy()
+        self.t = self.t.copy()
+
+    def adoptEquilibriumState(self, other):
+        """ Take the results of a solved time period from other, keeping this period's initial conditions """
+        self.finalAccumulation = other.finalAccumulation
+        self.finalProduction = other.finalProduction
+        self.finalSpeed = other.finalSpeed
+        self.steadyStateSpeed = other.steadyStateSpeed
+        self.nonAutoAccumulation = other.nonAutoAccumulation
+        self.blockedDistance = other.blockedDistance
+        self.inflow = other.inflow
+        self.outflow = other.outflow
+        self.v = other.v
+        self.n = other.n
+        self.t = other.t
+        self.copyArrays()
+
     def resetBlockedDistance(self):
         self.blockedDistance = 0.0
 
@@ -1197,6 +1380,16 @@ class CollectedNetworkStateData:
                     # prods.append(np.sum(val.v * val.n) * (val.t[1] - val.t[0]))
         return np.array(prods)
 
+    def copy(self):
+        out = CollectedNetworkStateData()
+        for key, val in self.__data.items():
+            out[key] = val.copy()
+        return out
+
+    def adoptEquilibriumState(self, other):
+        for key, val in self.__data.items():
+            val.adoptEquilibriumState(other[key])
+
     def addMicrotype(self, microtype):
         for modes, network in microtype.networks:
             self[(microtype.microtypeID, modes)] = network.getNetworkStateData()
@@ -1205,6 +1398,18 @@ class CollectedNetworkStateData:
         for modes, network in microtype.networks:
             network.setInitialStateData(self[(microtype.microtypeID, modes)])
 
+    def alignTimes(self, initialStates: dict):
+        """ Shift the time series to start at the times in initialStates (as given by getFinalStates), or at zero """
+        for key, val in self.__data.items():
+            if len(val.t) > 0:
+                initialTime = initialStates[key][2] if key in initialStates else 0.0
+                val.t = val.t - val.initialTime + initialTime
+                val.initialTime = initialTime
+
+    def getFinalStates(self) -> dict:
+        """ (microtypeID, modes) to the (accumulation, speed, time) the next time period starts from """
+        return {key: (val.n[-1], val.v[-1], val.t[-1]) for key, val in self.__data.items() if len(val.n) > 0}
+
     def getAutoSpeeds(self):
         speeds = []
         ns = []